@@ -1,9 +1,12 @@
 import os
-import json
 import pandas as pd
 import uuid
 from dotenv import load_dotenv
-from src.search_src.similarity_result import get_record_linkage
+from src.search_src.api_client import check_customer, matches_frame
+from src.search_src.create_superduperdb import CUSTOMER_FIELDS, DuplicateCustomerError, build_details, find_customers_by_key
+from src.search_src.instrumentation import serve_metrics, stage_summary, trace
+from src.search_src.resource_cache import get_cached
+from src.search_src.similarity_result import add_customers, get_record_linkage, get_search_index, metrics_gauges, warm_up
 import streamlit as st
 
 # Load environment variables from .env file
@@ -14,12 +17,23 @@ mongodb_uri = os.getenv("MONGODB_URI")
 artifact_store = os.getenv("ARTIFACT_STORE")
 collection_name = os.getenv("COLLECTION_NAME")
 chunk_file = os.getenv("CHUNK_FILE")
+debug = os.getenv("DEDUP_DEBUG", "").lower() in ("1", "true", "yes")
+metrics_port = os.getenv("METRICS_PORT")
+# With DEDUP_API_URL set the form is a client of the deduplication API (src/search_src/api.py) and does no model or database work
+api_url = os.getenv("DEDUP_API_URL")
 
 
-# open the json file
-# @st.cache_data
-with open(chunk_file) as f:
-    chunks = json.load(f)
+# The customer snapshot (JSONL, or a legacy JSON array) is not loaded here: it is only streamed
+# into the database in batches when the index is built for the first time
+chunks = chunk_file
+
+# Load the model and indexes in the background while the form renders, once per process
+if not api_url:
+    get_cached('warm_up', (mongodb_uri, artifact_store, None), lambda: warm_up(chunks, mongodb_uri, artifact_store))
+
+# Serve the Prometheus metrics once per process, not on every Streamlit rerun; the API serves its own on /metrics
+if metrics_port and not api_url:
+    get_cached('metrics_server', (None, None, None), lambda: serve_metrics(int(metrics_port), gauges=metrics_gauges))
 
 
 
@@ -35,11 +49,21 @@ def display_results(target_df, result):
         st.write('It seems your details below')
         st.dataframe(target_df.reset_index().drop('_id', axis= 1))
         st.write('is similar to some of our existing customers below')
-        st.dataframe(result.reset_index().drop(['_id', 'details'], axis=1).style.applymap(lambda _: "background-color: lightgreen;", subset=([0], slice(None))))
+        st.dataframe(result.reset_index().drop(['_id', 'details', 'normalized'], axis=1, errors='ignore').style.applymap(lambda _: "background-color: lightgreen;", subset=([0], slice(None))))
         st.markdown("### Sorry, you are not eligible for the new customer 10 days trial")
     else:
         st.markdown("### Thank you for registering. Verify your email in your inbox and start enjoying your new customer 10 days trial.")
 
+def display_latency(timings):
+    """
+    Display the stage latencies of the last check and of all checks so far, when the app runs with DEDUP_DEBUG set.
+    """
+    with st.expander("Latency (debug)"):
+        st.write('Last check (ms)')
+        st.dataframe(pd.DataFrame([timings]))
+        st.write('All checks of this process')
+        st.dataframe(pd.DataFrame(stage_summary()).T)
+
 def home():
     """
     Main function to display the Streamlit application form for user data input.
@@ -76,13 +100,12 @@ def home():
         # Submit button logic
         submitted = st.form_submit_button("Submit")
         if submitted:
-            # Creating the full name and search term
-            full_name = st.session_state['first_name'] + ' ' + st.session_state['last_name']
-            email = st.session_state['email']
-            address = st.session_state['address']
-            phone = st.session_state['phone']
+            # Creating the full name and search term, blank fields are left out
+            full_name = (st.session_state['first_name'].strip() + ' ' + st.session_state['last_name'].strip()).strip()
+            email = st.session_state['email'].strip()
+            address = st.session_state['address'].strip()
+            phone = st.session_state['phone'].strip()
             # full_name = f'{first_name} {last_name}'.strip()
-            search_term = ' '.join([full_name, email, address, phone]).lower().strip()
 
             # Prepare data for comparison
             customer_data = {
@@ -92,11 +115,34 @@ def home():
                 'Phone Number': phone if phone else None,
                 '_id': str(uuid.uuid4())
             }
-
-            target_df = pd.DataFrame([customer_data]).set_index('_id')
-            result = get_record_linkage(target_df, chunks, mongodb_uri, artifact_store, search_term, n=5, method='jarowinkler', threshold=0.85)
-
-            display_results(target_df, result)
+            # An empty form would be checked, and registered, as a customer without any details
+            if not any(customer_data[field] for field in CUSTOMER_FIELDS):
+                st.warning('Please fill in at least one of your details.')
+            else:
+                # The search term is embedded in the format of the stored 'details' it is compared with
+                search_term = build_details(customer_data)
+                target_df = pd.DataFrame([customer_data]).set_index('_id')
+                if api_url:
+                    # The API checks the customer and registers them when they match no one
+                    response = check_customer(api_url, customer_data, register=True)
+                    result, timings = matches_frame(response), response['timings_ms']
+                else:
+                    with trace() as timings:
+                        result = get_record_linkage(target_df, chunks, mongodb_uri, artifact_store, search_term, n=5, method='jarowinkler', threshold=0.85)
+
+                # Register the new customer so that later sign-ups are checked against them as well
+                if len(result) == 0 and not api_url:
+                    try:
+                        add_customers([customer_data], chunks, mongodb_uri, artifact_store)
+                    except DuplicateCustomerError:
+                        # The same details were registered meanwhile, e.g. by a double submission
+                        st.warning('These details are already registered.')
+                        db, collection, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+                        result = pd.DataFrame(find_customers_by_key(db, collection, [customer_data])).set_index('_id')
+
+                display_results(target_df, result)
+                if debug:
+                    display_latency(timings)
     # Place the Start Again button outside the form
     if st.button("Start Again"):
         st.session_state['first_name'] = ''
@@ -0,0 +1,55 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.benchmark.dedup_benchmark import generate_benchmark_data, percentiles
+from src.search_src.api_client import DEDUP_API_URL, check_customer, check_customers
+from src.search_src.create_superduperdb import CUSTOMER_FIELDS
+
+
+def run_load(api_url, customers, concurrency=16, batch_size=1):
+    """
+    Sends the customers to the deduplication API from concurrent clients and times every request.
+
+    Parameters:
+    api_url (str): Base URL of the API.
+    customers (list): The customer records to check.
+    concurrency (int, optional): The number of requests in flight. Defaults to 16.
+    batch_size (int, optional): The number of customers per request; 1 uses /check, more uses /check/batch. Defaults to 1.
+
+    Returns:
+    dict: The number of checks, the checks per second, the request latency percentiles and the duplicates found.
+    """
+    customers = [{field: c.get(field) for field in CUSTOMER_FIELDS} for c in customers]
+    requests = [customers[i:i + batch_size] for i in range(0, len(customers), batch_size)]
+
+    def send(batch):
+        start = time.perf_counter()
+        results = [check_customer(api_url, batch[0])] if batch_size == 1 else check_customers(api_url, batch)
+        return (time.perf_counter() - start) * 1000, sum(r['duplicate'] for r in results)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(send, requests))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'checks': len(customers), 'concurrency': concurrency, 'batch_size': batch_size,
+        'checks_per_second': len(customers) / elapsed, **percentiles([latency for latency, _ in outcomes]),
+        'duplicates_found': sum(found for _, found in outcomes),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test a running deduplication API with generated duplicates and new customers.')
+    parser.add_argument('--api-url', default=DEDUP_API_URL or 'http://localhost:8000')
+    parser.add_argument('--rows', type=int, default=10000, help='size of the generated customer base the queries are drawn from')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--batch-size', type=int, default=1)
+    args = parser.parse_args()
+
+    # The API must serve the same generated customer base, e.g. one loaded with `ingest.py`
+    _, duplicates, new_customers = generate_benchmark_data(args.rows)
+    queries = duplicates + new_customers
+    for concurrency in args.concurrency:
+        print(json.dumps(run_load(args.api_url, queries, concurrency=concurrency, batch_size=args.batch_size)))
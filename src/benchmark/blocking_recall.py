@@ -0,0 +1,49 @@
+import argparse
+import json
+from collections import Counter
+from src.benchmark.dedup_benchmark import generate_benchmark_data
+from src.search_src.blocking_index import BlockingIndex
+
+
+def blocking_recall(customers, duplicates, max_block_size=50):
+    """
+    Measures how often the blocking index finds the customer a duplicate was made from.
+
+    Parameters:
+    customers (list): The customer records, each with its 'row' number.
+    duplicates (list): The duplicate records, each with the 'row' of the customer it was made from as 'source'.
+    max_block_size (int, optional): The largest block used for lookups, None for no cap. Defaults to 50.
+
+    Returns:
+    dict: The recall (duplicates whose source is among the candidates), the mean number of candidates per lookup
+          and the number of keys over the cap per key kind.
+    """
+    blocking_index = BlockingIndex(max_block_size=max_block_size or float('inf'))
+    blocking_index.add([c['row'] for c in customers], customers)
+
+    found, candidates = 0, 0
+    for duplicate in duplicates:
+        ids = blocking_index.lookup(duplicate)
+        found += str(duplicate['source']) in ids
+        candidates += len(ids)
+
+    oversized = Counter(key[0] for key, block in blocking_index.blocks.items() if len(block) > (max_block_size or float('inf')))
+    return {
+        'max_block_size': max_block_size,
+        'recall': found / len(duplicates),
+        'candidates_per_lookup': candidates / len(duplicates),
+        'oversized_keys': dict(oversized),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the recall of the blocking index with and without its block size cap.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[20000, 1000000], help='customer base sizes')
+    parser.add_argument('--max-block-size', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        customers, duplicates, _ = generate_benchmark_data(rows, seed=args.seed)
+        for max_block_size in (args.max_block_size, None):
+            print(json.dumps({'rows': rows, **blocking_recall(customers, duplicates, max_block_size=max_block_size)}))
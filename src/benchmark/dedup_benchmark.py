@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import random
+import resource
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from src.data_generation.parallel_generate import generate_parallel
+from src.data_generation.snapshot import iter_snapshot
+from src.search_src.create_superduperdb import CUSTOMER_FIELDS, MODEL_IDENTIFIER, build_details, iter_customers, load_encoder
+from src.search_src.resource_cache import get_cached
+from src.search_src.similarity_result import get_record_linkage, get_search_index
+
+
+# Where the generated benchmark data is kept between runs, and the customers per generated shard: the data only
+# depends on the seed and the shard size, so the shard size is fixed whatever the number of processes
+BENCHMARK_DATA_DIR = os.getenv('BENCHMARK_DATA_DIR', './data/benchmark')
+BENCHMARK_SHARD_SIZE = 50000
+
+
+def generate_benchmark_data(rows, anomaly_fraction=0.1, seed=0, processes=None, data_dir=BENCHMARK_DATA_DIR):
+    """
+    Generates a reproducible customer base, typo'd duplicates of some of its customers and new customers.
+
+    The data is generated in parallel with `parallel_generate.generate_parallel`, which gives the same records for
+    any number of processes, and written to JSONL snapshots in `data_dir`. Later runs with the same size, fraction
+    and seed read the snapshots instead of generating the data again.
+
+    Parameters:
+    rows (int): The number of customers in the customer base.
+    anomaly_fraction (float, optional): The number of duplicates to generate, as a fraction of `rows`. Defaults to 0.1.
+    seed (int, optional): The seed of the generators. Defaults to 0.
+    processes (int, optional): The number of generating processes. Defaults to the number of CPUs.
+    data_dir (str, optional): The directory of the generated snapshots. Defaults to the BENCHMARK_DATA_DIR environment
+                              variable or './data/benchmark'.
+
+    Returns:
+    tuple: The customer records (each with its 'row' number and 'details'), the duplicate records with the 'row'
+           of the customer they were made from as 'source', and as many new (non-duplicate) customer records.
+    """
+    anomalies_number = max(1, int(rows * anomaly_fraction))
+    shard_count = max(1, -(-rows // BENCHMARK_SHARD_SIZE))
+    paths = {
+        'customers': os.path.join(data_dir, f'customers-{rows}-{anomalies_number}-{seed}.jsonl'),
+        # Seeded after the shards of the customer base, so the new customers are not copies of existing ones
+        'new_customers': os.path.join(data_dir, f'new-customers-{anomalies_number}-{seed + shard_count}.jsonl'),
+    }
+    os.makedirs(data_dir, exist_ok=True)
+    for name, path in paths.items():
+        if os.path.exists(path):
+            continue
+        # Write to a temporary file first, so that an interrupted run does not leave a truncated snapshot behind
+        partial_path = f'{path}.{os.getpid()}.partial.jsonl'
+        if name == 'customers':
+            generate_parallel(partial_path, rows, anomalies_number, shard_size=BENCHMARK_SHARD_SIZE, processes=processes,
+                              seed=seed, record_sources=True)
+        else:
+            generate_parallel(partial_path, anomalies_number, 0, shard_size=BENCHMARK_SHARD_SIZE, processes=processes,
+                              seed=seed + shard_count)
+        os.replace(partial_path, path)
+
+    customers, duplicates = [], []
+    for batch in iter_snapshot(paths['customers']):
+        for record in batch:
+            if record['row'] is not None:
+                del record['source']
+                customers.append(record)
+            else:
+                del record['row']
+                duplicates.append(record)
+    new_customers = [record for batch in iter_snapshot(paths['new_customers']) for record in batch]
+    return customers, duplicates, new_customers
+
+
+def percentiles(values):
+    """
+    Summarizes latencies with their p50, p95 and p99.
+
+    Parameters:
+    values (list): The latencies in milliseconds.
+
+    Returns:
+    dict: The p50, p95 and p99 latency in milliseconds.
+    """
+    p50, p95, p99 = (float(p) for p in np.percentile(values, [50, 95, 99]))
+    return {'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+
+def run_queries(queries, chunks, mongodb_uri, artifact_store, n=5, backend='superduperdb', blocking=True):
+    """
+    Runs `get_record_linkage` for every query record the way the Streamlit form does and times each call.
+
+    Parameters:
+    queries (list): The query records with the customer fields.
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    n (int, optional): Number of nearest similarity results to retrieve. Defaults to 5.
+    backend (str, optional): The nearest neighbour backend. Defaults to 'superduperdb'.
+    blocking (bool, optional): Whether to look up the blocking index first. Defaults to True.
+
+    Returns:
+    tuple: The list of latencies in milliseconds and the list of the matching customer ids of every query.
+    """
+    latencies, matches = [], []
+    for i, query in enumerate(queries):
+        target_df = pd.DataFrame([{**{field: query.get(field) for field in CUSTOMER_FIELDS}, '_id': f'query-{i}'}]).set_index('_id')
+        search_term = build_details({field: query.get(field) or None for field in CUSTOMER_FIELDS})
+
+        start = time.perf_counter()
+        result = get_record_linkage(target_df, chunks, mongodb_uri, artifact_store, search_term, n=n, backend=backend, blocking=blocking)
+        latencies.append((time.perf_counter() - start) * 1000)
+        matches.append([str(i) for i in result.index])
+    return latencies, matches
+
+
+def run_benchmark(rows, mongodb_uri, artifact_store, queries=1000, anomaly_fraction=0.1, n=5, backend='superduperdb', blocking=True, seed=0):
+    """
+    Benchmarks the end-to-end deduplication path on a generated customer base of the given size.
+
+    It measures the ingest throughput (insert and embed), the raw embedding throughput, the query latency
+    percentiles and the peak memory of `get_record_linkage`, and its precision and recall: a duplicate query
+    counts as found when the customer it was made from is among the results, and a new-customer query which
+    returns any result counts as a false positive.
+
+    Parameters:
+    rows (int): The number of customers in the customer base.
+    mongodb_uri (str): MongoDB connection URI of an empty database.
+    artifact_store (str): Path to the artifact store.
+    queries (int, optional): The number of duplicate queries and of new-customer queries. Defaults to 1000.
+    anomaly_fraction (float, optional): The number of generated duplicates as a fraction of `rows`. Defaults to 0.1.
+    n (int, optional): Number of nearest similarity results to retrieve. Defaults to 5.
+    backend (str, optional): The nearest neighbour backend. Defaults to 'superduperdb'.
+    blocking (bool, optional): Whether to look up the blocking index first. Defaults to True.
+    seed (int, optional): The seed of the data generation and of the query sample. Defaults to 0.
+
+    Returns:
+    dict: The benchmark results.
+    """
+    customers, duplicates, new_customers = generate_benchmark_data(rows, anomaly_fraction=anomaly_fraction, seed=seed)
+    sample = random.Random(seed)
+    duplicate_queries = sample.sample(duplicates, min(queries, len(duplicates)))
+    new_queries = new_customers[:queries]
+
+    # Ingest: insert every customer and embed it through the vector index listener
+    start = time.perf_counter()
+    db, _, _ = get_search_index(customers, mongodb_uri, artifact_store)
+    ingest_seconds = time.perf_counter() - start
+    row_ids = {r['_id']: r['row'] for r in iter_customers(db, fields=['row'])}
+
+    # Raw embedding throughput of the model on the customer details
+    encoder = get_cached('encoder', (None, None, MODEL_IDENTIFIER), load_encoder)
+    details = [c['details'] for c in customers[:10000]]
+    start = time.perf_counter()
+    encoder.encode(details, batch_size=256)
+    embedding_seconds = time.perf_counter() - start
+
+    # Queries
+    tracemalloc.start()
+    duplicate_latencies, duplicate_matches = run_queries(duplicate_queries, customers, mongodb_uri, artifact_store, n=n, backend=backend, blocking=blocking)
+    new_latencies, new_matches = run_queries(new_queries, customers, mongodb_uri, artifact_store, n=n, backend=backend, blocking=blocking)
+    _, peak_query_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    true_positives = sum(
+        1 for query, found in zip(duplicate_queries, duplicate_matches)
+        if query['source'] in {row_ids.get(i) for i in found}
+    )
+    flagged = sum(1 for found in duplicate_matches + new_matches if found)
+
+    return {
+        'rows': rows,
+        'backend': backend,
+        'blocking': blocking,
+        'n': n,
+        'ingest_rows_per_second': rows / ingest_seconds,
+        'embedding_rows_per_second': len(details) / embedding_seconds,
+        'query_latency': percentiles(duplicate_latencies + new_latencies),
+        'peak_query_memory_mb': peak_query_memory / 2**20,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        'precision': true_positives / flagged if flagged else 0.0,
+        'recall': true_positives / len(duplicate_queries),
+        'false_positive_rate': sum(1 for found in new_matches if found) / len(new_queries),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the end-to-end deduplication path on generated data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000], help='customer base sizes')
+    parser.add_argument('--mongodb-uri', default='mongomock://dedup_benchmark_{rows}', help='MongoDB URI, {rows} is replaced by the size')
+    parser.add_argument('--artifact-store', default='filesystem://./data/benchmark_{rows}/', help='artifact store, {rows} is replaced by the size')
+    parser.add_argument('--queries', type=int, default=1000, help='number of duplicate and of new-customer queries')
+    parser.add_argument('--n', type=int, default=5, help='number of nearest similarity results')
+    parser.add_argument('--backend', default='superduperdb', help="nearest neighbour backend, e.g. 'superduperdb' or 'ivf_flat'")
+    parser.add_argument('--no-blocking', action='store_true', help='skip the blocking index')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        results = run_benchmark(
+            rows, args.mongodb_uri.format(rows=rows), args.artifact_store.format(rows=rows),
+            queries=args.queries, n=args.n, backend=args.backend, blocking=not args.no_blocking, seed=args.seed,
+        )
+        print(json.dumps(results))
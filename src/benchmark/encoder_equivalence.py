@@ -0,0 +1,95 @@
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from src.benchmark.dedup_benchmark import generate_benchmark_data, percentiles
+from src.search_src.create_superduperdb import MODEL_IDENTIFIER, load_encoder
+
+
+def throughput(encoder, texts, batch_size=256, single_queries=200):
+    """
+    Measures the bulk throughput and the single-query latency of an encoder.
+
+    Parameters:
+    encoder: An object with the `encode` method of `SentenceTransformer`.
+    texts (list): The texts to encode.
+    batch_size (int, optional): The batch size of the bulk encoding. Defaults to 256.
+    single_queries (int, optional): The number of texts encoded one at a time. Defaults to 200.
+
+    Returns:
+    tuple: The embeddings of `texts` and a dict with the rows per second of the bulk encoding and the
+           latency percentiles of the single queries.
+    """
+    # The first call loads lazily initialised kernels, it is not timed
+    encoder.encode(texts[:batch_size], batch_size=batch_size)
+
+    start = time.perf_counter()
+    embeddings = np.asarray(encoder.encode(texts, batch_size=batch_size), dtype=np.float32)
+    rows_per_second = len(texts) / (time.perf_counter() - start)
+
+    latencies = []
+    for text in texts[:single_queries]:
+        start = time.perf_counter()
+        encoder.encode(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return embeddings, {'rows_per_second': rows_per_second, **percentiles(latencies)}
+
+
+def compare_encoders(texts, threads=None, batch_size=256, n=5):
+    """
+    Compares the int8 ONNX encoder with the PyTorch sentence transformer on the same texts.
+
+    Parameters:
+    texts (list): The texts to encode, e.g. customer details.
+    threads (int, optional): The number of CPU threads of both encoders. Defaults to the library defaults.
+    batch_size (int, optional): The batch size of the bulk encoding. Defaults to 256.
+    n (int, optional): The number of nearest neighbours compared. Defaults to 5.
+
+    Returns:
+    dict: The throughput of both encoders, the cosine similarity between the embeddings of every text
+          (min, p1 and mean), and the overlap of the n nearest neighbours of every text within `texts`.
+    """
+    torch_embeddings, torch_speed = throughput(load_encoder(MODEL_IDENTIFIER, 'torch', threads), texts, batch_size)
+    onnx_embeddings, onnx_speed = throughput(load_encoder(MODEL_IDENTIFIER, 'onnx', threads), texts, batch_size)
+
+    def normalize(x):
+        return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+    torch_embeddings, onnx_embeddings = normalize(torch_embeddings), normalize(onnx_embeddings)
+    cosine = (torch_embeddings * onnx_embeddings).sum(axis=1)
+
+    # What the deduplication sees: the same neighbours among the customers
+    torch_neighbours = np.argsort(-(torch_embeddings[:1000] @ torch_embeddings.T), axis=1)[:, :n]
+    onnx_neighbours = np.argsort(-(onnx_embeddings[:1000] @ onnx_embeddings.T), axis=1)[:, :n]
+    overlap = np.mean([len(set(a) & set(b)) / n for a, b in zip(torch_neighbours, onnx_neighbours)])
+
+    return {
+        'rows': len(texts),
+        'threads': threads,
+        'torch': torch_speed,
+        'onnx_int8': onnx_speed,
+        'speedup': onnx_speed['rows_per_second'] / torch_speed['rows_per_second'],
+        'cosine_min': float(cosine.min()),
+        'cosine_p1': float(np.percentile(cosine, 1)),
+        'cosine_mean': float(cosine.mean()),
+        f'neighbour_overlap_at_{n}': float(overlap),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the int8 ONNX encoder against the PyTorch model and compare their throughput.')
+    parser.add_argument('--rows', type=int, default=5000, help='number of generated customers to encode')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads of both encoders')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--min-cosine', type=float, default=0.98, help='fail if any embedding is less similar than this')
+    args = parser.parse_args()
+
+    customers, _, _ = generate_benchmark_data(args.rows, seed=args.seed)
+    texts = [c['details'] for c in customers]
+    result = compare_encoders(texts, threads=args.threads, batch_size=args.batch_size)
+    print(json.dumps(result))
+    if result['cosine_min'] < args.min_cosine:
+        print(f"cosine similarity {result['cosine_min']:.4f} is below {args.min_cosine}", file=sys.stderr)
+        sys.exit(1)
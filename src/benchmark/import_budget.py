@@ -0,0 +1,83 @@
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+# Import-time budget of the query path, in milliseconds (cumulative, as reported by `python -X importtime`)
+IMPORT_BUDGETS_MS = {
+    'src.search_src.query_cache': 20,
+    'src.search_src.reranker': 250,
+    'src.search_src.blocking_index': 300,
+    'src.search_src.similarity_result': 600,
+    'src.search_src.api_client': 100,
+}
+
+# Libraries which take seconds to import and must only be loaded on first use
+DEFERRED_MODULES = ['sentence_transformers', 'superduperdb', 'recordlinkage', 'torch', 'pandas', 'faker']
+
+
+def measure_import(module, repeat=3):
+    """
+    Imports a module in fresh interpreters and measures its import time.
+
+    Parameters:
+    module (str): The module to import, e.g. 'src.search_src.similarity_result'.
+    repeat (int, optional): The number of measurements; the fastest counts, so that a cold disk cache does
+                            not fail the check. Defaults to 3.
+
+    Returns:
+    dict: The cumulative import time of the module in milliseconds and the deferred libraries it imported,
+          or the error raised by the import.
+    """
+    code = f'import sys, json, {module}; print(json.dumps(sorted(m for m in {DEFERRED_MODULES!r} if m in sys.modules)))'
+    timings = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+        if process.returncode:
+            return {'error': process.stderr.strip().splitlines()[-1]}
+
+        # Lines look like 'import time:   self [us] | cumulative | module'
+        for line in process.stderr.splitlines():
+            match = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)', line)
+            if match and match.group(2) == module:
+                timings.append(int(match.group(1)) / 1000)
+
+    return {'import_ms': min(timings), 'deferred_modules_imported': json.loads(process.stdout)}
+
+
+def check_budgets(budgets=IMPORT_BUDGETS_MS, repeat=3):
+    """
+    Checks every module against its import-time budget and against importing any deferred library.
+
+    Parameters:
+    budgets (dict, optional): The budget in milliseconds of every module. Defaults to IMPORT_BUDGETS_MS.
+    repeat (int, optional): The number of measurements per module. Defaults to 3.
+
+    Returns:
+    tuple: The measurements of every module and the list of violations (empty when every budget is met).
+    """
+    results, violations = {}, []
+    for module, budget in budgets.items():
+        result = measure_import(module, repeat=repeat)
+        results[module] = {**result, 'budget_ms': budget}
+        if 'error' in result:
+            violations.append(f"{module} could not be imported: {result['error']}")
+        elif result['import_ms'] > budget:
+            violations.append(f"{module} took {result['import_ms']:.0f} ms to import, over its {budget} ms budget")
+        if result.get('deferred_modules_imported'):
+            violations.append(f"{module} imports {', '.join(result['deferred_modules_imported'])} at import time")
+    return results, violations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time of the query path against its budget.')
+    parser.add_argument('--repeat', type=int, default=3, help='measurements per module, the fastest one counts')
+    args = parser.parse_args()
+
+    results, violations = check_budgets(repeat=args.repeat)
+    for module, result in results.items():
+        print(json.dumps({'module': module, **result}))
+    for violation in violations:
+        print(violation, file=sys.stderr)
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+from src.search_src.ann_index import BruteForceIndex
+from src.search_src.reranker import SIMILARITY_COLUMNS, compare_block, first_matching_field, short_circuit_candidates, similar_candidates
+from src.search_src.sharded_index import ShardedIndex, build_shards
+
+CHECKS = ('reranker', 'encoder', 'sharded')
+
+# Customers with blank fields, as submitted by an empty form: they must match no one, blank fields being missing
+BLANK_RECORDS = [
+    {'Full Name': '', 'Email': None, 'Address': None, 'Phone Number': None},
+    {'Full Name': '  ', 'Email': '', 'Address': ' ', 'Phone Number': ''},
+    {'Full Name': '', 'Email': '', 'Address': '', 'Phone Number': ''},
+]
+
+
+def check_reranker(rows=50, seed=0, method='jarowinkler', threshold=0.85):
+    """
+    Checks the block reranker against the recordlinkage comparison it replaced, on a small seeded pair set.
+
+    The customers and their typo'd duplicates are generated with `generate_database.main`, and every duplicate is
+    compared with every customer (a full recordlinkage index). With `normalized=False` the features of `compare_block`
+    must equal those of `build_comparison`. The normalized mode has no recordlinkage counterpart, so its features are
+    not checked against a reference. In both modes the short-circuit rerank must keep the same candidates as the full
+    one, and `first_matching_field` must find a field exactly for the pairs with a 'similarity_sum' of at least 1.0.
+    These two checks also run on the customers of BLANK_RECORDS, which must not match each other.
+
+    Parameters:
+    rows (int, optional): The number of customers and of duplicates, so rows * rows pairs are compared. Defaults to 50.
+    seed (int, optional): The seed of the data generation. Defaults to 0.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+
+    Returns:
+    tuple: A dict with the number of pairs and of matching pairs per mode, and the list of mismatches found.
+    """
+    import recordlinkage
+    from src.data_generation.generate_database import main, seed_generators
+    from src.search_src.similarity_result import build_comparison
+
+    seed_generators(seed)
+    df = main(rows, rows)
+    target_df, comparison_df = df.iloc[rows:].copy(), df.iloc[:rows].copy()
+    targets, candidates = target_df.to_dict('records'), comparison_df.to_dict('records')
+    pairs = recordlinkage.Index().full().index(target_df, comparison_df)
+    # Positions of the pairs of the index in the (target, candidate) grid of `compare_block`
+    target_rows = target_df.index.get_indexer(pairs.get_level_values(0))
+    candidate_rows = comparison_df.index.get_indexer(pairs.get_level_values(1))
+
+    results, violations = {'pairs': len(pairs)}, []
+    for normalized in (False, True):
+        features = compare_block(targets, candidates, method=method, threshold=threshold, normalized=normalized)
+        if not normalized:
+            expected = build_comparison(method, threshold).compute(pairs, target_df, comparison_df)[SIMILARITY_COLUMNS].to_numpy()
+            if not np.array_equal(features[target_rows, candidate_rows], expected):
+                violations.append(f'the features of compare_block differ from recordlinkage on {int((features[target_rows, candidate_rows] != expected).any(axis=1).sum())} pairs')
+
+        results[f'matching_pairs_normalized_{normalized}'] = int((features.sum(axis=2) >= 1.0).sum())
+        all_targets, all_candidates = targets + BLANK_RECORDS, candidates + BLANK_RECORDS
+        matches = compare_block(all_targets, all_candidates, method=method, threshold=threshold, normalized=normalized).sum(axis=2) >= 1.0
+        if matches[len(targets):, len(candidates):].any():
+            violations.append(f'normalized={normalized}: customers with blank fields match each other')
+        for row, target in enumerate(all_targets):
+            full = similar_candidates([target], all_candidates, method=method, threshold=threshold, normalized=normalized)
+            short_circuit = short_circuit_candidates([target], all_candidates, method=method, threshold=threshold, normalized=normalized)
+            if full != short_circuit:
+                violations.append(f'normalized={normalized}: duplicate {row} keeps candidates {short_circuit} with the short-circuit rerank, {full} with the full one')
+            fields = [first_matching_field(target, candidate, method=method, threshold=threshold, normalized=normalized) for candidate in all_candidates]
+            if [field is not None for field in fields] != matches[row].tolist():
+                violations.append(f'normalized={normalized}: first_matching_field disagrees with the features of duplicate {row}')
+    return results, violations
+
+
+def check_encoder(rows=200, seed=0, threads=None, min_cosine=0.98):
+    """
+    Checks the int8 ONNX encoder against the PyTorch sentence transformer on a small seeded set of customers.
+
+    Parameters:
+    rows (int, optional): The number of generated customers to encode. Defaults to 200.
+    seed (int, optional): The seed of the data generation. Defaults to 0.
+    threads (int, optional): The number of CPU threads of both encoders. Defaults to the library defaults.
+    min_cosine (float, optional): The lowest cosine similarity accepted between the two embeddings of a customer. Defaults to 0.98.
+
+    Returns:
+    tuple: The report of `encoder_equivalence.compare_encoders` and the list of mismatches found.
+    """
+    from src.benchmark.dedup_benchmark import generate_benchmark_data
+    from src.benchmark.encoder_equivalence import compare_encoders
+
+    customers, _, _ = generate_benchmark_data(rows, seed=seed)
+    result = compare_encoders([c['details'] for c in customers], threads=threads, batch_size=64)
+    violations = []
+    if result['cosine_min'] < min_cosine:
+        violations.append(f"the cosine similarity of the encoders drops to {result['cosine_min']:.4f}, below {min_cosine}")
+    return result, violations
+
+
+def check_sharded(rows=2000, dimensions=32, shard_count=4, queries=50, n=5, seed=0):
+    """
+    Checks that a sharded exact index returns the same neighbours as a single exact index, before and after adding
+    customers, on seeded random unit vectors.
+
+    Parameters:
+    rows (int, optional): The number of indexed vectors, a tenth more are added afterwards. Defaults to 2000.
+    dimensions (int, optional): The dimension of the vectors. Defaults to 32.
+    shard_count (int, optional): The number of shards. Defaults to 4.
+    queries (int, optional): The number of query vectors. Defaults to 50.
+    n (int, optional): Number of neighbours compared per query. Defaults to 5.
+    seed (int, optional): The seed of the vectors. Defaults to 0.
+
+    Returns:
+    tuple: A dict with the shard sizes, and the list of mismatches found.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((rows + rows // 10 + queries, dimensions)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [str(i) for i in range(len(vectors))]
+    added = slice(rows, rows + rows // 10)
+    query_vectors = vectors[rows + rows // 10:]
+
+    single = BruteForceIndex(dimensions)
+    single.add(ids[:rows], vectors[:rows])
+    violations = []
+    with tempfile.TemporaryDirectory() as path:
+        # No customer fields: the vectors are spread over the shards by id
+        sizes = build_shards(os.path.join(path, 'shards'), ids[:rows], vectors[:rows], [{}] * rows, shard_count=shard_count)
+        sharded = ShardedIndex(os.path.join(path, 'shards'))
+        try:
+            for stage in ('built', 'added'):
+                if stage == 'added':
+                    single.add(ids[added], vectors[added])
+                    sharded.add(ids[added], vectors[added], [{}] * len(ids[added]))
+                single_ids, single_scores = single.search(query_vectors, n=n)
+                sharded_ids, sharded_scores = sharded.search(query_vectors, n=n)
+                for q in range(queries):
+                    if list(sharded_ids[q]) != list(single_ids[q]) or not np.allclose(sharded_scores[q], single_scores[q], atol=1e-5):
+                        violations.append(f'{stage}: query {q} gets {list(sharded_ids[q])} from the shards, {list(single_ids[q])} from a single index')
+        finally:
+            sharded.close()
+    return {'rows': rows, 'added': rows // 10, 'shard_sizes': sizes}, violations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the optimized search paths against their reference on small seeded data.')
+    parser.add_argument('--checks', nargs='+', choices=CHECKS, default=list(CHECKS), help='the checks to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-cosine', type=float, default=0.98, help='lowest cosine similarity between the two encoders')
+    args = parser.parse_args()
+
+    failed = False
+    for check in args.checks:
+        if check == 'reranker':
+            result, violations = check_reranker(seed=args.seed)
+        elif check == 'encoder':
+            result, violations = check_encoder(seed=args.seed, min_cosine=args.min_cosine)
+        else:
+            result, violations = check_sharded(seed=args.seed)
+        print(json.dumps({'check': check, **result, 'mismatches': len(violations)}))
+        for violation in violations:
+            print(f'{check}: {violation}', file=sys.stderr)
+        failed = failed or bool(violations)
+    sys.exit(1 if failed else 0)
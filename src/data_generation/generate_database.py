@@ -7,6 +7,8 @@ from src.data_generation.general_data import generate_database, transform_phone_
 fake = faker.Faker('de_DE')
 # random.seed(0)
 
+CUSTOMER_COLUMNS = ['Full Name', 'Email', 'Address', 'Phone Number']
+
 def handlers(item, data):
     """
     Processes a given item type by applying an appropriate modification function.
@@ -57,7 +59,18 @@ def backfill(item):
     # Get the corresponding data generation function and call it
     return data_generation_map.get(item, lambda: None)()
 
-def regeneration(dataset, number):
+def seed_generators(seed):
+    """
+    Seeds the random number generators used by the data generation so that a dataset can be reproduced.
+
+    Parameters:
+    seed (int): The seed for both the `random` module and the Faker generators.
+    """
+    random.seed(seed)
+    faker.Faker.seed(seed)
+
+
+def regeneration(dataset, number, return_sources=False):
     """
     Generates a new dataset by randomly modifying or backfilling selected items from a sample of an existing dataset.
 
@@ -69,19 +82,27 @@ def regeneration(dataset, number):
     Parameters:
     dataset (DataFrame): A pandas DataFrame representing the original dataset from which to sample.
     number (int): The number of entries to sample from the dataset and the size of the new dataset to be generated.
+    return_sources (bool, optional): Whether to also return the index of the original row each entry was made from. Defaults to False.
 
     Returns:
     list: A list of dictionaries, where each dictionary represents a modified row from the original dataset.
           Each dictionary contains keys corresponding to the columns of the original dataset.
+          If `return_sources` is True, a tuple of this list and the list of the original dataset index of every entry.
     """
 
-    df_sample = dataset.sample(number).reset_index(drop=True)
+    # The sample is drawn with the `random` module so that seeding it makes the dataset reproducible
+    df_sample = dataset.sample(number, random_state=random.randint(0, 2**32 - 1))
+    sample_index = list(df_sample.index)
+    df_sample = df_sample.reset_index(drop=True)
     col_list = list(df_sample.columns)
     db = []
+    sources = []
 
     for _ in range(number):
         # Randomly select a row from the dataset
-        info = dict(df_sample.iloc[random.randint(0, len(df_sample)-1)])
+        position = random.randint(0, len(df_sample)-1)
+        info = dict(df_sample.iloc[position])
+        sources.append(sample_index[position])
         new_info = {}
 
         # Randomly decide how many items to select (1, 2, or 3) and select them
@@ -97,9 +118,32 @@ def regeneration(dataset, number):
 
         db.append(new_info)
 
+    if return_sources:
+        return db, sources
     return db
 
-def main(maindb_number, anomalies_number):
+def details_column(df, columns=CUSTOMER_COLUMNS):
+    """
+    Builds the lower-cased 'details' text of every row of a DataFrame at once.
+
+    The given columns are lower-cased and joined with a single space and missing values are left empty,
+    which is the column-wise equivalent of joining `str(x).lower()` over each row.
+
+    Parameters:
+    df (DataFrame): A DataFrame with the customer columns.
+    columns (list, optional): The columns to join, in order. Defaults to 'Full Name', 'Email', 'Address' and 'Phone Number'.
+
+    Returns:
+    Series: The 'details' text of every row.
+    """
+    details = None
+    for column in columns:
+        values = df[column].fillna('').astype(str).str.lower()
+        details = values if details is None else details + ' ' + values
+    return details
+
+
+def main(maindb_number, anomalies_number, return_sources=False):
     """
     Generates a combined DataFrame consisting of a main database and a regenerated database with anomalies.
 
@@ -108,13 +152,18 @@ def main(maindb_number, anomalies_number):
     Parameters:
     maindb_number (int): The number of records to generate for the main database.
     anomalies_number (int): The number of records to generate with anomalies for the regenerated database.
+    return_sources (bool, optional): Whether to also return, for every anomaly row, the row of the main database it was made from. Defaults to False.
 
     Returns:
     DataFrame: A pandas DataFrame containing the combined records from both the main and regenerated datasets.
+               If `return_sources` is True, a tuple of this DataFrame and the list of source rows of the anomalies,
+               where the n-th source belongs to row `maindb_number + n`.
     """
     df = pd.DataFrame(generate_database(maindb_number))
-    db = regeneration(df, anomalies_number)
+    db, sources = regeneration(df, anomalies_number, return_sources=True)
     df = pd.concat([df, pd.DataFrame(db)], ignore_index=True)
+    if return_sources:
+        return df, sources
     return df
 
 if __name__ == '__main__':
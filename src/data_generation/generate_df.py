@@ -1,17 +1,14 @@
 # import pandas as pd
 # import sys
-from src.data_generation.generate_database import main
+from src.data_generation.generate_database import details_column, main
+from src.data_generation.snapshot import write_snapshot
 
 # sys.path.insert(0,'customer_deduplication/src/')
 
 
 df = main(10, 5)
-df['details'] = df.apply(lambda row: ' '.join(str(x).lower() if x is not None else '' for x in row), axis=1)
+df['details'] = details_column(df)
 
-# Convert DataFrame to JSON
-json_result = df.to_json(orient='records')
-
-
-# To save the JSON to a file
-with open('customer_details.json', 'w') as file:
-    file.write(json_result)
+# Save the records to a JSONL snapshot, one record per line
+df = df.astype(object).where(df.notna(), None)
+write_snapshot(df.to_dict('records'), 'customer_details.jsonl')
@@ -0,0 +1,156 @@
+import argparse
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from src.data_generation.general_data import generate_database
+from src.data_generation.generate_database import CUSTOMER_COLUMNS, backfill, details_column, handlers, seed_generators
+
+
+def vectorized_regeneration(dataset, number, rng, return_sources=False):
+    """
+    Generates anomalies of randomly chosen rows of a dataset, choosing the rows and the modified columns all at once.
+
+    This follows the rules of `regeneration`: each anomaly is made from a random row, 1, 2 or 3 of its columns
+    are modified with `handlers` and the other columns are backfilled with `backfill`. Only the per-value
+    modifications themselves run one value at a time.
+
+    Parameters:
+    dataset (DataFrame): The customer base to make anomalies from.
+    number (int): The number of anomalies to generate.
+    rng (Generator): The numpy random generator used for the row and column selection.
+    return_sources (bool, optional): Whether to also return the position of the row every anomaly was made from. Defaults to False.
+
+    Returns:
+    DataFrame: The anomalies, with the columns of the dataset. If `return_sources` is True, a tuple of the anomalies
+               and the array of the positions in `dataset` of their source rows.
+    """
+    columns = list(dataset.columns)
+    source_rows = rng.integers(0, len(dataset), size=number)
+    sources = dataset.iloc[source_rows].reset_index(drop=True)
+
+    # A random permutation of the columns per anomaly; its first 1, 2 or 3 columns are the selected ones
+    ranks = np.argsort(rng.random((number, len(columns))), axis=1).argsort(axis=1)
+    selected = ranks < rng.choice([1, 2, 3], size=number)[:, None]
+
+    anomalies = {}
+    for position, column in enumerate(columns):
+        values = sources[column].to_numpy(dtype=object)
+        anomalies[column] = [
+            handlers(column, {column: value}) if is_selected else backfill(column)
+            for value, is_selected in zip(values, selected[:, position])
+        ]
+    anomalies = pd.DataFrame(anomalies, columns=columns)
+    if return_sources:
+        return anomalies, source_rows
+    return anomalies
+
+
+def generate_shard(shard):
+    """
+    Generates one shard of the dataset with its own seed and writes it to a JSON lines file.
+
+    Parameters:
+    shard (tuple): The shard number, the number of main database rows, the number of anomalies,
+                   the seed of the shard, the path of the file to write and the number of the first main database
+                   row of the shard in the whole dataset, or None not to record the rows.
+
+    Returns:
+    str: The path of the written file.
+    """
+    shard_number, maindb_number, anomalies_number, seed, path, first_row = shard
+    seed_generators(seed)
+    rng = np.random.default_rng(seed)
+
+    df = pd.DataFrame(generate_database(maindb_number), columns=CUSTOMER_COLUMNS)
+    source_rows = np.array([], dtype=np.int64)
+    if anomalies_number:
+        anomalies, source_rows = vectorized_regeneration(df, anomalies_number, rng, return_sources=True)
+        df = pd.concat([df, anomalies], ignore_index=True)
+    df = df.astype(object).where(df.notna(), None)
+    df['details'] = details_column(df)
+    if first_row is not None:
+        # Main database rows get their 'row' number in the whole dataset and anomalies the 'source' row they were made from
+        df['row'] = pd.Series([first_row + row for row in range(maindb_number)] + [None] * len(source_rows), dtype=object)
+        df['source'] = pd.Series([None] * maindb_number + [first_row + int(row) for row in source_rows], dtype=object)
+
+    df.to_json(path, orient='records', lines=True)
+    return path
+
+
+def generate_parallel(output_path, maindb_number, anomalies_number, shard_size=100000, processes=None, seed=0, record_sources=False):
+    """
+    Generates a large customer dataset in parallel and streams it to disk shard by shard.
+
+    The rows are split into shards of `shard_size` main database rows with a proportional share of the anomalies
+    (made from the rows of the same shard). Every shard is generated in a worker process with its own seed,
+    written to a temporary file and appended to the output as soon as it is ready, so neither the whole DataFrame
+    nor the whole JSON string is ever held in memory. The output only depends on the seed and the shard size, not on
+    the number of processes.
+
+    Parameters:
+    output_path (str): The file to write. A '.jsonl' file gets one JSON record per line; any other file gets a JSON array
+                       like `generate_df.py` writes.
+    maindb_number (int): The number of records to generate for the main database.
+    anomalies_number (int): The number of records to generate with anomalies.
+    shard_size (int, optional): The number of main database rows per shard. Defaults to 100000.
+    processes (int, optional): The number of worker processes. Defaults to the number of CPUs.
+    seed (int, optional): The base seed; shard i is seeded with `seed + i`. Defaults to 0.
+    record_sources (bool, optional): Whether to add the 'row' number of every main database record and the 'source'
+                                     row of every anomaly, e.g. to measure whether a duplicate is found. Defaults to False.
+
+    Returns:
+    int: The number of records written.
+    """
+    shard_count = max(1, -(-maindb_number // shard_size))
+    tmp_dir = tempfile.mkdtemp(prefix='customer_shards_')
+    shards = []
+    for i in range(shard_count):
+        rows = min(shard_size, maindb_number - i * shard_size)
+        anomalies = anomalies_number * (i + 1) // shard_count - anomalies_number * i // shard_count
+        first_row = i * shard_size if record_sources else None
+        shards.append((i, rows, anomalies, seed + i, os.path.join(tmp_dir, f'shard-{i}.jsonl'), first_row))
+
+    lines_format = output_path.endswith('.jsonl')
+    written = 0
+    try:
+        with Pool(processes) as pool, open(output_path, 'w') as output:
+            if not lines_format:
+                output.write('[')
+            for path in pool.imap(generate_shard, shards):
+                with open(path) as shard_file:
+                    for line in shard_file:
+                        line = line.rstrip('\n')
+                        if not line:
+                            continue
+                        if lines_format:
+                            output.write(line + '\n')
+                        else:
+                            output.write((',' if written else '') + line)
+                        written += 1
+                os.remove(path)
+            if not lines_format:
+                output.write(']')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a large synthetic customer dataset in parallel.')
+    parser.add_argument('output_path', help="output file, '.jsonl' for JSON lines or '.json' for a JSON array")
+    parser.add_argument('maindb_number', type=int, help='number of main database records')
+    parser.add_argument('anomalies_number', type=int, help='number of records with anomalies')
+    parser.add_argument('--shard-size', type=int, default=100000, help='main database rows per shard')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    written = generate_parallel(
+        args.output_path, args.maindb_number, args.anomalies_number,
+        shard_size=args.shard_size, processes=args.processes, seed=args.seed,
+    )
+    print(f'{written} records written to {args.output_path}')
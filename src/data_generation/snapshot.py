@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+class StaleEmbeddingsError(ValueError):
+    """
+    Raised when the embedding matrix stored alongside a snapshot was not computed from the snapshot as it is now.
+    """
+
+
+def write_snapshot(records, path):
+    """
+    Writes customer records to a line-delimited JSON (JSONL) snapshot, one record per line.
+
+    The records are written one at a time, so they can come from a generator and never have to be in memory together.
+
+    Parameters:
+    records (iterable): The customer records as dictionaries.
+    path (str): The snapshot file to write, e.g. 'customer_details.jsonl'.
+
+    Returns:
+    int: The number of records written.
+    """
+    written = 0
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+            written += 1
+    return written
+
+
+def iter_snapshot(path, batch_size=10000):
+    """
+    Reads a customer snapshot in batches.
+
+    JSONL snapshots are streamed line by line. A JSON array file, as written by earlier versions of `generate_df.py`,
+    is still accepted but has to be parsed at once.
+
+    Parameters:
+    path (str): The snapshot file.
+    batch_size (int, optional): The number of records per batch. Defaults to 10000.
+
+    Yields:
+    list: A list of at most `batch_size` customer records.
+    """
+    if not path.endswith('.jsonl'):
+        with open(path) as f:
+            records = json.load(f)
+        for start in range(0, len(records), batch_size):
+            yield records[start:start + batch_size]
+        return
+
+    batch = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def count_snapshot_rows(path):
+    """
+    Counts the records of a customer snapshot without parsing them (for JSONL snapshots).
+
+    Parameters:
+    path (str): The snapshot file.
+
+    Returns:
+    int: The number of records.
+    """
+    if not path.endswith('.jsonl'):
+        return sum(len(batch) for batch in iter_snapshot(path))
+
+    with open(path) as f:
+        return sum(1 for line in f if line.strip())
+
+
+def embeddings_path(path):
+    """
+    Returns the path of the embedding matrix stored alongside a snapshot.
+
+    Parameters:
+    path (str): The snapshot file, e.g. 'customer_details.jsonl'.
+
+    Returns:
+    str: The path of the embedding matrix, e.g. 'customer_details.embeddings.npy'.
+    """
+    return f'{os.path.splitext(path)[0]}.embeddings.npy'
+
+
+def fingerprint_path(path):
+    """
+    Returns the path of the fingerprint of the snapshot its embedding matrix was computed from.
+
+    Parameters:
+    path (str): The snapshot file, e.g. 'customer_details.jsonl'.
+
+    Returns:
+    str: The path of the fingerprint, e.g. 'customer_details.embeddings.json'.
+    """
+    return f'{os.path.splitext(path)[0]}.embeddings.json'
+
+
+def snapshot_fingerprint(path, chunk_size=2**20):
+    """
+    Fingerprints a snapshot by its number of records and the SHA-256 of its content.
+
+    Parameters:
+    path (str): The snapshot file.
+    chunk_size (int, optional): The number of bytes hashed at once. Defaults to 1 MiB.
+
+    Returns:
+    dict: The 'rows' and the 'sha256' of the snapshot.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return {'rows': count_snapshot_rows(path), 'sha256': digest.hexdigest()}
+
+
+def save_fingerprint(path, fingerprint):
+    """
+    Records the fingerprint of the snapshot an embedding matrix was computed from, once the matrix is complete.
+
+    Parameters:
+    path (str): The snapshot file.
+    fingerprint (dict): The fingerprint returned by `snapshot_fingerprint` before the embeddings were computed.
+    """
+    with open(fingerprint_path(path), 'w') as f:
+        json.dump(fingerprint, f)
+
+
+def create_embeddings(path, rows, dimensions=384):
+    """
+    Creates the memory-mapped float32 embedding matrix of a snapshot, to be filled batch by batch.
+
+    Parameters:
+    path (str): The snapshot file.
+    rows (int): The number of records of the snapshot.
+    dimensions (int, optional): The embedding size. Defaults to 384.
+
+    Returns:
+    memmap: A writable (rows, dimensions) float32 matrix backed by the '.embeddings.npy' file.
+    """
+    # Mark the matrix as incomplete until `save_fingerprint` records the snapshot it was computed from
+    save_fingerprint(path, {'rows': rows, 'sha256': None})
+    return np.lib.format.open_memmap(embeddings_path(path), mode='w+', dtype=np.float32, shape=(rows, dimensions))
+
+
+def load_embeddings(path):
+    """
+    Memory-maps the embedding matrix of a snapshot, if it has been computed.
+
+    Only the pages which are actually read are loaded. The matrix is attached to the records by position, so it is
+    first checked against the snapshot: the fingerprint saved with it must match the snapshot as it is now. A matrix
+    written before fingerprints were saved must have one row per record and be newer than the snapshot.
+
+    Parameters:
+    path (str): The snapshot file.
+
+    Returns:
+    memmap: A read-only float32 matrix whose rows are aligned with the snapshot records, or None if there is none.
+
+    Raises:
+    StaleEmbeddingsError: If the matrix was computed from another version of the snapshot, or not completed.
+    """
+    matrix_path = embeddings_path(path)
+    if not os.path.exists(matrix_path):
+        return None
+    embeddings = np.load(matrix_path, mmap_mode='r')
+
+    if os.path.exists(fingerprint_path(path)):
+        with open(fingerprint_path(path)) as f:
+            stored = json.load(f)
+        current = snapshot_fingerprint(path)
+        stale = stored != current or len(embeddings) != current['rows']
+    else:
+        stale = len(embeddings) != count_snapshot_rows(path) or os.path.getmtime(matrix_path) < os.path.getmtime(path)
+    if stale:
+        raise StaleEmbeddingsError(
+            f'{matrix_path} was not computed from the current {path}; compute it again with '
+            f'`python -m src.search_src.create_superduperdb {path}` or delete it'
+        )
+    return embeddings
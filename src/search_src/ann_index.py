@@ -0,0 +1,716 @@
+import abc
+import argparse
+import json
+import tempfile
+import os
+import time
+import numpy as np
+from src.search_src.vector_search import normalize, top_n_cosine, top_n_from_blocks
+
+
+def train_centroids(vectors, nlist, iterations=10, seed=0):
+    """
+    Clusters unit-length vectors with spherical k-means on a sample of at most 256 vectors per cluster.
+
+    Parameters:
+    vectors (ndarray): A 2-d array of unit-length vectors, possibly memory-mapped.
+    nlist (int): The number of clusters. It is capped at the number of vectors.
+    iterations (int, optional): The number of k-means iterations. Defaults to 10.
+    seed (int, optional): The seed of the sampling. Defaults to 0.
+
+    Returns:
+    ndarray: The unit-length centroids, one row per cluster.
+    """
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(vectors))
+    rows = np.sort(rng.choice(len(vectors), size=min(len(vectors), nlist * 256), replace=False))
+    sample = np.asarray(vectors[rows], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+
+    for _ in range(iterations):
+        assignments = top_n_cosine(sample, centroids, n=1)[0][:, 0]
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = np.bincount(assignments, minlength=nlist) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+def inverted_lists(assignments, nlist):
+    """
+    Groups the row positions of the stored vectors by their cluster.
+
+    Parameters:
+    assignments (ndarray): The cluster of every stored vector.
+    nlist (int): The number of clusters.
+
+    Returns:
+    list: One array of row positions per cluster, in row order.
+    """
+    order = np.argsort(assignments, kind='stable')
+    bounds = np.searchsorted(assignments[order], np.arange(nlist + 1))
+    return [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+
+
+class BruteForceIndex:
+    """
+    Exact nearest neighbour index which compares a query with every stored vector.
+
+    It is the reference the approximate indexes are measured against.
+    """
+
+    backend = 'brute_force'
+
+    def __init__(self, dimensions=384):
+        self.dimensions = dimensions
+        self.ids = np.array([], dtype=object)
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+
+    def add(self, ids, vectors):
+        """
+        Adds vectors to the index.
+
+        Parameters:
+        ids (list): The ids of the vectors, for example the customer '_id's as strings.
+        vectors (ndarray): A 2-d array of vectors, row-aligned with `ids`.
+        """
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        self.vectors = np.concatenate([self.vectors, normalize(vectors)])
+
+    def search(self, queries, n=5):
+        """
+        Finds the n most similar stored vectors of every query.
+
+        Parameters:
+        queries (ndarray): A 2-d array of query vectors.
+        n (int, optional): Number of neighbours to return per query. Defaults to 5.
+
+        Returns:
+        tuple: A list with the neighbour ids of every query and a list with their cosine similarity scores.
+        """
+        positions, scores = top_n_cosine(normalize(queries), self.vectors, n=n)
+        return [list(self.ids[p]) for p in positions], scores.tolist()
+
+    def _params(self):
+        return {}
+
+    def _save_arrays(self, path):
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+
+    def _load_arrays(self, path):
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+
+    def save(self, path):
+        """
+        Persists the index to a directory.
+
+        Parameters:
+        path (str): The directory to write the index to. It is created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'backend': self.backend, 'dimensions': self.dimensions, 'params': self._params()}, f)
+        np.save(os.path.join(path, 'ids.npy'), self.ids.astype(str))
+        self._save_arrays(path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index persisted with `save`.
+
+        Parameters:
+        path (str): The directory the index was written to.
+
+        Returns:
+        The loaded index.
+        """
+        with open(os.path.join(path, 'index.json')) as f:
+            info = json.load(f)
+        index = cls(dimensions=info['dimensions'], **info['params'])
+        index.ids = np.load(os.path.join(path, 'ids.npy')).astype(object)
+        index._load_arrays(path)
+        return index
+
+
+class IVFFlatIndex(BruteForceIndex):
+    """
+    Inverted file index: the vectors are clustered with k-means and a query is only compared
+    with the vectors of its `nprobe` closest clusters.
+
+    Raising `nprobe` raises recall and latency; `nlist` sets the number of clusters.
+    """
+
+    backend = 'ivf_flat'
+
+    def __init__(self, dimensions=384, nlist=1024, nprobe=16, iterations=10, seed=0):
+        super().__init__(dimensions)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.assignments = np.array([], dtype=np.int64)
+        self._lists = None
+
+    def _train(self, vectors):
+        self.centroids = train_centroids(vectors, self.nlist, iterations=self.iterations, seed=self.seed)
+
+    def add(self, ids, vectors):
+        vectors = normalize(vectors)
+        if len(vectors) == 0:
+            # Nothing to train the centroids on yet, e.g. an empty shard
+            return
+        if self.centroids is None:
+            self._train(vectors)
+
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.assignments = np.concatenate([self.assignments, top_n_cosine(vectors, self.centroids, n=1)[0][:, 0]])
+        self._lists = None
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            self._lists = inverted_lists(self.assignments, len(self.centroids))
+        return self._lists
+
+    def search(self, queries, n=5):
+        queries = normalize(queries)
+        if self.centroids is None:
+            return [[] for _ in queries], [[] for _ in queries]
+
+        lists = self._inverted_lists()
+        probes = top_n_cosine(queries, self.centroids, n=self.nprobe)[0]
+
+        ids, scores = [], []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([lists[c] for c in probe])
+            positions, candidate_scores = top_n_cosine(query[None, :], self.vectors[candidates], n=n)
+            ids.append(list(self.ids[candidates[positions[0]]]))
+            scores.append(candidate_scores[0].tolist())
+        return ids, scores
+
+    def _params(self):
+        return {'nlist': self.nlist, 'nprobe': self.nprobe, 'iterations': self.iterations, 'seed': self.seed}
+
+    def _save_arrays(self, path):
+        super()._save_arrays(path)
+        # An index without customers has no centroids yet
+        if self.centroids is not None:
+            np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'assignments.npy'), self.assignments)
+
+    def _load_arrays(self, path):
+        super()._load_arrays(path)
+        centroids_path = os.path.join(path, 'centroids.npy')
+        self.centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+        self.assignments = np.load(os.path.join(path, 'assignments.npy'))
+
+
+class HNSWIndex(BruteForceIndex):
+    """
+    Hierarchical navigable small world graph index backed by the optional `hnswlib` package.
+
+    `M` and `ef_construction` control the graph quality at build time; raising `ef` raises
+    recall and latency at query time.
+    """
+
+    backend = 'hnsw'
+
+    def __init__(self, dimensions=384, M=16, ef_construction=200, ef=64):
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError("The 'hnsw' backend needs the hnswlib package: pip install hnswlib") from e
+
+        self.dimensions = dimensions
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.ids = np.array([], dtype=object)
+        self.graph = hnswlib.Index(space='cosine', dim=dimensions)
+        self.graph.init_index(max_elements=1024, ef_construction=ef_construction, M=M)
+
+    def add(self, ids, vectors):
+        start = len(self.ids)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        if len(self.ids) > self.graph.get_max_elements():
+            self.graph.resize_index(max(len(self.ids), 2 * self.graph.get_max_elements()))
+        self.graph.add_items(normalize(vectors), np.arange(start, len(self.ids)))
+
+    def search(self, queries, n=5):
+        n = min(n, len(self.ids))
+        if n == 0:
+            return [[] for _ in queries], [[] for _ in queries]
+
+        self.graph.set_ef(max(self.ef, n))
+        labels, distances = self.graph.knn_query(normalize(queries), k=n)
+        return [list(self.ids[label]) for label in labels], (1.0 - distances).tolist()
+
+    def _params(self):
+        return {'M': self.M, 'ef_construction': self.ef_construction, 'ef': self.ef}
+
+    def _save_arrays(self, path):
+        self.graph.save_index(os.path.join(path, 'graph.bin'))
+
+    def _load_arrays(self, path):
+        self.graph.load_index(os.path.join(path, 'graph.bin'), max_elements=max(len(self.ids), 1024))
+
+
+class QuantizedIndex(BruteForceIndex, abc.ABC):
+    """
+    Index over compressed vectors behind inverted lists, with an optional exact rescoring of the top candidates.
+
+    As in `IVFFlatIndex`, the vectors are clustered with k-means and a query is only compared with the codes of its
+    `nprobe` closest clusters; set `nlist` to 0 to scan every code. The codes are scored without expanding them
+    to float32 where the backend allows it (see `_score`). The `rescore * n` best candidates are then scored again
+    with their full-precision vectors. Once the index is saved and loaded, the full-precision vectors are
+    memory-mapped from disk and only the rows of the candidates are read, so only the codes have to fit in memory.
+    The vectors added to a loaded index are kept in an in-memory tail next to the memory-mapped ones, instead of
+    reading the whole file into memory to append them, and are written out with them by the next `save`.
+    Set `rescore` to 0 to return the approximate scores as they are.
+    """
+
+    def __init__(self, dimensions=384, rescore=4, nlist=1024, nprobe=16, iterations=10, seed=0):
+        super().__init__(dimensions)
+        self.rescore = rescore
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.codes = None
+        self.centroids = None
+        self.assignments = np.array([], dtype=np.int64)
+        self._lists = None
+        # The rescoring vectors added after the memory-mapped `vectors` were loaded
+        self._tail = np.zeros((0, dimensions), dtype=np.float32)
+
+    @abc.abstractmethod
+    def _encode(self, vectors):
+        """
+        Returns the codes of unit-length vectors, one row per vector.
+        """
+
+    @abc.abstractmethod
+    def _score(self, queries, codes):
+        """
+        Returns the approximate similarity of every query with every code, as a (queries, codes) float32 array.
+        """
+
+    def add(self, ids, vectors):
+        vectors = normalize(vectors)
+        if len(vectors) == 0:
+            return
+        # The lists are trained on the first vectors; an index saved without lists keeps scanning every code
+        if self.nlist and self.centroids is None and self.codes is None:
+            self.centroids = train_centroids(vectors, self.nlist, iterations=self.iterations, seed=self.seed)
+        codes = self._encode(vectors)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        self.codes = codes if self.codes is None else np.concatenate([self.codes, codes])
+        if self.centroids is not None:
+            self.assignments = np.concatenate([self.assignments, top_n_cosine(vectors, self.centroids, n=1)[0][:, 0]])
+            self._lists = None
+        if self.rescore and isinstance(self.vectors, np.memmap):
+            self._tail = np.concatenate([self._tail, vectors])
+        elif self.rescore:
+            self.vectors = np.concatenate([self.vectors, vectors])
+
+    def _rescoring_vectors(self, rows):
+        # The full-precision vectors of the sorted rows, from the memory-mapped file and the in-memory tail
+        split = np.searchsorted(rows, len(self.vectors))
+        if split == len(rows):
+            return self.vectors[rows]
+        return np.concatenate([self.vectors[rows[:split]], self._tail[rows[split:] - len(self.vectors)]])
+
+    def _candidates(self, queries, count, block_size=65536):
+        # The positions of the `count` best codes of every query, from its closest clusters or from all codes
+        if self.centroids is None:
+            blocks = (
+                (start, self._score(queries, self.codes[start:start + block_size]))
+                for start in range(0, len(self.codes), block_size)
+            )
+            positions, scores = top_n_from_blocks(blocks, len(queries), count)
+            return list(positions), list(scores)
+
+        if self._lists is None:
+            self._lists = inverted_lists(self.assignments, len(self.centroids))
+        probes = top_n_cosine(queries, self.centroids, n=self.nprobe)[0]
+        positions, scores = [], []
+        for query, probe in zip(queries, probes):
+            rows = np.sort(np.concatenate([self._lists[c] for c in probe]))
+            row_scores = self._score(query[None, :], self.codes[rows])[0]
+            best = np.argsort(-row_scores, kind='stable')[:count]
+            positions.append(rows[best])
+            scores.append(row_scores[best])
+        return positions, scores
+
+    def search(self, queries, n=5):
+        queries = normalize(queries)
+        n = min(n, len(self.ids))
+        if self.codes is None:
+            return [[] for _ in queries], [[] for _ in queries]
+        rescoring = bool(self.rescore) and len(self.vectors) + len(self._tail) == len(self.ids)
+        candidate_count = min(n * self.rescore, len(self.ids)) if rescoring else n
+        positions, scores = self._candidates(queries, candidate_count)
+        if not rescoring:
+            return [list(self.ids[p]) for p in positions], [s.tolist() for s in scores]
+
+        ids, rescored = [], []
+        for query, candidates in zip(queries, positions):
+            # Read the candidate rows in file order
+            candidates = np.sort(candidates)
+            exact_positions, exact_scores = top_n_cosine(query[None, :], self._rescoring_vectors(candidates), n=n)
+            ids.append(list(self.ids[candidates[exact_positions[0]]]))
+            rescored.append(exact_scores[0].tolist())
+        return ids, rescored
+
+    def memory_bytes(self):
+        """
+        Returns the memory taken by the index.
+
+        The full-precision vectors kept for the rescoring are counted while they are in memory, i.e. from `add`
+        until the index is saved and loaded again; a loaded index memory-maps them and reads them from disk.
+
+        Returns:
+        int: The size in bytes of the codes, the codebooks, the cluster centroids and assignments and the
+             in-memory full-precision vectors.
+        """
+        size = 0 if self.codes is None else self.codes.nbytes
+        size += self.assignments.nbytes + (0 if self.centroids is None else self.centroids.nbytes)
+        if self.rescore and not isinstance(self.vectors, np.memmap):
+            size += self.vectors.nbytes
+        return size + self._tail.nbytes
+
+    def _params(self):
+        return {'rescore': self.rescore, 'nlist': self.nlist, 'nprobe': self.nprobe, 'iterations': self.iterations, 'seed': self.seed}
+
+    def _save_arrays(self, path):
+        # An index without vectors has no codes or centroids yet
+        if self.codes is not None:
+            np.save(os.path.join(path, 'codes.npy'), self.codes)
+        if self.centroids is not None:
+            np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'assignments.npy'), self.assignments)
+        if self.rescore and isinstance(self.vectors, np.memmap):
+            # Copy the memory-mapped vectors and the tail block by block into a new file, which replaces the one
+            # they may be mapped from
+            vectors_path = os.path.join(path, 'vectors.npy')
+            partial_path = vectors_path + '.partial'
+            merged = np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.float32, shape=(len(self.vectors) + len(self._tail), self.dimensions))
+            for start in range(0, len(self.vectors), 65536):
+                end = min(start + 65536, len(self.vectors))
+                merged[start:end] = self.vectors[start:end]
+            merged[len(self.vectors):] = self._tail
+            merged.flush()
+            del merged
+            os.replace(partial_path, vectors_path)
+        elif self.rescore:
+            super()._save_arrays(path)
+
+    def _load_arrays(self, path):
+        for name in ('codes', 'centroids'):
+            array_path = os.path.join(path, f'{name}.npy')
+            setattr(self, name, np.load(array_path) if os.path.exists(array_path) else None)
+        assignments_path = os.path.join(path, 'assignments.npy')
+        if os.path.exists(assignments_path):
+            self.assignments = np.load(assignments_path)
+        if os.path.exists(os.path.join(path, 'vectors.npy')):
+            super()._load_arrays(path)
+
+
+class Float16Index(QuantizedIndex):
+    """
+    Index over half-precision vectors: 2 bytes per dimension and almost no loss of recall.
+    """
+
+    backend = 'float16'
+
+    def __init__(self, dimensions=384, rescore=0, nlist=1024, nprobe=16, iterations=10, seed=0):
+        super().__init__(dimensions, rescore, nlist, nprobe, iterations, seed)
+
+    def _encode(self, vectors):
+        return vectors.astype(np.float16)
+
+    def _score(self, queries, codes):
+        # NumPy has no fast float16 product, so the probed codes are widened and multiplied with BLAS
+        return queries @ codes.astype(np.float32).T
+
+
+class ScalarQuantizedIndex(QuantizedIndex):
+    """
+    Index over int8 vectors: every dimension is scaled by its largest absolute value and rounded
+    to one byte, a quarter of the float32 size.
+    """
+
+    backend = 'int8'
+
+    def __init__(self, dimensions=384, rescore=4, nlist=1024, nprobe=16, iterations=10, seed=0):
+        super().__init__(dimensions, rescore, nlist, nprobe, iterations, seed)
+        self.scale = None
+
+    def _encode(self, vectors):
+        if self.scale is None:
+            self.scale = np.maximum(np.abs(vectors).max(axis=0), 1e-6).astype(np.float32) / 127
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def _score(self, queries, codes):
+        # q . (codes * scale) == (q * scale) . codes
+        scaled = (queries * self.scale).astype(np.float32)
+        if len(scaled) == 1:
+            # One query is multiplied with the int8 codes as they are, about 3x faster than widening them first
+            return np.einsum('nd,d->n', codes, scaled[0])[None, :]
+        # A batch of queries amortizes the widening over one BLAS product
+        return scaled @ codes.astype(np.float32).T
+
+    def memory_bytes(self):
+        return super().memory_bytes() + (0 if self.scale is None else self.scale.nbytes)
+
+    def _save_arrays(self, path):
+        super()._save_arrays(path)
+        if self.scale is not None:
+            np.save(os.path.join(path, 'scale.npy'), self.scale)
+
+    def _load_arrays(self, path):
+        super()._load_arrays(path)
+        scale_path = os.path.join(path, 'scale.npy')
+        self.scale = np.load(scale_path) if os.path.exists(scale_path) else None
+
+
+class ProductQuantizedIndex(QuantizedIndex):
+    """
+    Index over product-quantized vectors: the dimensions are split into `m` sub-vectors and each of them
+    is replaced by the number of its closest centroid out of 256, so a vector takes `m` bytes.
+
+    A query is compared with the codes through per-query lookup tables of its similarity with every centroid
+    (asymmetric distance computation), so the codes are never decoded.
+    The scores are coarse, so the top candidates should be rescored.
+    """
+
+    backend = 'pq'
+
+    def __init__(self, dimensions=384, m=48, rescore=10, nlist=1024, nprobe=16, iterations=10, seed=0):
+        if dimensions % m:
+            raise ValueError(f'The number of sub-vectors m={m} must divide the dimensions ({dimensions})')
+        super().__init__(dimensions, rescore, nlist, nprobe, iterations, seed)
+        self.m = m
+        self.codebooks = None
+
+    def _split(self, vectors):
+        return vectors.reshape(len(vectors), self.m, self.dimensions // self.m)
+
+    def _train(self, vectors):
+        # k-means with 256 centroids in every sub-space, on a sample of the vectors
+        rng = np.random.default_rng(self.seed)
+        sample = self._split(vectors[rng.choice(len(vectors), size=min(len(vectors), 256 * 64), replace=False)])
+        codebooks = []
+        for j in range(self.m):
+            points = sample[:, j]
+            centroids = points[rng.choice(len(points), size=min(256, len(points)), replace=False)]
+            for _ in range(self.iterations):
+                assignments = self._nearest(points, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignments, points)
+                counts = np.bincount(assignments, minlength=len(centroids))
+                centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+            codebooks.append(centroids)
+        self.codebooks = np.stack(codebooks).astype(np.float32)
+
+    @staticmethod
+    def _nearest(points, centroids):
+        # argmin |p - c|^2 == argmin |c|^2 - 2 p . c
+        return np.argmin((centroids ** 2).sum(axis=1) - 2 * points @ centroids.T, axis=1)
+
+    def _encode(self, vectors, block_size=65536):
+        if self.codebooks is None:
+            self._train(vectors)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for start in range(0, len(vectors), block_size):
+            block = self._split(vectors[start:start + block_size])
+            for j in range(self.m):
+                codes[start:start + block_size, j] = self._nearest(block[:, j], self.codebooks[j])
+        return codes
+
+    def _score(self, queries, codes):
+        # Similarity of every query sub-vector with every centroid of its sub-space: (queries, m, 256)
+        tables = np.einsum('qjd,jkd->qjk', self._split(queries), self.codebooks)
+        sub_spaces = np.arange(self.m)
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        # Bound the (queries, rows, m) lookups held at once
+        block_size = max(1024, 2**24 // (len(queries) * self.m))
+        for start in range(0, len(codes), block_size):
+            scores[:, start:start + block_size] = tables[:, sub_spaces, codes[start:start + block_size]].sum(axis=2)
+        return scores
+
+    def memory_bytes(self):
+        return super().memory_bytes() + (0 if self.codebooks is None else self.codebooks.nbytes)
+
+    def _params(self):
+        return {'m': self.m, **super()._params()}
+
+    def _save_arrays(self, path):
+        super()._save_arrays(path)
+        if self.codebooks is not None:
+            np.save(os.path.join(path, 'codebooks.npy'), self.codebooks)
+
+    def _load_arrays(self, path):
+        super()._load_arrays(path)
+        codebooks_path = os.path.join(path, 'codebooks.npy')
+        self.codebooks = np.load(codebooks_path) if os.path.exists(codebooks_path) else None
+
+
+ANN_BACKENDS = {
+    'brute_force': BruteForceIndex,
+    'ivf_flat': IVFFlatIndex,
+    'hnsw': HNSWIndex,
+    'float16': Float16Index,
+    'int8': ScalarQuantizedIndex,
+    'pq': ProductQuantizedIndex,
+}
+
+
+def build_ann_index(backend, ids, vectors, **params):
+    """
+    Builds an in-process nearest neighbour index of the given backend.
+
+    The backends and their parameters are:
+    - 'brute_force': exact search, no parameters.
+    - 'ivf_flat': `nlist` (1024) clusters, of which a query searches the `nprobe` (16) closest; the clusters are
+      trained with `iterations` (10) of k-means from `seed` (0).
+    - 'hnsw': `M` (16) links per node, `ef_construction` (200) and the search breadth `ef` (64).
+    - 'float16', 'int8' and 'pq': the quantized indexes, with the `nlist`, `nprobe`, `iterations` and `seed` of
+      'ivf_flat' (`nlist=0` scans every code) and `rescore`, the number of candidates per neighbour rescored with the
+      full-precision vectors (0 for none; 0 for 'float16', 4 for 'int8' and 10 for 'pq' by default). 'pq' also takes
+      `m` (48), the number of sub-vectors, which must divide the dimensions.
+
+    Parameters:
+    backend (str): One of the keys of ANN_BACKENDS, see above.
+    ids (list): The ids of the vectors.
+    vectors (ndarray): A 2-d array of vectors, row-aligned with `ids`.
+    **params: The parameters of the backend, see above; the defaults are in parentheses.
+
+    Returns:
+    The built index.
+    """
+    if backend not in ANN_BACKENDS:
+        raise ValueError(f"Unknown ANN backend '{backend}', expected one of {list(ANN_BACKENDS)}")
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    index = ANN_BACKENDS[backend](dimensions=vectors.shape[1], **params)
+    index.add(ids, vectors)
+    return index
+
+
+def load_ann_index(path):
+    """
+    Loads an index persisted with `save`, whatever its backend.
+
+    Parameters:
+    path (str): The directory the index was written to.
+
+    Returns:
+    The loaded index.
+    """
+    with open(os.path.join(path, 'index.json')) as f:
+        backend = json.load(f)['backend']
+    return ANN_BACKENDS[backend].load(path)
+
+
+def benchmark_ann_index(index, vectors, queries, n=5):
+    """
+    Measures the recall and latency of an index against exact search.
+
+    Parameters:
+    index: The index to measure, built over `vectors`.
+    vectors (ndarray): The vectors stored in the index, row-aligned with its ids.
+    queries (ndarray): The query vectors.
+    n (int, optional): Number of neighbours per query. Defaults to 5.
+
+    Returns:
+    dict: The recall at n and the p50, p95 and p99 single-query latency in milliseconds.
+    """
+    exact_positions, _ = top_n_cosine(normalize(queries), normalize(vectors), n=n)
+
+    latencies, hits = [], 0
+    for query, exact in zip(queries, exact_positions):
+        start = time.perf_counter()
+        ids, _ = index.search(query[None, :], n=n)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(ids[0]) & set(index.ids[exact]))
+
+    p50, p95, p99 = (float(p) for p in np.percentile(latencies, [50, 95, 99]))
+    return {'recall': hits / exact_positions.size, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+
+def quantization_report(vectors, queries, n=5, m=48, rescore=10, nlist=1024, nprobe=16):
+    """
+    Reports the memory saved and the recall lost by the compressed backends, against exact float32 search.
+
+    Every backend is measured without rescoring and with the exact rescoring of its `rescore * n` best candidates.
+    The indexes are saved and loaded first, as they are served, so their full-precision vectors are memory-mapped
+    and the reported memory is that of the codes, codebooks and inverted lists.
+
+    Parameters:
+    vectors (ndarray): The stored vectors.
+    queries (ndarray): The query vectors.
+    n (int, optional): Number of neighbours per query. Defaults to 5.
+    m (int, optional): The number of sub-vectors of the 'pq' backend. Defaults to 48.
+    rescore (int, optional): The number of rescored candidates per neighbour. Defaults to 10.
+    nlist (int, optional): The number of inverted lists, 0 to scan every code. Defaults to 1024.
+    nprobe (int, optional): The number of lists probed per query. Defaults to 16.
+
+    Returns:
+    list: One dictionary per backend and rescoring setting, with the bytes per vector, the recall at n and the
+          p50, p95 and p99 single-query latency in milliseconds.
+    """
+    ids = np.arange(len(vectors)).astype(str)
+    report = []
+    for backend, params in [('float16', {}), ('int8', {}), ('pq', {'m': m})]:
+        with tempfile.TemporaryDirectory() as path:
+            build_ann_index(backend, ids, vectors, rescore=rescore, nlist=nlist, nprobe=nprobe, **params).save(path)
+            index = load_ann_index(path)
+            for setting in (0, rescore):
+                index.rescore = setting
+                report.append({
+                    'backend': backend,
+                    'rescore': setting,
+                    'bytes_per_vector': index.memory_bytes() / len(vectors),
+                    **benchmark_ann_index(index, vectors, queries, n=n),
+                })
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the recall and latency of the ANN backends offline.')
+    parser.add_argument('vectors', help='.npy file of embeddings, e.g. exported with load_customer_embeddings')
+    parser.add_argument('--queries', type=int, default=1000, help='number of stored vectors reused as queries')
+    parser.add_argument('--n', type=int, default=5, help='number of neighbours per query')
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--ef', type=int, default=64)
+    parser.add_argument('--m', type=int, default=48, help="number of sub-vectors of the 'pq' backend")
+    parser.add_argument('--quantization', action='store_true', help='report the recall of the compressed backends instead')
+    args = parser.parse_args()
+
+    vectors = np.load(args.vectors, mmap_mode='r')
+    queries = np.asarray(vectors[np.random.default_rng(0).choice(len(vectors), size=args.queries, replace=False)])
+    ids = np.arange(len(vectors)).astype(str)
+
+    if args.quantization:
+        print({'backend': 'float32', 'bytes_per_vector': vectors.shape[1] * 4, 'recall': 1.0})
+        for row in quantization_report(vectors, queries, n=args.n, m=args.m, nlist=args.nlist, nprobe=args.nprobe):
+            print(row)
+        raise SystemExit
+
+    backend_params = {
+        'brute_force': {},
+        'ivf_flat': {'nlist': args.nlist, 'nprobe': args.nprobe},
+        'hnsw': {'ef': args.ef},
+    }
+    for backend, params in backend_params.items():
+        try:
+            index = build_ann_index(backend, ids, vectors, **params)
+        except ImportError as e:
+            print(f'{backend}: skipped ({e})')
+            continue
+        print(backend, benchmark_ann_index(index, vectors, queries, n=args.n))
@@ -0,0 +1,222 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from src.search_src.async_service import build_search_term
+from src.search_src.create_superduperdb import CUSTOMER_FIELDS, DuplicateCustomerError, find_customers_by_key
+from src.search_src.instrumentation import prometheus_text, trace
+from src.search_src.resource_cache import cached_items, get_cached
+from src.search_src.similarity_result import add_customers, get_record_linkage, get_search_index, metrics_gauges, warm_up
+
+# Where `python -m src.search_src.api` listens, and how many worker processes it starts
+API_HOST = os.getenv('API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('API_PORT', 8000))
+API_WORKERS = int(os.getenv('API_WORKERS', 1))
+# The largest batch accepted by /check/batch, and how many of its customers are checked at once
+API_BATCH_MAX = int(os.getenv('API_BATCH_MAX', 100))
+API_BATCH_THREADS = int(os.getenv('API_BATCH_THREADS', 8))
+
+# Fields of the matching customers which are internal to the reranker and not returned
+INTERNAL_FIELDS = ['normalized']
+
+# Checks which register the customer run one at a time in a worker, so that two identical sign-ups sent to the same
+# worker cannot both pass the check; across workers the unique customer key index rejects the second one
+_registration_lock = threading.Lock()
+
+
+def customer_frame(customer):
+    """
+    Builds the target DataFrame and the search term of a customer the way the Streamlit form does.
+
+    Parameters:
+    customer (dict): A dictionary with the 'Full Name', 'Email', 'Address' and 'Phone Number' of a customer;
+                     missing or empty fields are treated as unknown.
+
+    Returns:
+    tuple: The target DataFrame indexed by '_id' and the search term.
+    """
+    customer_data = {field: customer.get(field) or None for field in CUSTOMER_FIELDS}
+    target_df = pd.DataFrame([{**customer_data, '_id': str(customer.get('_id') or uuid.uuid4())}]).set_index('_id')
+    return target_df, build_search_term(customer_data)
+
+
+def result_records(result):
+    """
+    Turns the DataFrame returned by `get_record_linkage` into JSON-serializable records.
+
+    Parameters:
+    result (DataFrame): The matching customers indexed by '_id'.
+
+    Returns:
+    list: One dictionary per matching customer, with its '_id' as string and missing values as None.
+    """
+    result = result.reset_index().drop(INTERNAL_FIELDS, axis=1, errors='ignore')
+    result['_id'] = result['_id'].astype(str)
+    return result.astype(object).where(result.notna(), None).to_dict('records')
+
+
+def check_customer(customer, chunks, mongodb_uri, artifact_store, n=5, method='jarowinkler', threshold=0.85, register=False):
+    """
+    Checks whether a customer is already registered with `get_record_linkage`, and optionally registers them.
+
+    Parameters:
+    customer (dict): A dictionary with the 'Full Name', 'Email', 'Address' and 'Phone Number' of a customer.
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    n (int, optional): Number of nearest similarity results to retrieve. Defaults to 5.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+    register (bool, optional): Whether to add the customer to the database when they match no one, as the
+                               registration form does. A customer with the same normalized fields as a stored
+                               customer (see `normalization.customer_key`) is reported as a duplicate of it even if
+                               the check missed it, e.g. because another worker registered it a moment ago.
+                               Defaults to False.
+
+    Returns:
+    dict: Whether the customer is a 'duplicate', the 'matches' sorted by score, the 'registered_id' of the new
+          customer (or None) and the stage durations of the check in 'timings_ms'.
+    """
+    if register:
+        with _registration_lock:
+            return _check_customer(customer, chunks, mongodb_uri, artifact_store, n, method, threshold, register)
+    return _check_customer(customer, chunks, mongodb_uri, artifact_store, n, method, threshold, register)
+
+
+def _check_customer(customer, chunks, mongodb_uri, artifact_store, n, method, threshold, register):
+    target_df, search_term = customer_frame(customer)
+    with trace() as timings:
+        result = get_record_linkage(target_df, chunks, mongodb_uri, artifact_store, search_term, n=n, method=method, threshold=threshold)
+
+    registered_id = None
+    if register and len(result) == 0:
+        try:
+            registered_id = str(add_customers([customer], chunks, mongodb_uri, artifact_store)[0])
+        except DuplicateCustomerError:
+            db, collection, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+            result = pd.DataFrame(find_customers_by_key(db, collection, [customer])).set_index('_id')
+    return {'duplicate': len(result) > 0, 'matches': result_records(result), 'registered_id': registered_id, 'timings_ms': timings}
+
+
+def create_app(chunks=None, mongodb_uri=None, artifact_store=None, n=5, method='jarowinkler', threshold=0.85):
+    """
+    Creates the HTTP/JSON deduplication API.
+
+    The routes are:
+    - POST /check: checks one customer, given as a JSON object with the customer fields. `?register=true` also adds
+      the customer to the database when they match no one.
+    - POST /check/batch: checks a JSON list of at most API_BATCH_MAX customers, API_BATCH_THREADS at a time, so that
+      their search terms are encoded together by the query batcher. Returns one result per customer, in order.
+    - POST /customers: registers a JSON list of customers without checking them and returns their ids, None for
+      the customers whose customer key is already stored.
+    - GET /healthz: liveness probe, answers as soon as the process serves requests.
+    - GET /readyz: readiness probe, answers 503 until the model is loaded and the vector and blocking indexes are
+      built, so that a load balancer only routes checks to warm workers.
+    - GET /metrics: the Prometheus metrics of `instrumentation.py`.
+
+    The database handle, model and indexes are cached for the whole worker process (see `resource_cache.py`) and
+    built by `warm_up` when the worker starts, so a request only pays for its own check. The check routes are plain
+    functions, which FastAPI runs on its thread pool. Every check first applies the customers registered by the
+    other workers since the last check (see `similarity_result.sync_customers`), so a resubmission is caught
+    whichever worker it lands on.
+
+    Parameters:
+    chunks (list or str, optional): Customer records, or the path of a customer snapshot, used to build the index the
+                                    first time it is needed. Defaults to the CHUNK_FILE environment variable.
+    mongodb_uri (str, optional): MongoDB connection URI. Defaults to the MONGODB_URI environment variable.
+    artifact_store (str, optional): Path to the artifact store. Defaults to the ARTIFACT_STORE environment variable.
+    n (int, optional): Number of nearest similarity results to retrieve. Defaults to 5.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+
+    Returns:
+    FastAPI: The application, to be served with uvicorn.
+    """
+    try:
+        from fastapi import Body, FastAPI, HTTPException
+        from fastapi.responses import PlainTextResponse
+    except ImportError as e:
+        raise ImportError('The deduplication API needs the optional fastapi and uvicorn packages: pip install fastapi uvicorn') from e
+
+    chunks = chunks or os.getenv('CHUNK_FILE')
+    mongodb_uri = mongodb_uri or os.getenv('MONGODB_URI')
+    artifact_store = artifact_store or os.getenv('ARTIFACT_STORE')
+    app = FastAPI(title='Customer deduplication')
+    batch_executor = ThreadPoolExecutor(max_workers=API_BATCH_THREADS, thread_name_prefix='api-batch')
+
+    def warm_up_thread():
+        return get_cached('warm_up', (mongodb_uri, artifact_store, None), lambda: warm_up(chunks, mongodb_uri, artifact_store))
+
+    def validate(customer):
+        if not isinstance(customer, dict) or not any(customer.get(field) for field in CUSTOMER_FIELDS):
+            raise HTTPException(status_code=422, detail=f'A customer needs at least one of the fields {CUSTOMER_FIELDS}')
+        return customer
+
+    @app.on_event('startup')
+    def start_warm_up():
+        warm_up_thread()
+
+    @app.on_event('shutdown')
+    def stop_batch_executor():
+        batch_executor.shutdown(wait=True)
+
+    @app.get('/healthz')
+    def healthz():
+        return {'status': 'ok'}
+
+    @app.get('/readyz')
+    def readyz():
+        if warm_up_thread().is_alive():
+            raise HTTPException(status_code=503, detail='warming up')
+        # The warm-up thread ends without building the index when it fails, e.g. when MongoDB is unreachable
+        if not cached_items('search_index', mongodb_uri=mongodb_uri, artifact_store=artifact_store):
+            raise HTTPException(status_code=503, detail='the vector index could not be loaded')
+        return {'status': 'ready'}
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    def metrics():
+        return prometheus_text(metrics_gauges())
+
+    @app.post('/check')
+    def check(customer: dict = Body(...), register: bool = False):
+        return check_customer(validate(customer), chunks, mongodb_uri, artifact_store, n=n, method=method, threshold=threshold, register=register)
+
+    @app.post('/check/batch')
+    def check_batch(customers: list = Body(...)):
+        if len(customers) > API_BATCH_MAX:
+            raise HTTPException(status_code=413, detail=f'A batch holds at most {API_BATCH_MAX} customers')
+        customers = [validate(customer) for customer in customers]
+        return list(batch_executor.map(
+            lambda customer: check_customer(customer, chunks, mongodb_uri, artifact_store, n=n, method=method, threshold=threshold),
+            customers,
+        ))
+
+    @app.post('/customers')
+    def register_customers(customers: list = Body(...)):
+        ids = []
+        for customer in [validate(customer) for customer in customers]:
+            try:
+                ids.append(str(add_customers([customer], chunks, mongodb_uri, artifact_store)[0]))
+            except DuplicateCustomerError:
+                ids.append(None)
+        return {'ids': ids}
+
+    return app
+
+
+if __name__ == '__main__':
+    import argparse
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Serve the deduplication check as an HTTP/JSON API.')
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('--workers', type=int, default=API_WORKERS, help='worker processes, each with its own model and indexes, kept in step through the customer feed')
+    args = parser.parse_args()
+
+    import uvicorn
+
+    # Every worker process builds the app from the environment and warms up its own model and indexes
+    uvicorn.run('src.search_src.api:create_app', factory=True, host=args.host, port=args.port, workers=args.workers)
@@ -0,0 +1,74 @@
+import json
+import os
+import urllib.request
+
+# Base URL of the deduplication API (see `api.py`), e.g. http://localhost:8000; when unset, app.py checks in-process
+DEDUP_API_URL = os.getenv('DEDUP_API_URL')
+DEDUP_API_TIMEOUT = float(os.getenv('DEDUP_API_TIMEOUT', 30))
+
+
+def post_json(api_url, path, payload, timeout=DEDUP_API_TIMEOUT):
+    """
+    Posts a JSON payload to the deduplication API and decodes its JSON response.
+
+    Parameters:
+    api_url (str): Base URL of the API.
+    path (str): The route, including its query string.
+    payload: The JSON-serializable request body.
+    timeout (float, optional): Seconds to wait for the response. Defaults to the DEDUP_API_TIMEOUT environment variable or 30.
+
+    Returns:
+    The decoded response body. HTTP errors are raised as `urllib.error.HTTPError`.
+    """
+    request = urllib.request.Request(
+        api_url.rstrip('/') + path, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def check_customer(api_url, customer, register=False, timeout=DEDUP_API_TIMEOUT):
+    """
+    Checks one customer with the API, see `api.check_customer`.
+
+    Parameters:
+    api_url (str): Base URL of the API.
+    customer (dict): A dictionary with the 'Full Name', 'Email', 'Address' and 'Phone Number' of a customer.
+    register (bool, optional): Whether the API registers the customer when they match no one. Defaults to False.
+    timeout (float, optional): Seconds to wait for the response. Defaults to DEDUP_API_TIMEOUT.
+
+    Returns:
+    dict: The 'duplicate' flag, the 'matches', the 'registered_id' and the 'timings_ms' of the check.
+    """
+    return post_json(api_url, '/check?register=true' if register else '/check', customer, timeout)
+
+
+def check_customers(api_url, customers, timeout=DEDUP_API_TIMEOUT):
+    """
+    Checks a batch of customers with one request to the API.
+
+    Parameters:
+    api_url (str): Base URL of the API.
+    customers (list): The customer dictionaries, at most API_BATCH_MAX of the server.
+    timeout (float, optional): Seconds to wait for the response. Defaults to DEDUP_API_TIMEOUT.
+
+    Returns:
+    list: The result of every customer, in the same order.
+    """
+    return post_json(api_url, '/check/batch', customers, timeout)
+
+
+def matches_frame(response):
+    """
+    Turns the matches of a check response back into the DataFrame `get_record_linkage` returns.
+
+    Parameters:
+    response (dict): A response of `check_customer`.
+
+    Returns:
+    DataFrame: The matching customers indexed by '_id', sorted by the 'score' field in descending order.
+    """
+    import pandas as pd
+
+    matches = pd.DataFrame(response['matches'])
+    return matches.set_index('_id') if len(matches) else matches
@@ -0,0 +1,174 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from src.search_src.create_superduperdb import CUSTOMER_FIELDS, build_details
+from src.search_src.query_cache import normalize_search_term, query_embeddings
+from src.search_src.similarity_result import (
+    RERANK_MODE,
+    RETRIEVAL_MODE,
+    add_customers,
+    get_query_batcher,
+    get_record_linkage,
+    get_search_index,
+)
+
+
+def build_search_term(customer):
+    """
+    Builds the search term of a customer the way the Streamlit form does.
+
+    Parameters:
+    customer (dict): A dictionary with the 'Full Name', 'Email', 'Address' and 'Phone Number' of a customer.
+
+    Returns:
+    str: The search term, in the format of the stored 'details' whose embeddings it is compared with.
+    """
+    return build_details({field: customer.get(field) or None for field in CUSTOMER_FIELDS})
+
+
+class AsyncDedupService:
+    """
+    Asyncio front end of the deduplication check, for serving many concurrent sign-ups from one process.
+
+    Every check runs `get_record_linkage` on a shared thread pool, with the blocking, normalization, rerank and
+    retrieval modes of the service, so it returns what the Streamlit form and the API return for the same customer.
+    Search terms are encoded by the query batcher of the model (see `query_batcher.py`): they wait up to
+    `max_wait_ms` for up to `max_batch_size` other terms and are then encoded with a single `model.predict` call,
+    so the throughput grows with the number of concurrent checks. The pool overlaps the encoding, which releases
+    the GIL in torch, and the MongoDB round trips of concurrent checks. The reranker is Python code (pandas,
+    recordlinkage and jellyfish) which holds the GIL, so the reranks of concurrent checks still run one at a time;
+    run several processes, e.g. API workers, to rerank in parallel.
+
+    A `mongomock://` URI can be used to run the service without a MongoDB server.
+    """
+
+    def __init__(self, chunks, mongodb_uri, artifact_store, n=5, method='jarowinkler', threshold=0.85,
+                 backend='superduperdb', blocking=True, normalized=False, rerank=RERANK_MODE, retrieval=RETRIEVAL_MODE,
+                 max_workers=None, max_batch_size=64, max_wait_ms=5):
+        self.chunks = chunks
+        self.mongodb_uri = mongodb_uri
+        self.artifact_store = artifact_store
+        self.n = n
+        self.method = method
+        self.threshold = threshold
+        self.backend = backend
+        self.blocking = blocking
+        self.normalized = normalized
+        self.rerank = rerank
+        self.retrieval = retrieval
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dedup')
+
+    async def _run(self, func, *args, **kwargs):
+        """
+        Runs a blocking function on the thread pool of the service.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def start(self):
+        """
+        Builds (or attaches to) the vector index and loads the model, so that the first check does not pay for it.
+
+        It also starts the query batcher of the model with the batch size and waiting time of the service.
+        """
+        _, _, model = await self._run(get_search_index, self.chunks, self.mongodb_uri, self.artifact_store)
+        get_query_batcher(model, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms)
+
+    async def encode(self, search_term):
+        """
+        Encodes a search term together with the other search terms submitted within `max_wait_ms`.
+
+        Parameters:
+        search_term (str): The search term, see `build_search_term`.
+
+        Returns:
+        list: The embedding of the search term.
+        """
+        _, _, model = await self._run(get_search_index, self.chunks, self.mongodb_uri, self.artifact_store)
+        cache_key = (model.identifier, normalize_search_term(search_term))
+        vector = query_embeddings.get(cache_key)
+        if vector is None:
+            batcher = get_query_batcher(model, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms)
+            vector = await asyncio.wrap_future(batcher.submit(search_term))
+            query_embeddings.set(cache_key, vector)
+        return vector
+
+    async def check(self, customer):
+        """
+        Checks whether a customer is already registered with `get_record_linkage`, on the thread pool of the service.
+
+        Parameters:
+        customer (dict): A dictionary with the 'Full Name', 'Email', 'Address' and 'Phone Number' of a customer.
+
+        Returns:
+        DataFrame: The matching customers indexed by '_id', sorted by the 'score' field in descending order.
+        """
+        target_df = pd.DataFrame([{**{field: customer.get(field) for field in CUSTOMER_FIELDS}, '_id': 'target'}]).set_index('_id')
+        return await self._run(
+            get_record_linkage, target_df, self.chunks, self.mongodb_uri, self.artifact_store, build_search_term(customer),
+            n=self.n, method=self.method, threshold=self.threshold, backend=self.backend, blocking=self.blocking,
+            normalized=self.normalized, rerank=self.rerank, retrieval=self.retrieval,
+        )
+
+    async def check_many(self, customers):
+        """
+        Checks several customers concurrently.
+
+        Parameters:
+        customers (list): The customer dictionaries.
+
+        Returns:
+        list: The DataFrame of matching customers of each customer, in the same order.
+        """
+        return await asyncio.gather(*(self.check(customer) for customer in customers))
+
+    async def add_customers(self, customers):
+        """
+        Registers new customers, see `similarity_result.add_customers`.
+
+        Parameters:
+        customers (list): The customer dictionaries.
+
+        Returns:
+        list: The ids of the inserted customers.
+        """
+        return await self._run(add_customers, customers, self.chunks, self.mongodb_uri, self.artifact_store)
+
+    def close(self):
+        """
+        Shuts the thread pool down once the running checks are done.
+        """
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    import json
+    import os
+    import sys
+    import time
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    # Usage: python -m src.search_src.async_service customers.jsonl [concurrency]
+    queries_path = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    with open(queries_path) as f:
+        queries = [json.loads(line) for line in f if line.strip()][:concurrency]
+
+    async def run():
+        service = AsyncDedupService(
+            os.getenv('CHUNK_FILE'),
+            os.getenv('MONGODB_URI', 'mongomock://customer_deduplication'),
+            os.getenv('ARTIFACT_STORE', 'filesystem://./data/'),
+        )
+        await service.start()
+        start = time.perf_counter()
+        results = await service.check_many(queries)
+        seconds = time.perf_counter() - start
+        service.close()
+        print(f'{len(queries)} concurrent checks in {seconds:.3f}s, {sum(1 for r in results if len(r))} with matches')
+
+    asyncio.run(run())
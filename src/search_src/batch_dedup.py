@@ -0,0 +1,104 @@
+import argparse
+import os
+import pandas as pd
+from dotenv import load_dotenv
+from src.data_generation.generate_database import details_column
+from src.search_src.create_superduperdb import CUSTOMER_FIELDS, cached_encoder, connect_database, load_customer_embeddings
+from src.search_src.reranker import SIMILARITY_COLUMNS, compare_pairs
+from src.search_src.vector_search import normalize, top_n_cosine
+
+
+def get_batch_record_linkage(candidates_df, customers_df, customer_vectors, encoder, n=5, method='jarowinkler', threshold=0.85, encode_batch_size=256):
+    """
+    Finds the existing customers that closely match each candidate of a batch of sign-ups.
+
+    All candidate 'details' are encoded in large batches, the n nearest customers of every candidate are found with
+    one blocked matrix product, and the comparison features of all candidate pairs are computed in one pass.
+
+    Parameters:
+    candidates_df (DataFrame): The candidate sign-ups, with a unique index and the customer fields as columns.
+    customers_df (DataFrame): The existing customers indexed by '_id', row-aligned with `customer_vectors`.
+    customer_vectors (ndarray): The unit-length embeddings of the existing customers.
+    encoder (SentenceTransformer): The model used to embed the candidates.
+    n (int): Number of nearest customers to compare per candidate. Default is 5.
+    method (str): The string comparison method to use. Default is 'jarowinkler'.
+    threshold (float): The threshold for string comparison. Default is 0.85.
+    encode_batch_size (int): Number of candidates encoded at once. Default is 256.
+
+    Returns:
+    DataFrame: One row per matching (candidate, customer) pair with the candidate index, the customer '_id',
+               the similarity 'score', the comparison features and their 'similarity_sum',
+               sorted by candidate and by score in descending order.
+    """
+    details = candidates_df['details'].fillna('') if 'details' in candidates_df else details_column(candidates_df, CUSTOMER_FIELDS)
+    query_vectors = normalize(encoder.encode(details.tolist(), batch_size=encode_batch_size))
+    positions, scores = top_n_cosine(query_vectors, customer_vectors, n=n)
+
+    # Every candidate is paired with its own n nearest customers only
+    candidate_records = candidates_df[CUSTOMER_FIELDS].to_dict('records')
+    left = [r for r in candidate_records for _ in range(positions.shape[1])]
+    right = customers_df[CUSTOMER_FIELDS].iloc[positions.ravel()].to_dict('records')
+
+    features = pd.DataFrame(compare_pairs(left, right, method=method, threshold=threshold), columns=SIMILARITY_COLUMNS)
+    features.insert(0, 'candidate', candidates_df.index.repeat(positions.shape[1]))
+    features.insert(1, '_id', customers_df.index[positions.ravel()])
+    features['similarity_sum'] = features[SIMILARITY_COLUMNS].sum(axis=1)
+    features['score'] = scores.ravel()
+
+    matches = features[features['similarity_sum'] >= 1.0]
+    return matches.sort_values(by=['candidate', 'score'], ascending=[True, False])
+
+
+def run_batch_deduplication(input_path, output_path, mongodb_uri, artifact_store, n=5, batch_size=10000, method='jarowinkler', threshold=0.85):
+    """
+    Checks a whole CSV file of candidate sign-ups against the existing customers and streams the matches to a CSV file.
+
+    The stored customer embeddings are loaded once; the candidates are then read, matched and written
+    `batch_size` rows at a time so the input file never has to fit in memory.
+
+    Parameters:
+    input_path (str): CSV file with the 'Full Name', 'Email', 'Address' and 'Phone Number' columns (for example the output of `generate_df.py`).
+    output_path (str): CSV file the matching pairs are written to.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    n (int): Number of nearest customers to compare per candidate. Default is 5.
+    batch_size (int): Number of candidates processed at once. Default is 10000.
+    method (str): The string comparison method to use. Default is 'jarowinkler'.
+    threshold (float): The threshold for string comparison. Default is 0.85.
+
+    Returns:
+    int: The number of matching pairs written.
+    """
+    db, _ = connect_database(mongodb_uri, artifact_store)
+    records, vectors = load_customer_embeddings(db)
+    customers_df = pd.DataFrame(records, columns=['_id'] + CUSTOMER_FIELDS).set_index('_id')
+    customer_vectors = normalize(vectors)
+    encoder = cached_encoder(artifact_store)
+
+    written = 0
+    reader = pd.read_csv(input_path, chunksize=batch_size, dtype=str)
+    for batch_number, candidates_df in enumerate(reader):
+        matches = get_batch_record_linkage(candidates_df, customers_df, customer_vectors, encoder, n=n, method=method, threshold=threshold)
+        matches.to_csv(output_path, mode='w' if batch_number == 0 else 'a', header=batch_number == 0, index=False)
+        written += len(matches)
+
+    return written
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Check a CSV file of candidate sign-ups against the existing customers.')
+    parser.add_argument('input_path', help='CSV file of candidate sign-ups')
+    parser.add_argument('output_path', help='CSV file to write the matching pairs to')
+    parser.add_argument('--n', type=int, default=5, help='number of nearest customers compared per candidate')
+    parser.add_argument('--batch-size', type=int, default=10000, help='number of candidates processed at once')
+    parser.add_argument('--method', default='jarowinkler', help='string comparison method')
+    parser.add_argument('--threshold', type=float, default=0.85, help='threshold for string comparison')
+    args = parser.parse_args()
+
+    written = run_batch_deduplication(
+        args.input_path, args.output_path, os.getenv("MONGODB_URI"), os.getenv("ARTIFACT_STORE"),
+        n=args.n, batch_size=args.batch_size, method=args.method, threshold=args.threshold,
+    )
+    print(f'{written} matching pairs written to {args.output_path}')
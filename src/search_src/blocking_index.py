@@ -0,0 +1,94 @@
+from collections import defaultdict
+import jellyfish
+from src.search_src.instrumentation import increment
+from src.search_src.normalization import is_missing, name_tokens, normalize_phone, split_address
+
+
+def blocking_keys(record):
+    """
+    Computes the blocking keys of a customer record.
+
+    The keys are the normalized phone number, the lower-cased email with and without its domain, and compound
+    phonetic keys of the name: first and last name, last name and postcode, first name and postcode. A phonetic
+    key of the last name alone is shared by thousands of customers in a large customer base, so it is always
+    combined with a second field, and a typo in any one field leaves at least one name key intact.
+
+    Parameters:
+    record (dict): A dictionary with the 'Full Name', 'Email', 'Address' and 'Phone Number' of a customer.
+
+    Returns:
+    list: The blocking keys of the record as tuples, e.g. ('phone', '01701234567').
+    """
+    keys = []
+
+    phone = normalize_phone(record.get('Phone Number'))
+    if phone:
+        keys.append(('phone', phone))
+
+    email = record.get('Email')
+    if not is_missing(email):
+        local_part, _, domain = str(email).strip().lower().partition('@')
+        if local_part and domain:
+            keys.append(('email', local_part, domain))
+        if local_part:
+            keys.append(('email_local', local_part))
+
+    tokens = name_tokens(record.get('Full Name'))
+    if tokens:
+        address = record.get('Address')
+        postcode = None if is_missing(address) else split_address(address)[1]
+        last_name = jellyfish.metaphone(tokens[-1])
+        first_name = jellyfish.metaphone(tokens[0]) if len(tokens) > 1 else None
+        if first_name:
+            keys.append(('name', first_name, last_name))
+        if postcode:
+            keys.append(('last_name_postcode', last_name, postcode))
+            if first_name:
+                keys.append(('first_name_postcode', first_name, postcode))
+
+    return keys
+
+
+class BlockingIndex:
+    """
+    In-memory index from blocking keys to customer ids, answering exact and near-exact matches in O(1).
+
+    Keys shared by more than `max_block_size` customers (e.g. a very common first and last name) are not used for
+    lookups, since they do not narrow the candidates down; every skipped key is counted in the
+    'blocking_oversized_keys' metric. `src/benchmark/blocking_recall.py` reports the recall lost to the cap.
+    """
+
+    def __init__(self, max_block_size=50):
+        self.max_block_size = max_block_size
+        self.blocks = defaultdict(list)
+
+    def add(self, ids, records):
+        """
+        Adds customers to the index.
+
+        Parameters:
+        ids (list): The customer ids.
+        records (list): The customer records, aligned with `ids`.
+        """
+        for customer_id, record in zip(ids, records):
+            for key in blocking_keys(record):
+                self.blocks[key].append(str(customer_id))
+
+    def lookup(self, record):
+        """
+        Finds the customers sharing a blocking key with a record.
+
+        Parameters:
+        record (dict): A dictionary with the customer fields.
+
+        Returns:
+        list: The ids of the customers sharing at least one blocking key with the record, without repetitions.
+        """
+        ids = {}
+        for key in blocking_keys(record):
+            block = self.blocks.get(key, ())
+            if len(block) <= self.max_block_size:
+                ids.update(dict.fromkeys(block))
+            else:
+                increment('blocking_oversized_keys')
+        return list(ids)
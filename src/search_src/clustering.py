@@ -0,0 +1,360 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+from src.search_src.ann_index import train_centroids
+from src.search_src.create_superduperdb import (
+    COLLECTION_NAME,
+    CUSTOMER_FIELDS,
+    MODEL_IDENTIFIER,
+    artifact_directory,
+    count_customer_embeddings,
+    decode_embedding,
+)
+from src.search_src.normalization import NORMALIZED_FIELD
+from src.search_src.reranker import compare_normalized_pairs, compare_pairs
+from src.search_src.vector_search import normalize, top_n_cosine
+
+CLUSTER_FIELD = 'cluster_id'
+
+
+class UnionFind:
+    """
+    Disjoint sets over the row positions 0..size-1, kept in one integer array so that millions of customers fit.
+    """
+
+    def __init__(self, size):
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            # Path halving
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            # The smaller position becomes the root, so the clusters do not depend on the order of the unions
+            self.parent[max(x, y)] = min(x, y)
+
+    def roots(self):
+        """
+        Returns the root of every position, with the whole array compressed at once.
+
+        Returns:
+        ndarray: The root position of every position; it is the smallest position of its set.
+        """
+        roots = self.parent.copy()
+        while True:
+            compressed = roots[roots]
+            if np.array_equal(compressed, roots):
+                return roots
+            roots = compressed
+
+
+def export_customers(db, path, normalized=False, model_identifier=MODEL_IDENTIFIER, key='details'):
+    """
+    Streams the embedded customers out of MongoDB into files the clustering workers can read without the database.
+
+    It writes 'vectors.npy' (unit-length float32 embeddings), 'ids.npy' (the customer ids), 'records.jsonl'
+    (the customer fields, one line per customer) and 'offsets.npy' (the byte offset of every line), all row-aligned.
+    Only one customer is held in memory at a time.
+
+    Parameters:
+    db (Datalayer): The database instance holding the vector index.
+    path (str): The directory to write the files to.
+    normalized (bool, optional): Whether to export the normalized comparison fields as well. Defaults to False.
+    model_identifier (str, optional): Identifier of the embedding model. Defaults to 'all-MiniLM-L6-v2'.
+    key (str, optional): The embedded field. Defaults to 'details'.
+
+    Returns:
+    int: The number of exported customers.
+    """
+    os.makedirs(path, exist_ok=True)
+    output_field = f'_outputs.{key}.{model_identifier}'
+    fields = CUSTOMER_FIELDS + ([NORMALIZED_FIELD] if normalized else [])
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    rows = count_customer_embeddings(db, model_identifier, key)
+
+    vectors, ids, offsets = None, np.zeros(rows, dtype='S24'), np.zeros(rows + 1, dtype=np.int64)
+    count = 0
+    with open(os.path.join(path, 'records.jsonl'), 'wb') as f:
+        cursor = raw_collection.find({output_field: {'$exists': True}}, {field: 1 for field in fields + [output_field]})
+        for r in cursor:
+            if count == rows:
+                break
+            vector = np.asarray(decode_embedding(r.pop('_outputs')[key][model_identifier]), dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(rows, len(vector)))
+            vectors[count] = normalize(vector[None, :])[0]
+            ids[count] = str(r.pop('_id')).encode()
+            offsets[count] = f.tell()
+            f.write(json.dumps(r, default=str).encode() + b'\n')
+            count += 1
+        offsets[count] = f.tell()
+
+    if vectors is not None:
+        vectors.flush()
+    np.save(os.path.join(path, 'ids.npy'), ids[:count])
+    np.save(os.path.join(path, 'offsets.npy'), offsets[:count + 1])
+    return count
+
+
+def assign_lists(vectors, centroids, block_size=65536):
+    """
+    Assigns every vector to its closest centroid, a block of vectors at a time.
+
+    Parameters:
+    vectors (ndarray): The unit-length vectors, possibly memory-mapped.
+    centroids (ndarray): The unit-length centroids.
+    block_size (int, optional): The number of vectors assigned at once. Defaults to 65536.
+
+    Returns:
+    ndarray: The centroid of every vector.
+    """
+    assignments = np.zeros(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        assignments[start:start + len(block)] = top_n_cosine(block, centroids, n=1)[0][:, 0]
+    return assignments
+
+
+# State of a clustering worker, loaded once per process by `_init_worker`
+_worker = {}
+
+
+def _init_worker(path, lists, probes, k, min_score, method, threshold, normalized):
+    _worker.update(
+        vectors=np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'),
+        offsets=np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r'),
+        records=open(os.path.join(path, 'records.jsonl'), 'rb'),
+        lists=lists, probes=probes, k=k, min_score=min_score, method=method, threshold=threshold, normalized=normalized,
+    )
+
+
+def _read_records(positions):
+    records, offsets = _worker['records'], _worker['offsets']
+    result = []
+    for position in positions:
+        records.seek(offsets[position])
+        result.append(json.loads(records.readline()))
+    return result
+
+
+def join_list(list_number):
+    """
+    Finds and reranks the nearest neighbours of the customers of one list, in a worker process.
+
+    The customers of the list are compared with the customers of the `nprobe` lists closest to it (the list
+    itself included) with blocked matrix products. Every pair of a customer and one of its k nearest neighbours
+    scoring at least `min_score` is compared with the `get_record_linkage` rules.
+
+    Parameters:
+    list_number (int): The list of the customers to join.
+
+    Returns:
+    tuple: The number of compared pairs, and an (m, 2) array of the row positions of the m matching pairs.
+    """
+    lists, vectors = _worker['lists'], _worker['vectors']
+    queries = lists[list_number]
+    if len(queries) == 0:
+        return 0, np.zeros((0, 2), dtype=np.int64)
+    candidates = np.sort(np.concatenate([lists[c] for c in _worker['probes'][list_number]]))
+
+    # One more neighbour than asked for, since every customer is its own nearest neighbour
+    positions, scores = top_n_cosine(
+        np.asarray(vectors[queries], dtype=np.float32), vectors[candidates], n=_worker['k'] + 1,
+    )
+    left = np.repeat(queries, positions.shape[1])
+    right = candidates[positions].ravel()
+
+    # Every pair once, with its smaller position first
+    keep = (left != right) & (scores.ravel() >= _worker['min_score'])
+    if not keep.any():
+        return 0, np.zeros((0, 2), dtype=np.int64)
+    pairs = np.unique(np.sort(np.stack([left[keep], right[keep]], axis=1), axis=1), axis=0)
+
+    rows = np.unique(pairs)
+    records = dict(zip(rows.tolist(), _read_records(rows)))
+    compare = compare_normalized_pairs if _worker['normalized'] else compare_pairs
+    features = compare(
+        [records[i] for i in pairs[:, 0].tolist()], [records[j] for j in pairs[:, 1].tolist()],
+        method=_worker['method'], threshold=_worker['threshold'],
+    )
+    return len(pairs), pairs[features.sum(axis=1) >= 1.0]
+
+
+@contextlib.contextmanager
+def _single_threaded_blas():
+    # Each worker process runs one list at a time; BLAS threads on top of one process per core would oversubscribe
+    names = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+    saved = {name: os.environ.get(name) for name in names}
+    os.environ.update({name: '1' for name in names})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def cluster_exported(path, k=5, nlist=None, nprobe=8, min_score=0.0, method='jarowinkler', threshold=0.85,
+                     normalized=False, workers=None, seed=0):
+    """
+    Clusters the customers exported with `export_customers` by an approximate kNN self-join.
+
+    The embeddings are partitioned into `nlist` lists with k-means (see `ann_index.train_centroids`). Every list
+    is joined with its `nprobe` closest lists in a pool of worker processes, one per core, which read the
+    memory-mapped embeddings and records, so the memory stays bounded by the lists being joined. The matching
+    pairs are merged into clusters with union-find.
+
+    Parameters:
+    path (str): The directory written by `export_customers`.
+    k (int, optional): The number of nearest neighbours compared per customer. Defaults to 5.
+    nlist (int, optional): The number of lists. Defaults to 4 * sqrt(customers); 1 makes the self-join exact.
+    nprobe (int, optional): The number of lists each list is joined with. Defaults to 8.
+    min_score (float, optional): The minimum cosine similarity of a compared pair. Defaults to 0.0.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+    normalized (bool, optional): Whether to compare the normalized fields, see `reranker.compare_normalized_pairs`.
+                                 Defaults to False.
+    workers (int, optional): The number of worker processes. Defaults to the number of cores.
+    seed (int, optional): The seed of the k-means sampling. Defaults to 0.
+
+    Returns:
+    tuple: The root position of every customer (the smallest position of its cluster), and a dict with the
+           number of compared and matching pairs.
+    """
+    vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+    nlist = nlist or max(1, int(4 * np.sqrt(len(vectors))))
+    centroids = train_centroids(vectors, nlist, seed=seed)
+    assignments = assign_lists(vectors, centroids)
+    order = np.argsort(assignments, kind='stable')
+    bounds = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+    lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(centroids))]
+    probes = top_n_cosine(centroids, centroids, n=min(nprobe, len(centroids)))[0]
+
+    union_find = UnionFind(len(vectors))
+    stats = {'compared_pairs': 0, 'matching_pairs': 0}
+    context = multiprocessing.get_context('spawn')
+    initargs = (path, lists, probes, k, min_score, method, threshold, normalized)
+    with _single_threaded_blas(), context.Pool(workers or os.cpu_count(), _init_worker, initargs) as pool:
+        # Largest lists first, so that the last tasks are short
+        tasks = sorted(range(len(lists)), key=lambda c: len(lists[c]), reverse=True)
+        for compared, matches in pool.imap_unordered(join_list, tasks):
+            stats['compared_pairs'] += compared
+            stats['matching_pairs'] += len(matches)
+            for i, j in matches.tolist():
+                union_find.union(i, j)
+
+    return union_find.roots(), stats
+
+
+def write_clusters(db, ids, roots, batch_size=1000):
+    """
+    Writes the cluster id of every customer which has duplicates, and removes the cluster ids of an earlier run.
+
+    The cluster id is the id of the first customer of the cluster.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    ids (ndarray): The customer ids, row-aligned with `roots`.
+    roots (ndarray): The root position of every customer, see `UnionFind.roots`.
+    batch_size (int, optional): The number of clusters written per bulk write. Defaults to 1000.
+
+    Returns:
+    tuple: The number of clusters and the number of customers in them.
+    """
+    from bson import ObjectId
+    from pymongo import UpdateMany
+
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    raw_collection.update_many({CLUSTER_FIELD: {'$exists': True}}, {'$unset': {CLUSTER_FIELD: ''}})
+
+    sizes = np.bincount(roots, minlength=len(roots))
+    clustered = np.flatnonzero(sizes[roots] > 1)
+    clustered = clustered[np.argsort(roots[clustered], kind='stable')]
+    bounds = np.flatnonzero(np.diff(roots[clustered])) + 1
+
+    operations = []
+    for members in np.split(clustered, bounds) if len(clustered) else []:
+        cluster_id = ids[roots[members[0]]].decode()
+        member_ids = [ObjectId(i.decode()) for i in ids[members]]
+        operations.append(UpdateMany({'_id': {'$in': member_ids}}, {'$set': {CLUSTER_FIELD: cluster_id}}))
+        if len(operations) == batch_size:
+            raw_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        raw_collection.bulk_write(operations, ordered=False)
+    return len(bounds) + 1 if len(clustered) else 0, len(clustered)
+
+
+def run_clustering(mongodb_uri, artifact_store, k=5, nlist=None, nprobe=8, min_score=0.0, method='jarowinkler',
+                   threshold=0.85, normalized=False, workers=None, dry_run=False):
+    """
+    Finds the clusters of duplicate customers already in the collection and writes their cluster id back.
+
+    Parameters:
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store; the exported customers are kept in '<artifact store>/clustering'.
+    k, nlist, nprobe, min_score, method, threshold, normalized, workers: See `cluster_exported`.
+    dry_run (bool, optional): Whether to only report the clusters without writing them. Defaults to False.
+
+    Returns:
+    dict: The number of customers, compared and matching pairs, clusters and clustered customers, and the duration of each step.
+    """
+    from src.search_src.create_superduperdb import connect_database
+
+    db, _ = connect_database(mongodb_uri, artifact_store)
+    path = artifact_directory(artifact_store, 'clustering')
+    report = {}
+
+    start = time.perf_counter()
+    report['customers'] = export_customers(db, path, normalized=normalized)
+    report['export_seconds'] = time.perf_counter() - start
+    if report['customers'] == 0:
+        return report
+
+    start = time.perf_counter()
+    roots, stats = cluster_exported(
+        path, k=k, nlist=nlist, nprobe=nprobe, min_score=min_score, method=method, threshold=threshold,
+        normalized=normalized, workers=workers,
+    )
+    report.update(stats, join_seconds=time.perf_counter() - start)
+
+    sizes = np.bincount(roots, minlength=len(roots))
+    report['clusters'] = int((sizes > 1).sum())
+    report['clustered_customers'] = int(sizes[sizes > 1].sum())
+    if not dry_run:
+        start = time.perf_counter()
+        write_clusters(db, np.load(os.path.join(path, 'ids.npy')), roots)
+        report['write_seconds'] = time.perf_counter() - start
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cluster the duplicate customers of the collection and write their cluster id.')
+    parser.add_argument('--k', type=int, default=5, help='nearest neighbours compared per customer')
+    parser.add_argument('--nlist', type=int, default=None, help='number of k-means lists, 1 for an exact self-join')
+    parser.add_argument('--nprobe', type=int, default=8, help='lists each list is joined with')
+    parser.add_argument('--min-score', type=float, default=0.0, help='minimum cosine similarity of a compared pair')
+    parser.add_argument('--method', default='jarowinkler', help='string comparison method')
+    parser.add_argument('--threshold', type=float, default=0.85, help='threshold for string comparison')
+    parser.add_argument('--normalized', action='store_true', help='compare the normalized fields')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the number of cores')
+    parser.add_argument('--dry-run', action='store_true', help='report the clusters without writing them')
+    args = parser.parse_args()
+
+    print(json.dumps(run_clustering(
+        os.getenv("MONGODB_URI"), os.getenv("ARTIFACT_STORE"), k=args.k, nlist=args.nlist, nprobe=args.nprobe,
+        min_score=args.min_score, method=args.method, threshold=args.threshold, normalized=args.normalized,
+        workers=args.workers, dry_run=args.dry_run,
+    )))
@@ -1,11 +1,24 @@
 # import json
-import sentence_transformers
-from superduperdb import Document
-from superduperdb import superduper
-from superduperdb import Model, vector
-from superduperdb import Listener, VectorIndex
-from superduperdb.backends.mongodb import Collection
+import logging
+import os
+import numpy as np
+from bson import ObjectId
+from src.search_src.embedding_cache import EMBEDDING_CACHE_MAX_MB, CachedEncoder, EmbeddingCache
+from src.search_src.resource_cache import get_cached
+from src.search_src.normalization import CUSTOMER_KEY_FIELD, NORMALIZED_FIELD, customer_key, normalize_customer
+from src.data_generation.snapshot import (
+    create_embeddings,
+    embeddings_path,
+    iter_snapshot,
+    load_embeddings,
+    save_fingerprint,
+    snapshot_fingerprint,
+)
 
+logger = logging.getLogger('customer_deduplication')
+
+# superduperdb and sentence_transformers take seconds to import, so they are imported by the functions
+# which use them: code which only reads stored embeddings or customers does not pay for them.
 
 # MONGODB_URI = "mongomock://test"
 # artifact_store = 'filesystem://./data/'
@@ -13,84 +26,668 @@ from superduperdb.backends.mongodb import Collection
 
 # collection_name = 'customer_details'
 
+MODEL_IDENTIFIER = 'all-MiniLM-L6-v2'
+COLLECTION_NAME = 'customer_details'
+CUSTOMER_FIELDS = ['Full Name', 'Email', 'Address', 'Phone Number']
+
+# Storage of the embeddings in MongoDB: unset for lists of floats, 'float32' or 'float16' for packed binary arrays
+EMBEDDING_DTYPE = os.getenv('EMBEDDING_DTYPE') or None
+EMBEDDING_DTYPES = ('float32', 'float16')
+
+# Inference of the encoder: 'torch' for the sentence transformer, 'onnx' for its int8-quantized ONNX export,
+# with ENCODER_THREADS intra-op threads (unset for the library default)
+ENCODER_BACKEND = os.getenv('ENCODER_BACKEND', 'torch')
+ENCODER_THREADS = int(os.getenv('ENCODER_THREADS', 0)) or None
+ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', './data/onnx')
+
 # with open('customer_details.json') as f:
 #     chunks = json.load(f)
 
 
-def model_definition():
+def load_encoder(model_identifier=MODEL_IDENTIFIER, backend=ENCODER_BACKEND, threads=ENCODER_THREADS):
+    """
+    Loads the sentence transformer used to embed the customer details.
+
+    With the 'onnx' backend the model is exported to ONNX and quantized to int8 on first use (in ONNX_MODEL_DIR),
+    then served with onnxruntime. Both backends have the `encode` method the superduperdb `Model` calls.
+
+    Parameters:
+    model_identifier (str, optional): Identifier of the sentence transformer. Defaults to 'all-MiniLM-L6-v2'.
+    backend (str, optional): 'torch' or 'onnx'. Defaults to the ENCODER_BACKEND environment variable or 'torch'.
+    threads (int, optional): The number of CPU threads of the inference. Defaults to the ENCODER_THREADS
+                             environment variable, or the library default if it is unset.
+
+    Returns:
+    SentenceTransformer or OnnxEncoder: The sentence transformer model.
+    """
+    if backend == 'onnx':
+        from src.search_src.onnx_encoder import load_onnx_encoder
+
+        return load_onnx_encoder(model_identifier, os.path.join(ONNX_MODEL_DIR, model_identifier), threads=threads)
+    if backend != 'torch':
+        raise ValueError(f"Unknown encoder backend '{backend}', expected 'torch' or 'onnx'")
+
+    import sentence_transformers
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+    return sentence_transformers.SentenceTransformer(model_identifier)
+
+
+def encoder_backend(encoder, backend=None):
+    """
+    Tells which backend an encoder runs on, so that embeddings of different backends are never mixed in the cache.
+
+    Parameters:
+    encoder: A SentenceTransformer, an OnnxEncoder or another object with an `encode` method.
+    backend (str, optional): The backend of an encoder of another type, e.g. a wrapper. Defaults to None.
+
+    Returns:
+    str: 'onnx' for an OnnxEncoder, 'torch' for a SentenceTransformer, otherwise `backend`.
+
+    Raises:
+    ValueError: If the encoder is of another type and no `backend` is given.
+    """
+    from src.search_src.onnx_encoder import OnnxEncoder
+
+    if isinstance(encoder, OnnxEncoder):
+        return 'onnx'
+    if type(encoder).__module__.startswith('sentence_transformers'):
+        return 'torch'
+    if backend is None:
+        raise ValueError(f'Cannot tell the backend of a {type(encoder).__name__} encoder, pass backend= to label its cached embeddings')
+    return backend
+
+
+def cached_encoder(artifact_filepath, encoder=None, model_identifier=MODEL_IDENTIFIER, backend=None):
+    """
+    Returns the encoder of the customer details with the embedding cache of the artifact store in front of it.
+
+    The cache is the SQLite file '<artifact store>/embedding_cache.sqlite', shared by the index (re)builds, the ingest
+    pipeline and the batch deduplication. Its entries are keyed by the model identifier and the backend of the
+    encoder actually wrapped (see `encoder_backend`), so the embeddings of the ONNX and PyTorch backends are never
+    mixed, whichever backend the encoder was loaded with. With EMBEDDING_CACHE_MAX_MB=0 the encoder is returned as it is.
+
+    Parameters:
+    artifact_filepath (str): The artifact store, e.g. 'filesystem://./data/'.
+    encoder (SentenceTransformer, optional): The encoder to wrap. Defaults to the encoder cached for the process.
+    model_identifier (str, optional): Identifier of the sentence transformer. Defaults to 'all-MiniLM-L6-v2'.
+    backend (str, optional): The backend the encoder is loaded with when `encoder` is not given, see `load_encoder`,
+                             and the label of an `encoder` of a type `encoder_backend` does not know. Defaults to the
+                             ENCODER_BACKEND environment variable.
+
+    Returns:
+    CachedEncoder or SentenceTransformer: The encoder.
+    """
+    encoder = encoder or get_cached('encoder', (None, None, model_identifier), lambda: load_encoder(model_identifier, backend or ENCODER_BACKEND))
+    if not EMBEDDING_CACHE_MAX_MB:
+        return encoder
+    cache = get_cached(
+        'embedding_cache', (None, artifact_filepath, model_identifier),
+        lambda: EmbeddingCache(artifact_directory(artifact_filepath, 'embedding_cache.sqlite')),
+    )
+    return CachedEncoder(encoder, cache, f'{model_identifier}/{encoder_backend(encoder, backend)}')
+
+
+def embedding_encoder(embedding_dtype=None, dimensions=384):
+    """
+    Returns the encoder the embeddings are stored with.
+
+    Parameters:
+    embedding_dtype (str, optional): None to store lists of floats, or 'float32' or 'float16' to store packed binary arrays.
+                                     Defaults to None.
+    dimensions (int, optional): The embedding size. Defaults to 384.
+
+    Returns:
+    Encoder: The superduperdb encoder of the embeddings.
+    """
+    from superduperdb import vector
+    from superduperdb.ext.numpy import array
+
+    if embedding_dtype is None:
+        return vector(shape=(dimensions,))
+    if embedding_dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unsupported embedding dtype '{embedding_dtype}', expected one of {EMBEDDING_DTYPES}")
+    return array(embedding_dtype, shape=(dimensions,))
+
+
+def model_definition(embedding_dtype=EMBEDDING_DTYPE):
     """
     Defines and returns a sentence transformer model for use in vector search functionality.
 
     This function creates a sentence transformer model which is used for embedding text data.
     The model is configured with specific settings suitable for encoding and processing text data.
+    By default the embeddings are stored as lists of floats, which BSON stores with about 12 bytes per dimension;
+    with an `embedding_dtype` they are stored as packed binary arrays of 4 ('float32') or 2 ('float16') bytes per dimension.
+
+    Parameters:
+    embedding_dtype (str, optional): None, 'float32' or 'float16', see `embedding_encoder`. Defaults to the
+                                     EMBEDDING_DTYPE environment variable.
 
     Returns:
     Model: A sentence transformer model configured for text encoding and processing.
     """
+    from superduperdb import Model
+
+    if embedding_dtype is None:
+        postprocess = lambda x: x.tolist()  # noqa: E731
+    else:
+        postprocess = lambda x: x.astype(embedding_dtype)  # noqa: E731
+
     model = Model(
-        identifier='all-MiniLM-L6-v2',
-        object=sentence_transformers.SentenceTransformer('all-MiniLM-L6-v2'),
-        encoder=vector(shape=(384,)),
+        identifier=MODEL_IDENTIFIER,
+        object=load_encoder(MODEL_IDENTIFIER),
+        encoder=embedding_encoder(embedding_dtype),
         predict_method='encode', # Specify the prediction method
-        postprocess=lambda x: x.tolist(),  # Define postprocessing function
+        postprocess=postprocess,  # Define postprocessing function
         batch_predict=True, # Generate predictions for a set of observations all at once
     )
     return model
 
 
-def create_database(data, mongodb_uri, artifact_filepath):
+def encode_embedding(embedding, embedding_dtype=None):
+    """
+    Converts an embedding to the form the vector index listener stores it in, see `model_definition`.
+
+    Parameters:
+    embedding (ndarray): The embedding.
+    embedding_dtype (str, optional): None, 'float32' or 'float16'. Defaults to None.
+
+    Returns:
+    The embedding as a list of floats, or as the binary content of its encoder.
+    """
+    if embedding_dtype is None:
+        return embedding.tolist()
+    encoder = embedding_encoder(embedding_dtype, dimensions=len(embedding))
+    return {'_content': {'bytes': embedding.astype(embedding_dtype).tobytes(), 'encoder': encoder.identifier}}
+
+
+def decode_embedding(value):
+    """
+    Reads an embedding stored in the '_outputs' field of a raw MongoDB document, as a list or as a packed array.
+
+    Parameters:
+    value (list or dict): The stored embedding.
+
+    Returns:
+    list or ndarray: The embedding.
+    """
+    if isinstance(value, dict) and '_content' in value:
+        # e.g. 'numpy.float16[384]'
+        dtype = value['_content']['encoder'].split('.', 1)[1].split('[', 1)[0]
+        return np.frombuffer(value['_content']['bytes'], dtype=dtype)
+    return value
+
+
+def index_identifier(model_identifier=MODEL_IDENTIFIER):
+    """
+    Returns the identifier of the vector index built on top of the given model.
+
+    Parameters:
+    model_identifier (str, optional): Identifier of the embedding model. Defaults to 'all-MiniLM-L6-v2'.
+
+    Returns:
+    str: The vector index identifier, e.g. 'pymongo-docs-all-MiniLM-L6-v2'.
+    """
+    return f'pymongo-docs-{model_identifier}'
+
+
+def connect_database(mongodb_uri, artifact_filepath):
+    """
+    Connects to the database and returns the customer details collection without inserting any data.
+
+    Parameters:
+    mongodb_uri (str): MongoDB connection URI for the database.
+    artifact_filepath (str): Filepath for storing database artifacts, such as indexes.
+
+    Returns:
+    tuple: A tuple containing the database instance and the customer details collection.
+    """
+    from superduperdb import superduper
+    from superduperdb.backends.mongodb import Collection
+
+    db = superduper(mongodb_uri, artifact_store=artifact_filepath)
+    collection = Collection(COLLECTION_NAME)
+    return db, collection
+
+
+def vector_index_exists(db, model_identifier=MODEL_IDENTIFIER):
+    """
+    Checks whether the vector index for the given model has already been added to the database.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    model_identifier (str, optional): Identifier of the embedding model. Defaults to 'all-MiniLM-L6-v2'.
+
+    Returns:
+    bool: True if the vector index is registered in the database metadata, False otherwise.
+    """
+    return index_identifier(model_identifier) in db.show('vector_index')
+
+
+def stored_customer(record):
+    """
+    Returns a customer record the way it is stored: with its normalized comparison fields and its customer key.
+
+    Parameters:
+    record (dict): The customer record.
+
+    Returns:
+    dict: The record with its NORMALIZED_FIELD and CUSTOMER_KEY_FIELD.
+    """
+    normalized = normalize_customer(record)
+    return {**record, NORMALIZED_FIELD: normalized, CUSTOMER_KEY_FIELD: customer_key({NORMALIZED_FIELD: normalized})}
+
+
+def create_database(data, mongodb_uri, artifact_filepath, batch_size=10000, embedding_dtype=EMBEDDING_DTYPE):
     """
     Creates a database and collection, then stores provided data.
 
     This function initializes a MongoDB database and a collection based on the provided MongoDB URI and artifact filepath.
-    It then stores the given data in the newly created collection.
+    It then stores the given data in the newly created collection, together with the normalized comparison fields
+    and the customer key of every customer (see `normalization.py`).
+    A snapshot file is streamed and inserted `batch_size` records at a time. If the snapshot has a stored embedding
+    matrix (see `embed_snapshot`), the embeddings are inserted with the records, so the vector index listener does not
+    have to encode them again. The matrix is checked against the snapshot before anything is inserted, and a
+    `StaleEmbeddingsError` is raised if it was computed from another version of it. Otherwise they are computed through the embedding cache of the artifact store (see
+    `cached_encoder`), so rebuilding the index of an unchanged customer base only re-encodes the changed customers.
 
     Parameters:
-    data (list): A list of dictionaries representing the data to be stored in the database.
+    data (list or str): A list of dictionaries representing the data to be stored in the database, or the path of a customer snapshot.
     mongodb_uri (str): MongoDB connection URI for the database.
     artifact_filepath (str): Filepath for storing database artifacts, such as indexes.
+    batch_size (int, optional): The number of snapshot records inserted at once. Defaults to 10000.
+    embedding_dtype (str, optional): How the stored embeddings are encoded, see `model_definition`. Defaults to the
+                                     EMBEDDING_DTYPE environment variable.
 
     Returns:
     tuple: A tuple containing the database instance and the created collection.
     """
+    from superduperdb import Document
+
     # Initialize the database with the given URI and artifact store path
-    db = superduper(mongodb_uri, artifact_store=artifact_filepath)
+    # and create a collection for storing the data
+    db, collection = connect_database(mongodb_uri, artifact_filepath)
 
-    # Create a collection for storing the data
-    collection = Collection('customer_details')
+    # Embeddings are computed here, through the embedding cache, unless the snapshot has them stored
+    embeddings = load_embeddings(data) if isinstance(data, str) else None
+    encoder = cached_encoder(artifact_filepath) if embeddings is None and EMBEDDING_CACHE_MAX_MB else None
+    batches = iter_snapshot(data, batch_size=batch_size) if isinstance(data, str) else [data]
 
-    # Insert the data into the collection
-    db.execute(collection.insert_many([Document(r) for r in data]))
+    # Insert the data into the collection, streaming a snapshot batch by batch, together with the embeddings
+    offset = 0
+    for batch in batches:
+        vectors = embeddings[offset:offset + len(batch)] if embeddings is not None else None
+        if encoder is not None:
+            vectors = encoder.encode([r.get('details') or build_details(r) for r in batch], batch_size=256)
+        documents = [stored_customer(r) for r in batch]
+        if vectors is not None:
+            for document, vector in zip(documents, vectors):
+                document['_outputs'] = {'details': {MODEL_IDENTIFIER: encode_embedding(vector, embedding_dtype)}}
+        db.execute(collection.insert_many([Document(d) for d in documents]))
+        offset += len(batch)
 
     return db, collection
 
 
+def embed_snapshot(path, encoder=None, batch_size=10000):
+    """
+    Computes the embeddings of a customer snapshot and stores them alongside it as a memory-mapped float32 matrix.
+
+    The snapshot is streamed batch by batch and each batch of embeddings is written to the matrix as soon as it is
+    computed, so neither the records nor the embeddings have to fit in memory.
+
+    Parameters:
+    path (str): The snapshot file.
+    encoder (SentenceTransformer, optional): The model used for embedding. Defaults to 'all-MiniLM-L6-v2'.
+    batch_size (int, optional): The number of records encoded at once. Defaults to 10000.
+
+    Returns:
+    str: The path of the embedding matrix.
+    """
+    encoder = encoder or load_encoder()
+    fingerprint = snapshot_fingerprint(path)
+    embeddings = create_embeddings(path, fingerprint['rows'], encoder.get_sentence_embedding_dimension())
+
+    offset = 0
+    for batch in iter_snapshot(path, batch_size=batch_size):
+        embeddings[offset:offset + len(batch)] = encoder.encode([r.get('details') or build_details(r) for r in batch])
+        offset += len(batch)
+    embeddings.flush()
+    save_fingerprint(path, fingerprint)
+
+    return embeddings_path(path)
+
+
+def build_details(customer):
+    """
+    Builds the lower-cased 'details' text of a customer which is embedded by the vector index.
+
+    The fields are joined in the same order as in `generate_df.py` and missing fields are left empty.
+
+    Parameters:
+    customer (dict): A dictionary with the keys 'Full Name', 'Email', 'Address' and 'Phone Number'.
+
+    Returns:
+    str: The joined, lower-cased customer details.
+    """
+    return ' '.join(str(customer[field]).lower() if customer.get(field) is not None else '' for field in CUSTOMER_FIELDS)
+
+
+class DuplicateCustomerError(ValueError):
+    """
+    Raised when a customer with the same customer key (see `normalization.customer_key`) is already stored.
+    """
+
+
+def ensure_customer_key_index(db):
+    """
+    Creates the unique index on the customer key, so that the database rejects a second customer with the same
+    normalized fields, whichever process inserts it.
+
+    Customers stored without a key are left out of the index. When the collection already holds customers sharing
+    a key, e.g. because it was loaded before the index existed, a plain index is created instead.
+
+    Parameters:
+    db (Datalayer): The database instance.
+
+    Returns:
+    bool: True if the index is unique.
+    """
+    from pymongo.errors import OperationFailure
+
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    partial = {CUSTOMER_KEY_FIELD: {'$type': 'string'}}
+    try:
+        raw_collection.create_index(CUSTOMER_KEY_FIELD, unique=True, partialFilterExpression=partial)
+        return True
+    except OperationFailure as e:
+        if e.code != 11000:
+            # An index of the same name without the unique option, from an earlier version
+            raw_collection.drop_index(f'{CUSTOMER_KEY_FIELD}_1')
+            return ensure_customer_key_index(db)
+        logger.warning('Customers share a customer key, the customer key index is not unique: %s', e)
+        raw_collection.create_index(CUSTOMER_KEY_FIELD)
+        return False
+
+
+def insert_customers(db, collection, customers):
+    """
+    Inserts one or a few new customers into an existing collection and embeds only those customers.
+
+    Inserting through the database instance triggers the listener of the vector index for the inserted ids only,
+    so the new customers are added to the existing index without re-embedding the rest of the collection.
+
+    Parameters:
+    db (Datalayer): The database instance holding the vector index.
+    collection (Collection): The customer details collection.
+    customers (list): A list of dictionaries with the customer fields. The 'details' field is built when missing
+                      and the normalized comparison fields are computed.
+
+    Returns:
+    list: The ids of the inserted customers.
+
+    Raises:
+    DuplicateCustomerError: If the unique customer key index rejects one of the customers (see
+                            `ensure_customer_key_index`); the customers before it are inserted.
+    """
+    from pymongo.errors import BulkWriteError, DuplicateKeyError
+    from superduperdb import Document
+
+    documents = []
+    for customer in customers:
+        record = {field: customer.get(field) for field in CUSTOMER_FIELDS}
+        record['details'] = customer.get('details') or build_details(customer)
+        documents.append(Document(stored_customer(record)))
+
+    try:
+        inserted_ids, _ = db.execute(collection.insert_many(documents))
+    except (BulkWriteError, DuplicateKeyError) as e:
+        errors = e.details.get('writeErrors', [e.details]) if e.details else []
+        if errors and all(error.get('code') == 11000 for error in errors):
+            raise DuplicateCustomerError(f'A customer with the same {CUSTOMER_KEY_FIELD} is already stored') from e
+        raise
+    return inserted_ids
+
+
+def find_customers_by_key(db, collection, customers):
+    """
+    Fetches the stored customers having the customer key of one of the given customers.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    collection (Collection): The customer details collection.
+    customers (list): The customer dictionaries.
+
+    Returns:
+    list: The stored customers, as returned by `fetch_customers`, each with a score of 1.0.
+    """
+    keys = [stored_customer({field: c.get(field) for field in CUSTOMER_FIELDS})[CUSTOMER_KEY_FIELD] for c in customers]
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    ids = [str(r['_id']) for r in raw_collection.find({CUSTOMER_KEY_FIELD: {'$in': keys}}, {'_id': 1})]
+    return fetch_customers(db, collection, ids, [1.0] * len(ids))
+
+
+def add_to_vector_searcher(db, ids, vectors, model_identifier=MODEL_IDENTIFIER):
+    """
+    Adds customers embedded by another process to the in-memory vector searcher of this process.
+
+    The listener only updates the searcher of the process which inserts the customers; the other processes
+    serving the same collection call this for the customers they learn about from the customer feed. A process
+    which has not loaded its searcher yet, e.g. because it serves another backend, is left as it is: the searcher
+    reads the new customers from the collection when it is loaded.
+
+    Parameters:
+    db (Datalayer): The database instance holding the vector index.
+    ids (list): The customer ids as strings.
+    vectors (ndarray): Their embeddings, row-aligned with `ids`.
+    model_identifier (str, optional): Identifier of the embedding model. Defaults to 'all-MiniLM-L6-v2'.
+    """
+    from superduperdb.vector_search.base import VectorItem
+
+    # Looking a searcher up loads it, checking for it does not
+    if len(ids) and index_identifier(model_identifier) in db.fast_vector_searchers:
+        db.fast_vector_searchers[index_identifier(model_identifier)].add(
+            [VectorItem.create(id=str(i), vector=vector) for i, vector in zip(ids, vectors)]
+        )
+
+
+def artifact_directory(artifact_filepath, *parts):
+    """
+    Returns a local directory inside the artifact store for files kept next to the database artifacts.
+
+    Parameters:
+    artifact_filepath (str): The artifact store, e.g. 'filesystem://./data/'. Defaults to './data' when not set.
+    *parts (str): Sub-directories inside the artifact store.
+
+    Returns:
+    str: The directory path.
+    """
+    root = artifact_filepath.split('://', 1)[-1] if artifact_filepath else './data'
+    return os.path.join(root, *parts)
+
+
+def find_nearest_ids(db, vector, n=5, model_identifier=MODEL_IDENTIFIER):
+    """
+    Looks up an already computed query vector in the vector index of the database.
+
+    This is the lookup `.like(...)` runs after encoding the query, so a cached embedding can be searched without
+    encoding the query again. The first lookup of a process loads the in-memory vector searcher of the index.
+
+    Parameters:
+    db (Datalayer): The database instance holding the vector index.
+    vector (list): The query embedding.
+    n (int, optional): Number of nearest customers to return. Defaults to 5.
+    model_identifier (str, optional): Identifier of the embedding model. Defaults to 'all-MiniLM-L6-v2'.
+
+    Returns:
+    tuple: A list of customer ids (as strings) and a list of their similarity scores.
+    """
+    return db.fast_vector_searchers[index_identifier(model_identifier)].find_nearest_from_array(vector, n=n)
+
+
+def fetch_customers(db, collection, ids, scores, fields=CUSTOMER_FIELDS + ['details', NORMALIZED_FIELD]):
+    """
+    Fetches customers by id and attaches their similarity score.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    collection (Collection): The customer details collection.
+    ids (list): The customer ids as strings.
+    scores (list): The similarity scores, aligned with `ids`.
+    fields (list, optional): The fields to return besides '_id' and 'score'. Defaults to the customer fields, 'details'
+                             and the normalized comparison fields.
+
+    Returns:
+    list: A list of dictionaries, one per customer, sorted by 'score' in descending order.
+    """
+    scores = dict(zip((str(i) for i in ids), scores))
+    records = db.execute(
+        collection.find({'_id': {'$in': [ObjectId(i) for i in scores]}}, {field: 1 for field in fields + ['_id']})
+    )
+    results = [r.unpack() for r in records]
+    for r in results:
+        r['score'] = scores[str(r['_id'])]
+    return sorted(results, key=lambda r: r['score'], reverse=True)
+
+
+def iter_customers(db, fields=CUSTOMER_FIELDS):
+    """
+    Iterates over every customer of the collection without loading them all at once.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    fields (list, optional): The fields to return besides '_id'. Defaults to the customer fields.
+
+    Yields:
+    dict: A customer record with its '_id' as string.
+    """
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    for r in raw_collection.find({}, {field: 1 for field in fields}):
+        r['_id'] = str(r['_id'])
+        yield r
+
+
+def count_customers(db):
+    """
+    Counts the customers of the collection, embedded or not.
+
+    Parameters:
+    db (Datalayer): The database instance.
+
+    Returns:
+    int: The number of customers.
+    """
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    return raw_collection.count_documents({})
+
+
+def count_customer_embeddings(db, model_identifier=MODEL_IDENTIFIER, key='details'):
+    """
+    Counts the customers which have already been embedded by the vector index listener.
+
+    Parameters:
+    db (Datalayer): The database instance holding the vector index.
+    model_identifier (str, optional): Identifier of the embedding model. Defaults to 'all-MiniLM-L6-v2'.
+    key (str, optional): The embedded field. Defaults to 'details'.
+
+    Returns:
+    int: The number of embedded customers.
+    """
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    return raw_collection.count_documents({f'_outputs.{key}.{model_identifier}': {'$exists': True}})
+
+
+def load_customer_embeddings(db, model_identifier=MODEL_IDENTIFIER, key='details', ids=None):
+    """
+    Loads every embedded customer together with its stored embedding.
+
+    The embeddings are read from the '_outputs' field written by the vector index listener,
+    so nothing is re-encoded.
+
+    Parameters:
+    db (Datalayer): The database instance holding the vector index.
+    model_identifier (str, optional): Identifier of the embedding model. Defaults to 'all-MiniLM-L6-v2'.
+    key (str, optional): The embedded field. Defaults to 'details'.
+    ids (list, optional): Only load the customers with these ids. Defaults to all customers.
+
+    Returns:
+    tuple: A list of customer records (with their '_id' as string) and a float32 matrix of their embeddings, row-aligned.
+    """
+    output_field = f'_outputs.{key}.{model_identifier}'
+    projection = {field: 1 for field in CUSTOMER_FIELDS + [key, output_field]}
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    query = {output_field: {'$exists': True}}
+    if ids is not None:
+        query['_id'] = {'$in': [ObjectId(str(i)) for i in ids]}
+
+    records, vectors = [], []
+    for r in raw_collection.find(query, projection):
+        vectors.append(decode_embedding(r.pop('_outputs')[key][model_identifier]))
+        r['_id'] = str(r['_id'])
+        records.append(r)
+
+    return records, np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
 
-def search_functionality(data, mongodb_uri, artifact_filepath):
+
+def search_functionality(data, mongodb_uri, artifact_filepath, embedding_dtype=EMBEDDING_DTYPE):
     """
     Configures and initializes a MongoDB database with vector search functionality.
 
     This function creates a MongoDB database and a collection, then adds a vector search index to the collection.
     The vector search is based on a sentence transformer model, which is used to compute vector embeddings of the documents.
+    The data is inserted and embedded only once: if the vector index already exists in the database, the existing
+    collection and model are returned as they are and the data is not inserted again.
 
     Parameters:
-    data (list): A list of dictionaries representing the data to be stored in the database.
+    data (list or str): A list of dictionaries representing the data to be stored in the database, or the path of a customer snapshot.
     mongodb_uri (str): MongoDB connection URI.
     artifact_filepath (str): Filepath for storing artifacts.
+    embedding_dtype (str, optional): How the embeddings are stored, see `model_definition`. It only applies when the
+                                     index is created. Defaults to the EMBEDDING_DTYPE environment variable.
 
     Returns:
     tuple: A tuple containing the database instance, the collection, and the model used for embedding.
     """
+    # Reuse the existing index instead of re-inserting and re-embedding the data
+    db, collection = connect_database(mongodb_uri, artifact_filepath)
+    if vector_index_exists(db):
+        ensure_customer_key_index(db)
+        return db, collection, db.models[MODEL_IDENTIFIER]
+
     # Create the database and collection and store the data
-    db, collection = create_database(data, mongodb_uri, artifact_filepath)
+    db, collection = create_database(data, mongodb_uri, artifact_filepath, embedding_dtype=embedding_dtype)
+    ensure_customer_key_index(db)
+
+    return db, collection, add_vector_index(db, collection, embedding_dtype)
+
+
+def add_vector_index(db, collection, embedding_dtype=EMBEDDING_DTYPE):
+    """
+    Adds the vector index of the customer details to the database.
+
+    The listener of the index only encodes the customers which have no embedding in '_outputs' yet, so customers
+    loaded together with their embeddings are not encoded again.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    collection (Collection): The customer details collection.
+    embedding_dtype (str, optional): How the embeddings are stored, see `model_definition`. Defaults to the
+                                     EMBEDDING_DTYPE environment variable.
+
+    Returns:
+    Model: The model used for embedding.
+    """
+    from superduperdb import Listener, VectorIndex
 
     # Define the model for embedding
-    model = model_definition()
+    model = model_definition(embedding_dtype)
 
     # Add a vector index to the collection for vector search functionality
     db.add(
         VectorIndex(
-            identifier=f'pymongo-docs-{model.identifier}',
+            identifier=index_identifier(model.identifier),
             indexing_listener=Listener(
                 select=collection.find(),
                 key='details',
@@ -99,10 +696,16 @@ def search_functionality(data, mongodb_uri, artifact_filepath):
             ),
         )
     )
-    return db, collection, model
+    return model
 
 
 # if __name__ == '__main__':
 #     db, collection, model = search_functionality(chunks, MONGODB_URI, artifact_store)
 #     r = db.execute(collection.find_one())
 #     print(r.unpack())
+
+
+if __name__ == '__main__':
+    # Precompute the embeddings of a customer snapshot, e.g. python -m src.search_src.create_superduperdb customer_details.jsonl
+    import sys
+    print(embed_snapshot(sys.argv[1]))
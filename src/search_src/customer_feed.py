@@ -0,0 +1,95 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Collections of the feed of customer changes, which every process serving dedup checks on the collection follows
+FEED_COLLECTION = 'customer_feed'
+FEED_COUNTER_COLLECTION = 'customer_feed_counter'
+# How long a missing event number holds the followers back before they skip it, in seconds: a writer numbers its
+# event before it writes it, and a writer which dies in between leaves a gap that is never filled
+FEED_GAP_SECONDS = float(os.getenv('FEED_GAP_SECONDS', 30))
+
+_process_token = uuid.uuid4().hex[:8]
+
+
+def process_id():
+    """
+    Identifies the current process among the writers of the feed; forked workers get their own id.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}:{_process_token}'
+
+
+def feed_head(db):
+    """
+    Returns the number of the last event published on the feed, 0 if there is none.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    """
+    counter = db.databackend.get_table_or_collection(FEED_COUNTER_COLLECTION).find_one({'_id': 'feed'})
+    return counter['seq'] if counter else 0
+
+
+def publish(db, kind, ids=()):
+    """
+    Publishes a change of the customer collection to every process following the feed.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    kind (str): 'add' when customers were inserted, 'reload' when the collection was reloaded (e.g. by `ingest.py`)
+                and the followers must rebuild their indexes.
+    ids (list, optional): The ids of the inserted customers. Defaults to none.
+
+    Returns:
+    int: The number of the event.
+    """
+    from pymongo import ReturnDocument
+
+    counter = db.databackend.get_table_or_collection(FEED_COUNTER_COLLECTION).find_one_and_update(
+        {'_id': 'feed'}, {'$inc': {'seq': 1}}, upsert=True, return_document=ReturnDocument.AFTER,
+    )
+    db.databackend.get_table_or_collection(FEED_COLLECTION).insert_one({
+        '_id': counter['seq'], 'kind': kind, 'ids': [str(i) for i in ids], 'writer': process_id(), 'time': time.time(),
+    })
+    return counter['seq']
+
+
+class CustomerFeed:
+    """
+    Follower of the customer feed, which returns the changes published by other processes since the last poll.
+
+    It starts at the current end of the feed, so it must be created before the indexes it keeps up to date are
+    loaded: a change published in between is then applied to an index which may already hold it, which only adds
+    a customer twice, instead of being missed. Events of the own process are skipped, since the process applied
+    them when it published them.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.position = feed_head(db)
+        self._gap_since = None
+        self._lock = threading.Lock()
+
+    def poll(self):
+        """
+        Returns the events published by other processes since the last poll, in order.
+
+        Returns:
+        list: The event documents, with their 'kind' and 'ids'.
+        """
+        feed = self.db.databackend.get_table_or_collection(FEED_COLLECTION)
+        events = []
+        with self._lock:
+            for event in feed.find({'_id': {'$gt': self.position}}).sort('_id', 1):
+                if event['_id'] != self.position + 1:
+                    # Wait for the missing event unless its writer is gone
+                    self._gap_since = self._gap_since or time.monotonic()
+                    if time.monotonic() - self._gap_since < FEED_GAP_SECONDS:
+                        break
+                self._gap_since = None
+                self.position = event['_id']
+                if event['writer'] != process_id():
+                    events.append(event)
+        return events
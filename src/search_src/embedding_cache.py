@@ -0,0 +1,217 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+# Size bound of the on-disk embedding cache, 0 to disable it
+EMBEDDING_CACHE_MAX_MB = int(os.getenv('EMBEDDING_CACHE_MAX_MB', 2048))
+
+
+def text_hash(text):
+    """
+    Hashes a text to the key of its embedding in the cache.
+
+    Parameters:
+    text (str): The embedded text, e.g. the 'details' of a customer.
+
+    Returns:
+    bytes: The SHA-1 digest of the UTF-8 encoded text.
+    """
+    return hashlib.sha1(text.encode()).digest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings in a SQLite file, keyed by (model, hash of the embedded text).
+
+    Every hit refreshes the access time of the embedding; when the file grows beyond `max_bytes`, the least recently
+    used embeddings are dropped until it is back under 90% of it. The file can be shared by several processes.
+    """
+
+    def __init__(self, path, max_bytes=EMBEDDING_CACHE_MAX_MB * 2 ** 20):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            # A rowid table keeps a 1.5 kB vector in its row; a WITHOUT ROWID table would spill it to an overflow page
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings ('
+                'model TEXT NOT NULL, hash BLOB NOT NULL, vector BLOB NOT NULL, accessed REAL NOT NULL)'
+            )
+            self._connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS embeddings_key ON embeddings (model, hash)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)')
+
+    def get_many(self, model, hashes, chunk_size=500):
+        """
+        Looks embeddings up and refreshes the access time of the ones found.
+
+        Parameters:
+        model (str): The model key, see `CachedEncoder`.
+        hashes (list): The text hashes, see `text_hash`.
+        chunk_size (int, optional): The number of hashes looked up per query. Defaults to 500.
+
+        Returns:
+        dict: The float32 embedding of every hash found.
+        """
+        found = {}
+        with self._lock, self._connection:
+            for start in range(0, len(hashes), chunk_size):
+                chunk = hashes[start:start + chunk_size]
+                rows = self._connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({', '.join('?' * len(chunk))})",
+                    [model, *chunk],
+                )
+                found.update((bytes(h), np.frombuffer(v, dtype=np.float32)) for h, v in rows)
+            now = time.time()
+            self._connection.executemany(
+                'UPDATE embeddings SET accessed = ? WHERE model = ? AND hash = ?', [(now, model, h) for h in found],
+            )
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, model, hashes, vectors):
+        """
+        Stores embeddings, evicting the least recently used ones first if they would not fit.
+
+        Parameters:
+        model (str): The model key.
+        hashes (list): The text hashes.
+        vectors (ndarray): The embeddings, row-aligned with `hashes`.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        # Estimate the stored size from the rows already stored, which includes the indexes and the unused page space
+        with self._lock:
+            rows, = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+            row_bytes = self.size_bytes() / rows if rows else 1.5 * vectors[0].nbytes
+        self.evict(int(len(vectors) * row_bytes))
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, hash, vector, accessed) VALUES (?, ?, ?, ?)',
+                [(model, h, v.tobytes(), now) for h, v in zip(hashes, vectors)],
+            )
+
+    def size_bytes(self):
+        """
+        Returns the bytes used by the cache file, without its free pages.
+        """
+        page_count, = self._connection.execute('PRAGMA page_count').fetchone()
+        free_pages, = self._connection.execute('PRAGMA freelist_count').fetchone()
+        page_size, = self._connection.execute('PRAGMA page_size').fetchone()
+        return (page_count - free_pages) * page_size
+
+    def evict(self, incoming_bytes=0):
+        """
+        Drops the least recently used embeddings when the cache, with `incoming_bytes` more, would exceed `max_bytes`,
+        until it uses at most 90% of `max_bytes` with them.
+
+        Deleted pages are reused by later inserts, so the file does not grow past its bound.
+
+        Parameters:
+        incoming_bytes (int, optional): The size of the embeddings about to be stored. Defaults to 0.
+
+        Returns:
+        int: The number of evicted embeddings.
+        """
+        with self._lock:
+            used = self.size_bytes()
+            if used + incoming_bytes <= self.max_bytes:
+                return 0
+            rows, = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+            keep = max(0.0, 0.9 * self.max_bytes - incoming_bytes) / max(used, 1)
+            excess = min(rows, int(np.ceil(rows * (1 - keep))))
+            with self._connection:
+                self._connection.execute(
+                    'DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY accessed LIMIT ?)', (excess,),
+                )
+        self.evictions += excess
+        return excess
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counters and the size of the cache.
+        """
+        with self._lock:
+            rows, = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+            size = self.size_bytes()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'embeddings': rows, 'bytes': size}
+
+    def close(self):
+        self._connection.close()
+
+
+class CachedEncoder:
+    """
+    Wraps an encoder so that texts already encoded by the same model are read from an `EmbeddingCache`.
+
+    It has the `encode` and `get_sentence_embedding_dimension` methods of `SentenceTransformer`, so it can be passed
+    wherever an encoder is expected. `model` must change whenever the embeddings would, e.g. with the encoder backend.
+    """
+
+    def __init__(self, encoder, cache, model):
+        self.encoder = encoder
+        self.cache = cache
+        self.model = model
+
+    def get_sentence_embedding_dimension(self):
+        return self.encoder.get_sentence_embedding_dimension()
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        """
+        Encodes one or several sentences, encoding only the ones which are not cached yet.
+
+        Parameters:
+        sentences (str or list): A sentence or a list of sentences.
+        batch_size (int, optional): The batch size of the wrapped encoder. Defaults to 32.
+        **kwargs: Other arguments of the wrapped encoder.
+
+        Returns:
+        ndarray: The float32 embedding of the sentence, or a (len(sentences), dimensions) matrix of embeddings.
+        """
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        hashes = [text_hash(s) for s in sentences]
+        found = self.cache.get_many(self.model, list(dict.fromkeys(hashes)))
+
+        # Encode every missing text once, even if it appears several times
+        missing = {h: s for h, s in zip(hashes, sentences) if h not in found}
+        if missing:
+            vectors = np.asarray(self.encoder.encode(list(missing.values()), batch_size=batch_size, **kwargs), dtype=np.float32)
+            self.cache.put_many(self.model, list(missing), vectors)
+            found.update(zip(missing, vectors))
+
+        embeddings = np.stack([found[h] for h in hashes]) if hashes else np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+if __name__ == '__main__':
+    # Compare a cold and a warm pass over generated customer details, as in a reindex of an unchanged customer base
+    import argparse
+    import tempfile
+    from src.benchmark.dedup_benchmark import generate_benchmark_data
+    from src.search_src.create_superduperdb import MODEL_IDENTIFIER, load_encoder
+
+    parser = argparse.ArgumentParser(description='Time encoding customer details without and with the embedding cache.')
+    parser.add_argument('--rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    customers, _, _ = generate_benchmark_data(args.rows)
+    details = [c['details'] for c in customers]
+    with tempfile.TemporaryDirectory() as directory:
+        encoder = CachedEncoder(load_encoder(), EmbeddingCache(os.path.join(directory, 'embeddings.sqlite')), MODEL_IDENTIFIER)
+        for run in ('cold', 'warm'):
+            start = time.perf_counter()
+            encoder.encode(details, batch_size=256)
+            print(f'{run}: {len(details) / (time.perf_counter() - start):.0f} rows/s', encoder.cache.stats())
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.data_generation.snapshot import iter_snapshot
+from src.search_src.create_superduperdb import (
+    COLLECTION_NAME,
+    EMBEDDING_DTYPE,
+    MODEL_IDENTIFIER,
+    add_vector_index,
+    artifact_directory,
+    build_details,
+    cached_encoder,
+    connect_database,
+    encode_embedding,
+    ensure_customer_key_index,
+    stored_customer,
+    vector_index_exists,
+)
+from src.search_src.customer_feed import publish
+from src.search_src.lexical_index import build_lexical_index
+from src.search_src.normalization import CUSTOMER_KEY_FIELD
+from src.search_src.query_cache import query_results
+from src.search_src.resource_cache import invalidate
+
+
+def checkpoint_path(artifact_store, snapshot_path):
+    """
+    Returns the checkpoint file of the ingest of a snapshot, kept in the artifact store.
+
+    Parameters:
+    artifact_store (str): Path to the artifact store.
+    snapshot_path (str): The snapshot being loaded.
+
+    Returns:
+    str: The path of the checkpoint file.
+    """
+    return os.path.join(artifact_directory(artifact_store, 'ingest'), os.path.basename(snapshot_path) + '.checkpoint.json')
+
+
+def read_checkpoint(path, snapshot_path):
+    """
+    Reads the number of snapshot rows already loaded.
+
+    Parameters:
+    path (str): The checkpoint file.
+    snapshot_path (str): The snapshot being loaded.
+
+    Returns:
+    int: The number of rows to skip, 0 when there is no checkpoint or the snapshot changed since it was written.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    stat = os.stat(snapshot_path)
+    if (checkpoint['snapshot'], checkpoint['size'], checkpoint['mtime']) != (os.path.abspath(snapshot_path), stat.st_size, stat.st_mtime):
+        return 0
+    return checkpoint['rows']
+
+
+def write_checkpoint(path, snapshot_path, rows):
+    """
+    Records that the first `rows` rows of the snapshot are loaded, replacing the checkpoint file atomically.
+
+    Parameters:
+    path (str): The checkpoint file.
+    snapshot_path (str): The snapshot being loaded.
+    rows (int): The number of rows loaded.
+    """
+    stat = os.stat(snapshot_path)
+    checkpoint = {'snapshot': os.path.abspath(snapshot_path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'rows': rows}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def prepare_batch(records, encoder, embedding_dtype=EMBEDDING_DTYPE, encode_batch_size=256):
+    """
+    Normalizes and embeds a batch of customers and turns it into upserts on their customer key.
+
+    Customers with the same key within the batch are written once, the last one wins.
+
+    Parameters:
+    records (list): The customer records.
+    encoder (SentenceTransformer): The model used for embedding.
+    embedding_dtype (str, optional): How the embeddings are stored, see `model_definition`. Defaults to the
+                                     EMBEDDING_DTYPE environment variable.
+    encode_batch_size (int, optional): The number of customers encoded at once. Defaults to 256.
+
+    Returns:
+    list: The pymongo `UpdateOne` upserts of the batch.
+    """
+    from pymongo import UpdateOne
+
+    documents = {}
+    for r in records:
+        record = {k: v for k, v in r.items() if k != '_id'}
+        record['details'] = record.get('details') or build_details(record)
+        document = stored_customer(record)
+        documents[document[CUSTOMER_KEY_FIELD]] = document
+
+    documents = list(documents.values())
+    embeddings = encoder.encode([d['details'] for d in documents], batch_size=encode_batch_size) if documents else []
+    output_field = f'_outputs.details.{MODEL_IDENTIFIER}'
+    return [
+        UpdateOne(
+            {CUSTOMER_KEY_FIELD: d[CUSTOMER_KEY_FIELD]},
+            {'$set': {**d, output_field: encode_embedding(vector, embedding_dtype)}},
+            upsert=True,
+        )
+        for d, vector in zip(documents, embeddings)
+    ]
+
+
+def bulk_upsert(raw_collection, operations):
+    """
+    Writes upserts with one unordered bulk write, retrying once the ones which lost the race for their customer key.
+
+    Two runs upserting the same new customer at the same time both try to insert it; the unique customer key index
+    rejects one of them, whose retry then finds and updates the customer inserted by the other.
+
+    Parameters:
+    raw_collection (Collection): The pymongo customer collection.
+    operations (list): The `UpdateOne` upserts.
+
+    Yields:
+    dict: The 'nUpserted' and 'nMatched' counts of every bulk write.
+    """
+    from pymongo.errors import BulkWriteError
+
+    try:
+        result = raw_collection.bulk_write(operations, ordered=False)
+        yield {'nUpserted': result.upserted_count, 'nMatched': result.matched_count}
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+        yield {'nUpserted': e.details['nUpserted'], 'nMatched': e.details['nMatched']}
+        retry = [operations[error['index']] for error in e.details['writeErrors']]
+        result = raw_collection.bulk_write(retry, ordered=False)
+        yield {'nUpserted': result.upserted_count, 'nMatched': result.matched_count}
+
+
+def ingest_snapshot(snapshot_path, mongodb_uri, artifact_store, batch_size=5000, encode_batch_size=256,
+                    embedding_dtype=EMBEDDING_DTYPE, resume=True, checkpoint=None):
+    """
+    Loads a customer snapshot into the collection in batches of idempotent upserts, embedding each batch on the way.
+
+    Every customer is upserted on its customer key (a hash of its normalized fields, see `normalization.customer_key`),
+    so loading a snapshot twice, or replaying a batch after a crash, does not duplicate customers. Each batch is
+    written with one unordered bulk write, together with its embeddings in '_outputs', and the write of a batch
+    overlaps the normalization and encoding of the next one. The embeddings go through the embedding cache of the
+    artifact store (see `create_superduperdb.cached_encoder`), so reloading unchanged customers does not re-encode them. After every write the number of loaded rows is
+    checkpointed, so an interrupted load resumes after the last written batch.
+
+    The vector index is added at the end if the database does not have it yet; its listener finds the embeddings
+    already stored and does not encode anything. The character n-gram index of the details used by the hybrid
+    retrieval mode (see `lexical_index.py`) is rebuilt next to it in the artifact store.
+
+    The writes go to MongoDB directly, not through superduperdb, so the vector searchers and indexes held in memory
+    by running processes do not see the new customers by themselves. A 'reload' event is published on the customer
+    feed (see `customer_feed.py`): every app or API process following the feed drops its cached search results and
+    indexes before its next check and rebuilds them with the new customers. The same happens in this process.
+
+    The customer key index is unique (see `create_superduperdb.ensure_customer_key_index`), so overlapping runs
+    cannot insert a customer twice either: an upsert which loses the race for a key against another run is
+    retried once and then updates the customer the other run inserted.
+
+    Parameters:
+    snapshot_path (str): The customer snapshot (JSONL, or a JSON array).
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    batch_size (int, optional): The number of snapshot rows per bulk write. Defaults to 5000.
+    encode_batch_size (int, optional): The number of customers encoded at once. Defaults to 256.
+    embedding_dtype (str, optional): How the embeddings are stored, see `model_definition`. Defaults to the
+                                     EMBEDDING_DTYPE environment variable.
+    resume (bool, optional): Whether to skip the rows of an earlier, interrupted load of the same snapshot. Defaults to True.
+    checkpoint (str, optional): The checkpoint file. Defaults to '<artifact store>/ingest/<snapshot>.checkpoint.json'.
+
+    Returns:
+    dict: The number of rows read, of documents inserted and updated, and the rows per second.
+    """
+    checkpoint = checkpoint or checkpoint_path(artifact_store, snapshot_path)
+    skip = read_checkpoint(checkpoint, snapshot_path) if resume else 0
+
+    db, collection = connect_database(mongodb_uri, artifact_store)
+    raw_collection = db.databackend.get_table_or_collection(COLLECTION_NAME)
+    ensure_customer_key_index(db)
+    encoder = cached_encoder(artifact_store)
+
+    stats = {'skipped': skip, 'rows': 0, 'inserted': 0, 'updated': 0}
+
+    def write(operations, rows_done):
+        if operations:
+            for counts in bulk_upsert(raw_collection, operations):
+                stats['inserted'] += counts['nUpserted']
+                stats['updated'] += counts['nMatched']
+        write_checkpoint(checkpoint, snapshot_path, rows_done)
+
+    start = time.perf_counter()
+    rows_seen, pending = 0, None
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-writer') as writer:
+        for batch in iter_snapshot(snapshot_path, batch_size=batch_size):
+            rows_seen += len(batch)
+            if rows_seen <= skip:
+                continue
+            # A checkpoint written with another batch size can end inside this batch
+            batch = batch[max(0, skip - (rows_seen - len(batch))):]
+            operations = prepare_batch(batch, encoder, embedding_dtype, encode_batch_size)
+
+            # One batch is written while the next one is being prepared
+            if pending is not None:
+                pending.result()
+            pending = writer.submit(write, operations, rows_seen)
+            stats['rows'] += len(batch)
+        if pending is not None:
+            pending.result()
+    stats['rows_per_second'] = stats['rows'] / max(time.perf_counter() - start, 1e-9)
+
+    if not vector_index_exists(db):
+        add_vector_index(db, collection, embedding_dtype)
+    build_lexical_index(db, artifact_directory(artifact_store, 'lexical'))
+
+    # Searches and in-process indexes, here and in every process following the feed, must see the new customers
+    publish(db, 'reload')
+    query_results.clear()
+    invalidate(mongodb_uri=mongodb_uri, artifact_store=artifact_store)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load a customer snapshot into MongoDB with batched, restartable upserts.')
+    parser.add_argument('snapshot', help='customer snapshot (.jsonl or .json)')
+    parser.add_argument('--batch-size', type=int, default=5000, help='number of rows per bulk write')
+    parser.add_argument('--encode-batch-size', type=int, default=256, help='number of customers encoded at once')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and load the whole snapshot again')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint file, defaults to one in the artifact store')
+    args = parser.parse_args()
+
+    print(json.dumps(ingest_snapshot(
+        args.snapshot, os.getenv("MONGODB_URI"), os.getenv("ARTIFACT_STORE"), batch_size=args.batch_size,
+        encode_batch_size=args.encode_batch_size, resume=not args.restart, checkpoint=args.checkpoint,
+    )))
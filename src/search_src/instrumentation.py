@@ -0,0 +1,252 @@
+import contextvars
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+logger = logging.getLogger('customer_deduplication')
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# cProfile output directory of every outermost instrumented call, e.g. DEDUP_PROFILE_DIR=./profiles
+PROFILE_DIR = os.getenv('DEDUP_PROFILE_DIR')
+
+_lock = threading.Lock()
+_stages = {}
+_counters = defaultdict(int)
+_trace = contextvars.ContextVar('dedup_trace', default=None)
+_outermost = contextvars.ContextVar('dedup_outermost_call', default=None)
+
+
+class StageMetrics:
+    """
+    Latency histogram of one stage, plus its most recent durations for percentiles.
+    """
+
+    def __init__(self, history=10000):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.recent = deque(maxlen=history)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+def observe(name, seconds):
+    """
+    Records the duration of a stage.
+
+    Parameters:
+    name (str): The stage name, e.g. 'encode'.
+    seconds (float): The duration in seconds.
+    """
+    with _lock:
+        if name not in _stages:
+            _stages[name] = StageMetrics()
+        _stages[name].observe(seconds)
+
+    timings = _trace.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds * 1000
+
+
+def increment(name, value=1):
+    """
+    Increments a counter, e.g. the number of checks or of blocking index hits.
+
+    Parameters:
+    name (str): The counter name.
+    value (int, optional): The increment. Defaults to 1.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as a stage of the current check.
+
+    Parameters:
+    name (str): The stage name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+@contextmanager
+def trace():
+    """
+    Collects the stage durations of the calls made inside the block.
+
+    Yields:
+    dict: The duration of every stage in milliseconds, filled in as the stages complete.
+    """
+    timings = {}
+    token = _trace.set(timings)
+    try:
+        yield timings
+    finally:
+        _trace.reset(token)
+
+
+def instrumented(name):
+    """
+    Decorates a function so that each call is timed as a stage.
+
+    The outermost instrumented call of a check also collects the durations of its nested stages, logs them
+    as one JSON line on the 'customer_deduplication' logger (at DEBUG level) and, when DEDUP_PROFILE_DIR is set,
+    runs under cProfile and dumps its profile there. Every stage is a named function of its own, so py-spy
+    flame graphs line up with the stage names.
+
+    Parameters:
+    name (str): The stage name of the function.
+
+    Returns:
+    callable: The decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _outermost.get() is not None:
+                with stage(name):
+                    return func(*args, **kwargs)
+
+            profiler = cProfile.Profile() if PROFILE_DIR else None
+            token = _outermost.set(name)
+            # Record into the trace opened by the caller, if any
+            timings_context = nullcontext(_trace.get()) if _trace.get() is not None else trace()
+            with timings_context as timings:
+                if profiler:
+                    profiler.enable()
+                try:
+                    with stage(name):
+                        return func(*args, **kwargs)
+                finally:
+                    _outermost.reset(token)
+                    if profiler:
+                        profiler.disable()
+                        os.makedirs(PROFILE_DIR, exist_ok=True)
+                        profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}-{time.time_ns()}.prof'))
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(json.dumps({'event': name, 'stages_ms': timings}))
+        return wrapper
+    return decorator
+
+
+def stage_summary():
+    """
+    Summarizes the recorded stages, for the debug panel of the app.
+
+    Returns:
+    dict: For every stage, the number of calls and the mean, p50, p95 and p99 duration in milliseconds
+          over its most recent calls.
+    """
+    with _lock:
+        stages = {name: (metrics.count, metrics.total, list(metrics.recent)) for name, metrics in _stages.items()}
+
+    summary = {}
+    for name, (count, total, recent) in stages.items():
+        p50, p95, p99 = (float(p) * 1000 for p in np.percentile(recent, [50, 95, 99]))
+        summary[name] = {'count': count, 'mean_ms': total / count * 1000, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+    return summary
+
+
+def counters():
+    """
+    Returns the current value of every counter.
+
+    Returns:
+    dict: The counters by name.
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def prometheus_text(gauges=None):
+    """
+    Renders the stage histograms and counters in the Prometheus text exposition format.
+
+    Parameters:
+    gauges (dict, optional): Additional gauges by name, e.g. cache sizes or hit rates.
+
+    Returns:
+    str: The metrics page.
+    """
+    lines = [
+        '# HELP dedup_stage_seconds Duration of the stages of a deduplication check.',
+        '# TYPE dedup_stage_seconds histogram',
+    ]
+    with _lock:
+        for name, metrics in sorted(_stages.items()):
+            for bound, count in zip(BUCKETS, metrics.buckets):
+                lines.append(f'dedup_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'dedup_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {metrics.count}')
+            lines.append(f'dedup_stage_seconds_sum{{stage="{name}"}} {metrics.total}')
+            lines.append(f'dedup_stage_seconds_count{{stage="{name}"}} {metrics.count}')
+
+        for name, value in sorted(_counters.items()):
+            lines.append(f'# TYPE dedup_{name}_total counter')
+            lines.append(f'dedup_{name}_total {value}')
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f'# TYPE dedup_{name} gauge')
+        lines.append(f'dedup_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """
+    Drops every recorded stage and counter.
+    """
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+def serve_metrics(port=9100, gauges=None):
+    """
+    Serves the metrics page on http://0.0.0.0:<port>/metrics from a background thread.
+
+    Parameters:
+    port (int, optional): The port to listen on. Defaults to 9100.
+    gauges (callable, optional): A function without arguments returning additional gauges by name.
+
+    Returns:
+    ThreadingHTTPServer: The running server; call `shutdown()` to stop it.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text(gauges() if gauges else None).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
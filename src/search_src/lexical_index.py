@@ -0,0 +1,278 @@
+import json
+import os
+import re
+from array import array
+from collections import Counter, defaultdict
+import numpy as np
+
+
+def char_ngrams(text, n=3):
+    """
+    Splits a text into the character n-grams of its words, each word padded with a space on both sides.
+
+    Phone digits, email local parts and postcodes share most of their n-grams with a typo'd or reformatted
+    version of themselves, which is what makes the n-grams match where the sentence embedding does not.
+
+    Parameters:
+    text (str): The text, e.g. the 'details' of a customer.
+    n (int, optional): The n-gram length. Defaults to 3.
+
+    Returns:
+    list: The n-grams, with repetitions.
+    """
+    grams = []
+    for word in re.findall(r'[^\W_]+', str(text).lower()):
+        padded = f' {word} '
+        grams.extend(padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+    return grams
+
+
+def reciprocal_rank_fusion(rankings, n=5, k=60):
+    """
+    Fuses several rankings of the same items by the sum of 1 / (k + rank) of every item.
+
+    Parameters:
+    rankings (list): The rankings, each a list of item ids from best to worst.
+    n (int, optional): The number of fused items to return. Defaults to 5.
+    k (int, optional): The rank offset, which damps the weight of the top ranks. Defaults to 60.
+
+    Returns:
+    tuple: The n best item ids and their fused scores, sorted by score in descending order.
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] += 1.0 / (k + rank)
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n]
+    return [item for item, _ in best], [score for _, score in best]
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the character n-grams of the customer details.
+
+    The postings are kept in compressed sparse row arrays (document positions and term frequencies sorted by term),
+    so millions of customers fit in memory. Customers added one at a time go to a small delta index which is merged
+    into the arrays once it holds `merge_every` customers. It has the `search` interface of the indexes in
+    `ann_index.py`, with search terms instead of vectors as queries.
+
+    N-grams found in more than `max_df` of the customers (such as those of 'web.de') say nothing about a customer
+    and are skipped at query time, like the oversized blocks of the blocking index.
+    """
+
+    def __init__(self, ngram=3, k1=1.2, b=0.75, max_df=0.05, merge_every=10000):
+        self.ngram = ngram
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df
+        self.merge_every = merge_every
+        self.vocabulary = {}
+        self.ids = np.array([], dtype=object)
+        self.doc_lengths = np.zeros(0, dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.docs = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.float32)
+        self._delta = defaultdict(list)
+        self._delta_docs = 0
+
+    def add(self, ids, texts):
+        """
+        Adds customers to the index.
+
+        Parameters:
+        ids (list): The customer ids.
+        texts (list): The texts to index, e.g. the 'details' of the customers, aligned with `ids`.
+        """
+        start = len(self.ids)
+        term_ids, docs, tfs, lengths = array('q'), array('i'), array('f'), array('f')
+        for position, text in enumerate(texts, start=start):
+            grams = Counter(char_ngrams(text or '', self.ngram))
+            lengths.append(sum(grams.values()))
+            for gram, count in grams.items():
+                term_ids.append(self.vocabulary.setdefault(gram, len(self.vocabulary)))
+                docs.append(position)
+                tfs.append(count)
+
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        self.doc_lengths = np.concatenate([self.doc_lengths, np.frombuffer(lengths, dtype=np.float32)])
+        if len(texts) >= self.merge_every or self._delta_docs + len(texts) >= self.merge_every:
+            self._merge(np.frombuffer(term_ids, dtype=np.int64), np.frombuffer(docs, dtype=np.int32), np.frombuffer(tfs, dtype=np.float32))
+        else:
+            for term_id, doc, tf in zip(term_ids, docs, tfs):
+                self._delta[term_id].append((doc, tf))
+            self._delta_docs += len(texts)
+
+    def _merge(self, term_ids=None, docs=None, tfs=None):
+        # Rebuild the arrays from the existing postings, the delta and the new postings, sorted by term
+        existing_terms = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int64), np.diff(self.offsets))
+        delta = [(term_id, doc, tf) for term_id, postings in self._delta.items() for doc, tf in postings]
+        delta = np.array(delta, dtype=np.float64).reshape(-1, 3)
+        all_terms = np.concatenate([existing_terms, delta[:, 0].astype(np.int64), term_ids if term_ids is not None else []]).astype(np.int64)
+        all_docs = np.concatenate([self.docs, delta[:, 1].astype(np.int32), docs if docs is not None else []]).astype(np.int32)
+        all_tfs = np.concatenate([self.tfs, delta[:, 2].astype(np.float32), tfs if tfs is not None else []]).astype(np.float32)
+
+        order = np.argsort(all_terms, kind='stable')
+        self.docs, self.tfs = all_docs[order], all_tfs[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(all_terms, minlength=len(self.vocabulary)))]).astype(np.int64)
+        self._delta = defaultdict(list)
+        self._delta_docs = 0
+
+    def _postings(self, term_id):
+        # Terms first seen since the last merge only have postings in the delta
+        start, end = (self.offsets[term_id], self.offsets[term_id + 1]) if term_id + 1 < len(self.offsets) else (0, 0)
+        docs, tfs = self.docs[start:end], self.tfs[start:end]
+        delta = self._delta.get(term_id)
+        if delta:
+            delta = np.array(delta, dtype=np.float64)
+            docs = np.concatenate([docs, delta[:, 0].astype(np.int32)])
+            tfs = np.concatenate([tfs, delta[:, 1].astype(np.float32)])
+        return docs, tfs
+
+    def search(self, queries, n=5):
+        """
+        Finds the n customers with the highest BM25 score of every query.
+
+        Parameters:
+        queries (list): The search terms.
+        n (int, optional): Number of customers to return per query. Defaults to 5.
+
+        Returns:
+        tuple: A list with the customer ids of every query and a list with their BM25 scores.
+        """
+        count = len(self.ids)
+        average_length = float(self.doc_lengths.mean()) if count else 0.0
+        ids, scores = [], []
+        for query in queries:
+            all_docs, all_weights = [], []
+            for gram, query_count in Counter(char_ngrams(query, self.ngram)).items():
+                term_id = self.vocabulary.get(gram)
+                if term_id is None:
+                    continue
+                docs, tfs = self._postings(term_id)
+                if len(docs) == 0 or len(docs) > max(self.max_df * count, 1):
+                    continue
+                idf = np.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / average_length)
+                all_docs.append(docs)
+                all_weights.append(query_count * idf * tfs * (self.k1 + 1) / (tfs + norm))
+
+            if not all_docs:
+                ids.append([])
+                scores.append([])
+                continue
+            docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+            totals = np.bincount(inverse, weights=np.concatenate(all_weights))
+            k = min(n, len(docs))
+            best = np.argpartition(-totals, k - 1)[:k]
+            best = best[np.argsort(-totals[best])]
+            ids.append(list(self.ids[docs[best]]))
+            scores.append(totals[best].tolist())
+        return ids, scores
+
+    def save(self, path):
+        """
+        Persists the index to a directory.
+
+        Parameters:
+        path (str): The directory to write the index to. It is created if it does not exist.
+        """
+        self._merge()
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'ngram': self.ngram, 'k1': self.k1, 'b': self.b, 'max_df': self.max_df, 'merge_every': self.merge_every}, f)
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez(
+            os.path.join(path, 'postings.npz'), terms=np.array(terms, dtype=str), ids=self.ids.astype(str),
+            doc_lengths=self.doc_lengths, offsets=self.offsets, docs=self.docs, tfs=self.tfs,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index persisted with `save`.
+
+        Parameters:
+        path (str): The directory the index was written to.
+
+        Returns:
+        LexicalIndex: The loaded index.
+        """
+        with open(os.path.join(path, 'index.json')) as f:
+            index = cls(**json.load(f))
+        with np.load(os.path.join(path, 'postings.npz')) as arrays:
+            index.vocabulary = {term: term_id for term_id, term in enumerate(arrays['terms'].tolist())}
+            index.ids = arrays['ids'].astype(object)
+            index.doc_lengths = arrays['doc_lengths']
+            index.offsets, index.docs, index.tfs = arrays['offsets'], arrays['docs'], arrays['tfs']
+        return index
+
+
+def build_lexical_index(db, path=None, batch_size=10000):
+    """
+    Builds the lexical index of the 'details' of every customer of the collection, streaming the customers.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    path (str, optional): The directory to persist the index to. Defaults to not persisting it.
+    batch_size (int, optional): The number of customers indexed at once. Defaults to 10000.
+
+    Returns:
+    LexicalIndex: The index.
+    """
+    from src.search_src.create_superduperdb import iter_customers
+
+    index = LexicalIndex()
+    ids, texts = [], []
+    for r in iter_customers(db, fields=['details']):
+        ids.append(r['_id'])
+        texts.append(r.get('details') or '')
+        if len(ids) == batch_size:
+            index.add(ids, texts)
+            ids, texts = [], []
+    if ids:
+        index.add(ids, texts)
+    if path:
+        index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    # Compare how often the customer a duplicate was made from is among the n first results of each retrieval mode
+    import argparse
+    import time
+    from src.benchmark.dedup_benchmark import generate_benchmark_data
+    from src.search_src.async_service import build_search_term
+
+    parser = argparse.ArgumentParser(description='Recall of the source customer of typo\'d duplicates per retrieval mode.')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=20, help='number of customers of each ranking fused in the hybrid mode')
+    parser.add_argument('--lexical-only', action='store_true', help='skip the vector and hybrid modes, which load the encoder')
+    args = parser.parse_args()
+
+    customers, duplicates, _ = generate_benchmark_data(args.rows)
+    queries = [build_search_term(d) for d in duplicates]
+    sources = [d['source'] for d in duplicates]
+
+    start = time.perf_counter()
+    index = LexicalIndex()
+    index.add([c['row'] for c in customers], [c['details'] for c in customers])
+    print(f'indexed {len(customers)} customers in {time.perf_counter() - start:.2f}s, {len(index.vocabulary)} n-grams')
+    start = time.perf_counter()
+    lexical, _ = index.search(queries, n=args.depth)
+    print(f'lexical search: {1000 * (time.perf_counter() - start) / len(queries):.2f} ms/query')
+    rankings = {'lexical': lexical}
+
+    if not args.lexical_only:
+        from src.search_src.create_superduperdb import load_encoder
+
+        encoder = load_encoder()
+        vectors = encoder.encode([c['details'] for c in customers], batch_size=256, normalize_embeddings=True)
+        query_vectors = encoder.encode(queries, batch_size=256, normalize_embeddings=True)
+        vector = np.argsort(-(query_vectors @ vectors.T), axis=1)[:, :args.depth].tolist()
+        rankings['vector'] = vector
+        rankings['hybrid'] = [reciprocal_rank_fusion([v, w], n=args.depth)[0] for v, w in zip(vector, lexical)]
+
+    for mode, ranking in rankings.items():
+        print(mode, ' '.join(
+            f'recall@{n}={np.mean([source in ids[:n] for source, ids in zip(sources, ranking)]):.3f}' for n in (1, 2, 5, 20)
+        ))
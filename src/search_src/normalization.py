@@ -0,0 +1,142 @@
+import hashlib
+import json
+import math
+import re
+
+NORMALIZED_FIELD = 'normalized'
+CUSTOMER_KEY_FIELD = 'customer_key'
+
+
+def is_missing(value):
+    """
+    Checks whether a field value is missing, i.e. None, NaN as produced by pandas, or a blank string as submitted
+    by an empty form field.
+
+    Parameters:
+    value: The field value.
+
+    Returns:
+    bool: True if the value is missing.
+    """
+    return value is None or (isinstance(value, float) and math.isnan(value)) or (isinstance(value, str) and not value.strip())
+
+
+def normalize_phone(phone_number):
+    """
+    Normalizes a phone number to its digits, after the same transformation the generated customers went through.
+
+    Parameters:
+    phone_number (str): The phone number as typed in.
+
+    Returns:
+    str: The digits of the phone number, or None if it has none.
+    """
+    # general_data sets up a Faker instance on import, which only the data generation needs
+    from src.data_generation.general_data import transform_phone_number
+
+    if is_missing(phone_number):
+        return None
+    return re.sub(r'\D', '', transform_phone_number(str(phone_number))) or None
+
+
+def name_tokens(full_name):
+    """
+    Splits a full name into lower-cased tokens, without the dots of abbreviations.
+
+    Parameters:
+    full_name (str): The full name, e.g. 'G. Herrmann'.
+
+    Returns:
+    list: The tokens in their original order, e.g. ['g', 'herrmann'].
+    """
+    if is_missing(full_name):
+        return []
+    return [token for token in re.sub(r'[.,]', ' ', str(full_name).lower()).split() if token]
+
+
+def split_address(address):
+    """
+    Splits a German address into its street part and its postcode.
+
+    Parameters:
+    address (str): The address, e.g. 'Hauptstr. 5 42130 Neubrandenburg'.
+
+    Returns:
+    tuple: The lower-cased street tokens before the postcode and the postcode (None if there is none).
+    """
+    tokens = str(address).lower().split()
+    for position, token in enumerate(tokens):
+        if re.fullmatch(r'\d{5}', token):
+            return tokens[:position], token
+    return tokens, None
+
+
+def normalize_customer(record):
+    """
+    Computes the comparison fields of a customer once, so that the reranker does not redo the string preparation per pair.
+
+    Parameters:
+    record (dict): A dictionary with the 'Full Name', 'Email', 'Address' and 'Phone Number' of a customer.
+
+    Returns:
+    dict: The normalized fields:
+          - 'name': the lower-cased name tokens sorted alphabetically, so that swapped first and last names are equal
+          - 'name_tokens': the lower-cased name tokens in their original order, to match abbreviations
+          - 'email_local' and 'email_domain': the lower-cased parts of the email address
+          - 'address': the lower-cased address with single spaces
+          - 'street' and 'postcode': the street tokens and the postcode of the address
+          - 'phone': the digits of the canonical phone number
+          Missing fields are None.
+    """
+    tokens = name_tokens(record.get('Full Name'))
+
+    email = record.get('Email')
+    email_local, email_domain = None, None
+    if not is_missing(email):
+        email_local, _, email_domain = str(email).strip().lower().partition('@')
+
+    address = record.get('Address')
+    street, postcode = (None, None) if is_missing(address) else split_address(address)
+
+    return {
+        'name': ' '.join(sorted(tokens)) or None,
+        'name_tokens': tokens,
+        'email_local': email_local or None,
+        'email_domain': email_domain or None,
+        'address': None if is_missing(address) else ' '.join(str(address).lower().split()),
+        'street': ' '.join(street) if street else None,
+        'postcode': postcode,
+        'phone': normalize_phone(record.get('Phone Number')),
+    }
+
+
+def normalized_fields(record):
+    """
+    Returns the stored comparison fields of a customer, computing them if the customer was stored without them.
+
+    Parameters:
+    record (dict): A customer record, with or without its NORMALIZED_FIELD.
+
+    Returns:
+    dict: The normalized fields, see `normalize_customer`.
+    """
+    normalized = record.get(NORMALIZED_FIELD)
+    if isinstance(normalized, dict):
+        return normalized
+    return normalize_customer(record)
+
+
+def customer_key(record):
+    """
+    Computes a stable key of a customer from its normalized fields, so that loading the same customer twice
+    updates one document instead of inserting a second one.
+
+    Parameters:
+    record (dict): A customer record, with or without its NORMALIZED_FIELD.
+
+    Returns:
+    str: The hex SHA-1 digest of the normalized name, email, address and phone number.
+    """
+    normalized = normalized_fields(record)
+    fields = [normalized[field] for field in ('name', 'email_local', 'email_domain', 'address', 'phone')]
+    return hashlib.sha1(json.dumps(fields).encode()).hexdigest()
@@ -0,0 +1,142 @@
+import os
+import numpy as np
+
+
+def export_onnx(model_identifier, output_dir, quantize=True):
+    """
+    Exports a sentence transformer to ONNX and, optionally, quantizes its weights to int8.
+
+    Needs torch, transformers and onnxruntime, which are only required when the 'onnx' encoder backend is used.
+
+    Parameters:
+    model_identifier (str): Identifier of the sentence transformer, e.g. 'all-MiniLM-L6-v2'.
+    output_dir (str): The directory to write 'model.onnx' (and 'model.int8.onnx') and the tokenizer to.
+    quantize (bool, optional): Whether to write the dynamically int8-quantized model as well. Defaults to True.
+
+    Returns:
+    str: The path of the model to serve, the quantized one if `quantize` is set.
+    """
+    import sentence_transformers
+    import torch
+
+    # SentenceTransformer[0] is the Hugging Face transformer; pooling and normalization are done by OnnxEncoder
+    transformer = sentence_transformers.SentenceTransformer(model_identifier, device='cpu')[0]
+    os.makedirs(output_dir, exist_ok=True)
+    transformer.tokenizer.save_pretrained(output_dir)
+
+    inputs = transformer.tokenizer(['an example customer'], return_tensors='pt')
+    input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+    dynamic_axes = {name: {0: 'batch', 1: 'tokens'} for name in input_names + ['last_hidden_state']}
+    model_path = os.path.join(output_dir, 'model.onnx')
+    torch.onnx.export(
+        transformer.auto_model.eval(),
+        tuple(inputs[name] for name in input_names),
+        model_path,
+        input_names=input_names,
+        output_names=['last_hidden_state'],
+        dynamic_axes=dynamic_axes,
+        opset_version=14,
+    )
+    if not quantize:
+        return model_path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = os.path.join(output_dir, 'model.int8.onnx')
+    quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+class OnnxEncoder:
+    """
+    CPU inference of an exported sentence transformer with onnxruntime.
+
+    It offers the `encode` and `get_sentence_embedding_dimension` methods of `SentenceTransformer`, so it can be used
+    as the object of the superduperdb `Model` with `predict_method='encode'` and everywhere `load_encoder` is used.
+    The embeddings are mean-pooled over the tokens and normalized to unit length, like 'all-MiniLM-L6-v2'.
+
+    The inference session cannot be pickled, so it is opened again from `model_path` when the encoder is
+    loaded back from the artifact store.
+    """
+
+    def __init__(self, model_path, threads=None, max_seq_length=256):
+        self.model_path = model_path
+        self.threads = threads
+        self.max_seq_length = max_seq_length
+        self._load()
+
+    def _load(self):
+        try:
+            import onnxruntime
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("The 'onnx' encoder backend needs onnxruntime and transformers: pip install onnxruntime transformers") from e
+
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        self.session = onnxruntime.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(self.model_path))
+
+    def __getstate__(self):
+        return {'model_path': self.model_path, 'threads': self.threads, 'max_seq_length': self.max_seq_length}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def get_sentence_embedding_dimension(self):
+        return self.session.get_outputs()[0].shape[-1]
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        """
+        Encodes one or several sentences.
+
+        Parameters:
+        sentences (str or list): A sentence or a list of sentences.
+        batch_size (int, optional): The number of sentences run through the model at once. Defaults to 32.
+        **kwargs: Other `SentenceTransformer.encode` arguments, which are ignored.
+
+        Returns:
+        ndarray: The float32 embedding of the sentence, or a (len(sentences), dimensions) matrix of embeddings.
+        """
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+
+        # Sort by length so that each batch is padded as little as possible
+        order = np.argsort([len(s) for s in sentences])
+        embeddings = np.zeros((len(sentences), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            positions = order[start:start + batch_size]
+            inputs = self.tokenizer(
+                [sentences[p] for p in positions], padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors='np',
+            )
+            feed = {name: inputs[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, feed)[0]
+
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            embeddings[positions] = pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+        return embeddings[0] if single else embeddings
+
+
+def load_onnx_encoder(model_identifier, model_dir, threads=None, quantize=True):
+    """
+    Loads the ONNX encoder of a sentence transformer, exporting (and quantizing) it first if it is not in `model_dir`.
+
+    Parameters:
+    model_identifier (str): Identifier of the sentence transformer, e.g. 'all-MiniLM-L6-v2'.
+    model_dir (str): The directory holding the exported model and its tokenizer.
+    threads (int, optional): The number of intra-op threads of onnxruntime. Defaults to onnxruntime's choice.
+    quantize (bool, optional): Whether to serve the int8-quantized model. Defaults to True.
+
+    Returns:
+    OnnxEncoder: The encoder.
+    """
+    model_path = os.path.join(model_dir, 'model.int8.onnx' if quantize else 'model.onnx')
+    if not os.path.exists(model_path):
+        model_path = export_onnx(model_identifier, model_dir, quantize=quantize)
+    return OnnxEncoder(model_path, threads=threads)
@@ -0,0 +1,165 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+
+
+class QueryBatcher:
+    """
+    Coalesces search terms submitted by concurrent callers into batched encode calls.
+
+    A background thread takes the first pending search term, waits up to `max_wait_ms` for more (or until
+    `max_batch_size` terms are pending), encodes them with a single call of `encode` and hands every caller
+    its own vector back. A lone search term therefore pays at most `max_wait_ms` of extra latency, while a burst
+    of searches is encoded several times faster than one term at a time.
+
+    It records the batch sizes and the queueing delay of every search term, see `stats()`.
+    """
+
+    def __init__(self, encode, max_batch_size=64, max_wait_ms=5, history=10000):
+        self.encode_batch = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batches = 0
+        self.items = 0
+        self.batch_sizes = deque(maxlen=history)
+        self.queue_delays_ms = deque(maxlen=history)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='query-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, search_term):
+        """
+        Queues a search term for the next batch.
+
+        Parameters:
+        search_term (str): The normalized search term.
+
+        Returns:
+        Future: A future resolving to the embedding of the search term.
+        """
+        if self._closed:
+            raise RuntimeError('The query batcher is closed')
+        future = Future()
+        self._queue.put((search_term, future, time.perf_counter()))
+        return future
+
+    def encode(self, search_term):
+        """
+        Encodes a search term as part of the next batch and waits for its embedding.
+
+        Parameters:
+        search_term (str): The normalized search term.
+
+        Returns:
+        list: The embedding of the search term.
+        """
+        return self.submit(search_term).result()
+
+    def _next_batch(self):
+        """
+        Waits for a search term, then collects the terms submitted within `max_wait_ms` of it.
+        """
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Encode what is pending before stopping
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            started = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.batch_sizes.append(len(batch))
+                self.queue_delays_ms.extend((started - submitted) * 1000 for _, _, submitted in batch)
+
+            try:
+                vectors = self.encode_batch([search_term for search_term, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        """
+        Returns the batching metrics.
+
+        Returns:
+        dict: The number of batches and encoded search terms, the mean and maximum batch size and the p50, p95 and p99
+              queueing delay in milliseconds, over the last `history` batches and search terms.
+        """
+        with self._lock:
+            sizes = list(self.batch_sizes)
+            delays = list(self.queue_delays_ms)
+            stats = {
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': float(np.mean(sizes)) if sizes else 0.0,
+                'max_batch_size': max(sizes, default=0),
+            }
+        p50, p95, p99 = (float(p) for p in np.percentile(delays, [50, 95, 99])) if delays else (0.0, 0.0, 0.0)
+        stats.update({'queue_delay_p50_ms': p50, 'queue_delay_p95_ms': p95, 'queue_delay_p99_ms': p99})
+        return stats
+
+    def close(self):
+        """
+        Stops the background thread after the pending search terms are encoded.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+    from src.search_src.create_superduperdb import load_encoder
+
+    parser = argparse.ArgumentParser(description='Compare one-at-a-time and micro-batched query encoding.')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    encoder = load_encoder('all-MiniLM-L6-v2')
+    terms = [f'customer {i} street {i % 97} city {i % 13}' for i in range(args.queries)]
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda term: encoder.encode(term), terms))
+        single_seconds = time.perf_counter() - start
+
+        batcher = QueryBatcher(lambda batch: encoder.encode(batch, batch_size=len(batch)), args.max_batch_size, args.max_wait_ms)
+        start = time.perf_counter()
+        list(pool.map(batcher.encode, terms))
+        batched_seconds = time.perf_counter() - start
+        batcher.close()
+
+    print(f'one at a time: {args.queries / single_seconds:.0f} encodings/s')
+    print(f'micro-batched: {args.queries / batched_seconds:.0f} encodings/s')
+    print(batcher.stats())
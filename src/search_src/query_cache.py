@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded least-recently-used cache with an optional time to live.
+
+    It counts hits, misses and evictions so that its size can be tuned from `stats()`.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value of a key and marks it as recently used.
+
+        Parameters:
+        key: The cache key.
+
+        Returns:
+        The cached value, or None if the key is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        Caches a value, evicting the least recently used entries beyond `maxsize`.
+
+        Parameters:
+        key: The cache key.
+        value: The value to cache.
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drops every cached entry (the counters are kept).
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the usage counters of the cache.
+
+        Returns:
+        dict: The number of hits, misses and evictions, the hit rate and the current and maximum size.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+
+def normalize_search_term(search_term):
+    """
+    Normalizes a search term into the key of its cache entries, so that resubmissions of the same details share them.
+
+    The term is lower-cased (as `home()` in `app.py` does) and runs of whitespace, e.g. from empty form fields,
+    are collapsed into single spaces. Only the cache keys are normalized: the search term itself is encoded as
+    given, in the format of the stored 'details' (see `create_superduperdb.build_details`), whose embeddings
+    it is compared with.
+
+    Parameters:
+    search_term (str): The search term built from the form fields.
+
+    Returns:
+    str: The cache key of the search term.
+    """
+    return ' '.join(search_term.lower().split())
+
+
+# Embeddings of search terms, by normalized search term. They only depend on the model, so they stay valid when customers are added.
+query_embeddings = LRUCache(maxsize=10000)
+
+# Nearest neighbours of search terms, by normalized search term. They are cleared whenever customers are added,
+# and expire after a while so that changes made outside of this process are picked up.
+query_results = LRUCache(maxsize=10000, ttl=600)
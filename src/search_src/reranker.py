@@ -0,0 +1,329 @@
+import jellyfish
+import numpy as np
+from src.search_src.normalization import NORMALIZED_FIELD, is_missing, normalized_fields
+
+SIMILARITY_COLUMNS = ['Phone Number', 'Full Name', 'Email', 'Address']
+STRING_COLUMNS = ['Full Name', 'Email', 'Address']
+
+# Order in which the short-circuit rerank tries the fields, after their exact checks: the email and the name
+# are the most discriminating string fields, the long address the most expensive one
+SHORT_CIRCUIT_ORDER = ['Phone Number', 'Email', 'Full Name', 'Address']
+
+
+def _levenshtein_similarity(s1, s2):
+    return 1 - jellyfish.levenshtein_distance(s1, s2) / max(len(s1), len(s2))
+
+
+def _damerau_levenshtein_similarity(s1, s2):
+    return 1 - jellyfish.damerau_levenshtein_distance(s1, s2) / max(len(s1), len(s2))
+
+
+# The same jellyfish functions (and normalisation) recordlinkage uses for its string comparisons
+STRING_SIMILARITIES = {
+    'jaro': jellyfish.jaro_similarity,
+    'jarowinkler': jellyfish.jaro_winkler_similarity,
+    'jaro_winkler': jellyfish.jaro_winkler_similarity,
+    'jw': jellyfish.jaro_winkler_similarity,
+    'levenshtein': _levenshtein_similarity,
+    'damerau_levenshtein': _damerau_levenshtein_similarity,
+    'dameraulevenshtein': _damerau_levenshtein_similarity,
+    'dl': _damerau_levenshtein_similarity,
+}
+
+
+def _names_match(a, b, similarity, threshold):
+    # Token-sorted names are equal when first and last name are swapped
+    if a['name'] is None or b['name'] is None:
+        return False
+    if a['name'] == b['name'] or similarity(a['name'], b['name']) >= threshold:
+        return True
+
+    # 'g. herrmann' matches 'gesche herrmann': every token is equal or the initial of the other,
+    # and at least one full token is shared
+    tokens_a, tokens_b = a['name_tokens'], b['name_tokens']
+    if len(tokens_a) != len(tokens_b):
+        return False
+    shared = False
+    for x, y in zip(tokens_a, tokens_b):
+        if x == y:
+            shared = shared or len(x) > 1
+        elif not (len(x) == 1 and y.startswith(x) or len(y) == 1 and x.startswith(y)):
+            return False
+    return shared
+
+
+def _emails_match(a, b, similarity, threshold):
+    # A typo is either in the local part or in the domain, the other part is equal
+    if None in (a['email_local'], a['email_domain'], b['email_local'], b['email_domain']):
+        return False
+    if a['email_local'] == b['email_local']:
+        return a['email_domain'] == b['email_domain'] or similarity(a['email_domain'], b['email_domain']) >= threshold
+    if a['email_domain'] == b['email_domain']:
+        return similarity(a['email_local'], b['email_local']) >= threshold
+    return False
+
+
+def _addresses_match(a, b, similarity, threshold):
+    if a['address'] is None or b['address'] is None:
+        return False
+    if a['address'] == b['address']:
+        return True
+    if a['postcode'] is not None and a['postcode'] == b['postcode'] and a['street'] is not None and b['street'] is not None:
+        if a['street'] == b['street'] or similarity(a['street'], b['street']) >= threshold:
+            return True
+    return similarity(a['address'], b['address']) >= threshold
+
+
+def compare_normalized_pairs(left_records, right_records, method='jarowinkler', threshold=0.85):
+    """
+    Computes the comparison features of aligned pairs of records from their normalized fields.
+
+    It reads the fields stored at ingest (see `normalization.py`) instead of the raw strings: phone numbers
+    are compared in their canonical form, names token-sorted and by initials, so that swapped and abbreviated
+    names match, emails part by part and addresses by postcode and street. Equal fields are matched without
+    computing any string similarity.
+
+    Parameters:
+    left_records (list): A list of dictionaries with the customer fields or their normalized fields.
+    right_records (list): A list of dictionaries with the customer fields or their normalized fields, aligned with `left_records`.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+
+    Returns:
+    ndarray: A float array of shape (len(left_records), 4) with one column per field of SIMILARITY_COLUMNS.
+    """
+    if method not in STRING_SIMILARITIES:
+        raise ValueError(f"The algorithm '{method}' is not known.")
+    similarity = STRING_SIMILARITIES[method]
+
+    features = np.zeros((len(left_records), len(SIMILARITY_COLUMNS)), dtype=np.float64)
+    for row, (left, right) in enumerate(zip(left_records, right_records)):
+        a, b = normalized_fields(left), normalized_fields(right)
+        features[row] = [
+            a['phone'] is not None and a['phone'] == b['phone'],
+            _names_match(a, b, similarity, threshold),
+            _emails_match(a, b, similarity, threshold),
+            _addresses_match(a, b, similarity, threshold),
+        ]
+    return features
+
+
+def compare_pairs(left_records, right_records, method='jarowinkler', threshold=0.85):
+    """
+    Computes the comparison features of aligned pairs of records in one pass.
+
+    The features follow the rules of `build_comparison` exactly: an exact comparison of the phone number and
+    thresholded string similarities of the full name, email and address, where a missing value scores 0. Blank
+    strings are missing too (see `is_missing`), where recordlinkage would match two empty phone numbers or two
+    whitespace-only strings; the short-circuit rerank relies on this to give the same matches.
+
+    Parameters:
+    left_records (list): A list of dictionaries with the customer fields.
+    right_records (list): A list of dictionaries with the customer fields, aligned with `left_records`.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+
+    Returns:
+    ndarray: A float array of shape (len(left_records), 4) with one column per field of SIMILARITY_COLUMNS.
+    """
+    if method not in STRING_SIMILARITIES:
+        raise ValueError(f"The algorithm '{method}' is not known.")
+    similarity = STRING_SIMILARITIES[method]
+
+    features = np.zeros((len(left_records), len(SIMILARITY_COLUMNS)), dtype=np.float64)
+    for column, field in enumerate(SIMILARITY_COLUMNS):
+        left = [r.get(field) for r in left_records]
+        right = [r.get(field) for r in right_records]
+        if field in STRING_COLUMNS:
+            scores = [
+                0.0 if is_missing(a) or is_missing(b) else similarity(a, b)
+                for a, b in zip(left, right)
+            ]
+            features[:, column] = np.asarray(scores) >= threshold
+        else:
+            features[:, column] = [
+                not (is_missing(a) or is_missing(b)) and a == b
+                for a, b in zip(left, right)
+            ]
+    return features
+
+
+NORMALIZED_MATCHERS = {'Full Name': _names_match, 'Email': _emails_match, 'Address': _addresses_match}
+
+
+def _comparison_keys(record, normalized, order):
+    # The values compared exactly, in `order`, with None for missing values
+    if not normalized:
+        return [None if is_missing(record.get(field)) else record.get(field) for field in order]
+    local_part, domain = record['email_local'], record['email_domain']
+    # In the order of SIMILARITY_COLUMNS
+    values = (record['phone'], record['name'], None if local_part is None or domain is None else (local_part, domain), record['address'])
+    return [values[SIMILARITY_COLUMNS.index(field)] for field in order]
+
+
+def _string_checks(order, normalized):
+    # The string fields in `order`, with their position in the comparison keys and their normalized matcher
+    return [(position, field, NORMALIZED_MATCHERS[field] if normalized else None) for position, field in enumerate(order) if field in STRING_COLUMNS]
+
+
+def _first_match(target, target_keys, candidate, candidate_keys, similarity, threshold, order, string_checks):
+    for field, x, y in zip(order, target_keys, candidate_keys):
+        if x is not None and x == y:
+            return field
+    for position, field, matcher in string_checks:
+        if matcher is not None:
+            if matcher(target, candidate, similarity, threshold):
+                return field
+            continue
+        x, y = target_keys[position], candidate_keys[position]
+        if x is not None and y is not None and similarity(x, y) >= threshold:
+            return field
+    return None
+
+
+def first_matching_field(target, candidate, method='jarowinkler', threshold=0.85, normalized=False, order=SHORT_CIRCUIT_ORDER):
+    """
+    Returns the first field on which a candidate matches a target, computing as few comparisons as possible.
+
+    A single matching field makes a candidate a duplicate, so the comparison stops at the first match: the exact
+    checks of all fields run first, in `order`, and only then the string similarities of the fields which are not
+    equal. Whether a candidate matches is the same as with `compare_pairs` (or `compare_normalized_pairs`),
+    since equal strings have a similarity of 1.
+
+    Parameters:
+    target (dict): A dictionary with the customer fields.
+    candidate (dict): A dictionary with the customer fields.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+    normalized (bool, optional): Whether to compare the normalized fields, see `compare_normalized_pairs`. Defaults to False.
+    order (list, optional): The fields of SIMILARITY_COLUMNS in the order they are tried. Defaults to SHORT_CIRCUIT_ORDER.
+
+    Returns:
+    str: The field which decided the match, or None if the candidate matches on no field.
+    """
+    if normalized:
+        target, candidate = normalized_fields(target), normalized_fields(candidate)
+    return _first_match(
+        target, _comparison_keys(target, normalized, order), candidate, _comparison_keys(candidate, normalized, order),
+        STRING_SIMILARITIES[method], threshold, order, _string_checks(order, normalized),
+    )
+
+
+def short_circuit_candidates(target_records, candidate_records, method='jarowinkler', threshold=0.85, normalized=False, order=SHORT_CIRCUIT_ORDER):
+    """
+    Returns the positions of the candidates that match a target on at least one field, stopping the comparison
+    of every pair at its first matching field (see `first_matching_field`).
+
+    It returns the same positions as `similar_candidates`, without computing the comparisons which cannot change
+    the outcome; use `compare_block` when the features of every field are needed, e.g. for an audit.
+
+    Parameters:
+    target_records (list): A list of N dictionaries with the customer fields.
+    candidate_records (list): A list of k dictionaries with the customer fields.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+    normalized (bool, optional): Whether to compare the normalized fields, see `compare_block`. Defaults to False.
+    order (list, optional): The order in which the fields are tried. Defaults to SHORT_CIRCUIT_ORDER.
+
+    Returns:
+    list: The matching candidate positions, target by target, in candidate order.
+    """
+    if method not in STRING_SIMILARITIES:
+        raise ValueError(f"The algorithm '{method}' is not known.")
+    if sorted(order) != sorted(SIMILARITY_COLUMNS):
+        raise ValueError(f"The comparison order must be a permutation of {SIMILARITY_COLUMNS}")
+    similarity = STRING_SIMILARITIES[method]
+
+    # Normalize every record and extract its exact comparison keys once, not once per pair
+    if normalized:
+        target_records = [normalized_fields(r) for r in target_records]
+        candidate_records = [normalized_fields(r) for r in candidate_records]
+    candidates = [(c, _comparison_keys(c, normalized, order)) for c in candidate_records]
+    string_checks = _string_checks(order, normalized)
+
+    positions = []
+    for target in target_records:
+        target_keys = _comparison_keys(target, normalized, order)
+        for position, (candidate, candidate_keys) in enumerate(candidates):
+            if _first_match(target, target_keys, candidate, candidate_keys, similarity, threshold, order, string_checks) is not None:
+                positions.append(position)
+    return positions
+
+
+def compare_block(target_records, candidate_records, method='jarowinkler', threshold=0.85, normalized=False):
+    """
+    Compares every target record with every candidate record, like a full recordlinkage index over both.
+
+    Parameters:
+    target_records (list): A list of N dictionaries with the customer fields.
+    candidate_records (list): A list of k dictionaries with the customer fields.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+    normalized (bool, optional): Whether to compare the normalized fields with `compare_normalized_pairs`
+                                 instead of the raw fields. Defaults to False.
+
+    Returns:
+    ndarray: A float array of shape (N, k, 4) with the comparison features of every (target, candidate) pair.
+    """
+    if normalized:
+        # Normalize every record once, not once per pair
+        target_records = [{NORMALIZED_FIELD: normalized_fields(r)} for r in target_records]
+        candidate_records = [{NORMALIZED_FIELD: normalized_fields(r)} for r in candidate_records]
+    left = [t for t in target_records for _ in candidate_records]
+    right = list(candidate_records) * len(target_records)
+    compare = compare_normalized_pairs if normalized else compare_pairs
+    features = compare(left, right, method=method, threshold=threshold)
+    return features.reshape(len(target_records), len(candidate_records), len(SIMILARITY_COLUMNS))
+
+
+def similar_candidates(target_records, candidate_records, method='jarowinkler', threshold=0.85, normalized=False):
+    """
+    Returns the positions of the candidates that match a target on at least one field.
+
+    Parameters:
+    target_records (list): A list of N dictionaries with the customer fields.
+    candidate_records (list): A list of k dictionaries with the customer fields.
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+    normalized (bool, optional): Whether to compare the normalized fields, see `compare_block`. Defaults to False.
+
+    Returns:
+    list: The candidate positions with a 'similarity_sum' of at least 1.0, target by target, in candidate order
+          (a candidate matching several targets is repeated, as with recordlinkage).
+    """
+    similarity_sum = compare_block(target_records, candidate_records, method=method, threshold=threshold, normalized=normalized).sum(axis=2)
+    return [int(position) for position in np.nonzero(similarity_sum >= 1.0)[1]]
+
+
+if __name__ == '__main__':
+    # The parity of the reranker with recordlinkage is checked by `python -m src.benchmark.parity_checks`
+    from src.data_generation.generate_database import main
+
+    # Compare how many generated duplicates each mode finds among the customer they were made from
+    df, sources = main(1000, 1000, return_sources=True)
+    customers, duplicates = df.iloc[:1000].to_dict('records'), df.iloc[1000:].to_dict('records')
+    pairs = [customers[source] for source in sources]
+    for normalized in (False, True):
+        compare = compare_normalized_pairs if normalized else compare_pairs
+        found = compare(duplicates, pairs).sum(axis=1) >= 1.0
+        print(f'normalized={normalized}: {found.mean():.3f} of the duplicates match their source')
+
+    # Check that the short-circuit rerank keeps the same candidates as the full comparison, and time both on
+    # windows like the nearest neighbours of a duplicate: its source and 4 other customers. The customers carry
+    # their normalized fields, as the customers fetched from MongoDB do, so that the timings of the normalized mode
+    # are those of the comparisons rather than of normalizing the candidates again for every window
+    import random
+    import time
+    from src.search_src.normalization import normalize_customer
+
+    customers = [{**customer, NORMALIZED_FIELD: normalize_customer(customer)} for customer in customers]
+    rng = random.Random(0)
+    windows = [[customers[source]] + rng.sample(customers, 4) for source in sources]
+    for normalized in (False, True):
+        timings, matches = {}, {}
+        for name, rerank in (('full', similar_candidates), ('short_circuit', short_circuit_candidates)):
+            start = time.perf_counter()
+            matches[name] = [rerank([duplicate], window, normalized=normalized) for duplicate, window in zip(duplicates, windows)]
+            timings[name] = time.perf_counter() - start
+        assert matches['full'] == matches['short_circuit']
+        print(f"normalized={normalized}: full {timings['full']:.2f}s, short-circuit {timings['short_circuit']:.2f}s for {len(windows)} windows, same matches")
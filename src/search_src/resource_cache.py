@@ -0,0 +1,113 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Long-lived resources (database handles, models and indexes), keyed by (kind, key)
+# where key starts with (mongodb_uri, artifact_store, model_identifier)
+_resources = {}
+_build_locks = {}
+_lock = threading.Lock()
+# How the resources of a kind holding processes, threads or files are released when they are invalidated
+_disposers = {}
+
+
+def register_disposer(kind, dispose):
+    """
+    Registers how the cached resources of a kind are released when `invalidate` drops them.
+
+    Resources which own worker processes or threads, e.g. the shard workers of a `ShardedIndex`, would otherwise
+    keep running after they are dropped from the cache.
+
+    Parameters:
+    kind (str): The kind of resource, e.g. 'sharded_index'.
+    dispose (callable): A function called with every dropped resource of this kind, e.g. one calling its `close`.
+    """
+    _disposers[kind] = dispose
+
+
+def get_cached(kind, key, factory):
+    """
+    Returns the cached resource of the given kind and key, building it with `factory` on the first call.
+
+    The cache lives as long as the process, so it survives Streamlit reruns. Concurrent callers asking for
+    the same resource wait for a single build instead of building it twice.
+
+    Parameters:
+    kind (str): The kind of resource, e.g. 'search_index', 'ann_index' or 'encoder'.
+    key (tuple): The key of the resource, starting with (mongodb_uri, artifact_store, model_identifier).
+    factory (callable): A function without arguments which builds the resource.
+
+    Returns:
+    The cached resource.
+    """
+    cache_key = (kind, key)
+    with _lock:
+        if cache_key in _resources:
+            return _resources[cache_key]
+        build_lock = _build_locks.setdefault(cache_key, threading.Lock())
+
+    with build_lock:
+        if cache_key not in _resources:
+            resource = factory()
+            with _lock:
+                _resources[cache_key] = resource
+    return _resources[cache_key]
+
+
+def cached_items(kind, mongodb_uri=None, artifact_store=None, model_identifier=None):
+    """
+    Lists the cached resources of the given kind, optionally only those of one database, artifact store or model.
+
+    Parameters:
+    kind (str): The kind of resource.
+    mongodb_uri (str, optional): Only list the resources of this MongoDB URI.
+    artifact_store (str, optional): Only list the resources of this artifact store.
+    model_identifier (str, optional): Only list the resources of this model.
+
+    Returns:
+    list: A list of (key, resource) tuples.
+    """
+    with _lock:
+        return [
+            (key, resource) for (resource_kind, key), resource in _resources.items()
+            if resource_kind == kind and _matches(key, mongodb_uri, artifact_store, model_identifier)
+        ]
+
+
+def invalidate(kind=None, mongodb_uri=None, artifact_store=None, model_identifier=None):
+    """
+    Drops cached resources so that they are built again on their next use.
+
+    Without arguments every resource is dropped; each argument narrows the invalidation down. The dropped resources
+    of a kind with a disposer (see `register_disposer`) are released once they are out of the cache, so a check
+    still using one may fail; a disposer which fails is logged and does not stop the others.
+
+    Parameters:
+    kind (str, optional): Only drop resources of this kind.
+    mongodb_uri (str, optional): Only drop the resources of this MongoDB URI.
+    artifact_store (str, optional): Only drop the resources of this artifact store.
+    model_identifier (str, optional): Only drop the resources of this model.
+
+    Returns:
+    int: The number of dropped resources.
+    """
+    with _lock:
+        dropped = [
+            cache_key for cache_key in _resources
+            if kind in (None, cache_key[0]) and _matches(cache_key[1], mongodb_uri, artifact_store, model_identifier)
+        ]
+        resources = [(cache_key[0], _resources.pop(cache_key)) for cache_key in dropped]
+
+    # Released outside the lock, since stopping e.g. worker processes takes a while
+    for resource_kind, resource in resources:
+        if resource_kind in _disposers:
+            try:
+                _disposers[resource_kind](resource)
+            except Exception:
+                logger.exception('Could not release a cached %s', resource_kind)
+    return len(dropped)
+
+
+def _matches(key, mongodb_uri, artifact_store, model_identifier):
+    return all(value is None or key[position] == value for position, value in enumerate([mongodb_uri, artifact_store, model_identifier]))
@@ -0,0 +1,370 @@
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import threading
+import zlib
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import numpy as np
+from src.search_src.ann_index import BruteForceIndex, build_ann_index, load_ann_index
+from src.search_src.normalization import is_missing
+
+# Number of shards of the 'sharded' backend, and how customers are assigned to them
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 4))
+SHARD_PARTITION = os.getenv('SHARD_PARTITION', 'postcode')
+# The most pending searches a shard worker answers with one stacked search
+SHARD_MAX_BATCH = int(os.getenv('SHARD_MAX_BATCH', 64))
+# How long a search or an add waits for the reply of a shard worker before failing
+SHARD_TIMEOUT_SECONDS = float(os.getenv('SHARD_TIMEOUT_SECONDS', 30))
+
+
+class ShardUnavailableError(RuntimeError):
+    """
+    Raised for the requests to a shard whose worker process stopped.
+    """
+
+
+def partition_key(record, partition='postcode'):
+    """
+    Returns the value a customer is partitioned on.
+
+    Parameters:
+    record (dict): A customer record with its 'Email' and 'Address'.
+    partition (str, optional): 'postcode' for the region of the postcode in the address (its first two digits),
+                               or 'email_domain' for the lower-cased domain of the email. Defaults to 'postcode'.
+
+    Returns:
+    str: The partition key, or None if the record has no value to partition on.
+    """
+    if partition == 'postcode':
+        address = record.get('Address')
+        match = None if is_missing(address) else re.search(r'\b(\d{2})\d{3}\b', str(address))
+        return match.group(1) if match else None
+    if partition == 'email_domain':
+        email = record.get('Email')
+        domain = None if is_missing(email) else str(email).strip().lower().partition('@')[2]
+        return domain or None
+    raise ValueError(f"Unknown partition '{partition}', expected 'postcode' or 'email_domain'")
+
+
+def shard_of(record, shard_count, partition='postcode', customer_id=None):
+    """
+    Assigns a customer to a shard with a stable hash of its partition key.
+
+    Customers without a partition key are spread over the shards by their id.
+
+    Parameters:
+    record (dict): A customer record.
+    shard_count (int): The number of shards.
+    partition (str, optional): See `partition_key`. Defaults to 'postcode'.
+    customer_id (str, optional): The customer id, used when the record has no partition key.
+
+    Returns:
+    int: The shard number.
+    """
+    key = partition_key(record, partition)
+    if key is None:
+        key = str(customer_id if customer_id is not None else record.get('_id'))
+    return zlib.crc32(key.encode()) % shard_count
+
+
+def _answer_searches(index, connection, searches):
+    # Answer the pending searches with one search of all their queries, for the largest n asked for
+    try:
+        queries = np.concatenate([queries for _, queries, _ in searches])
+        ids, scores = index.search(queries, n=max(n for _, _, n in searches))
+    except Exception as e:
+        for request_id, _, _ in searches:
+            connection.send((request_id, 'error', e))
+        return
+    start = 0
+    for request_id, queries, n in searches:
+        end = start + len(queries)
+        connection.send((request_id, 'ok', ([i[:n] for i in ids[start:end]], [s[:n] for s in scores[start:end]])))
+        start = end
+
+
+def serve_shard(path, connection, max_batch=SHARD_MAX_BATCH):
+    """
+    Serves the nearest neighbour index of one shard in a worker process.
+
+    The worker loads the index persisted in `path` (memory-mapping its vectors) and answers
+    (request id, 'search', queries, n) and (request id, 'add', ids, vectors) messages with
+    (request id, status, result) until it receives None. The searches waiting in the pipe, up to `max_batch` of
+    them, are answered with one search of all their queries, which turns concurrent searches into one matrix product.
+
+    Parameters:
+    path (str): The directory of the shard index.
+    connection (Connection): The worker end of the pipe to the coordinator.
+    max_batch (int, optional): The most searches answered at once. Defaults to the SHARD_MAX_BATCH environment variable or 64.
+    """
+    index = load_ann_index(path)
+    running = True
+    while running:
+        messages = [connection.recv()]
+        while messages[-1] is not None and len(messages) < max_batch and connection.poll():
+            messages.append(connection.recv())
+
+        searches = []
+        for message in messages:
+            if message is None:
+                running = False
+                break
+            request_id, command, *args = message
+            if command == 'search':
+                searches.append((request_id, np.asarray(args[0], dtype=np.float32), args[1]))
+                continue
+            # An add only runs after the searches received before it
+            if searches:
+                _answer_searches(index, connection, searches)
+                searches = []
+            try:
+                if command == 'add':
+                    index.add(*args)
+                    connection.send((request_id, 'ok', len(index.ids)))
+                else:
+                    connection.send((request_id, 'error', ValueError(f"Unknown command '{command}'")))
+            except Exception as e:
+                connection.send((request_id, 'error', e))
+        if searches:
+            _answer_searches(index, connection, searches)
+    connection.close()
+
+
+def build_shards(path, ids, vectors, records, shard_count=SHARD_COUNT, partition=SHARD_PARTITION, backend='brute_force', **params):
+    """
+    Partitions the customers into shards and persists the nearest neighbour index of every shard.
+
+    Parameters:
+    path (str): The directory to write the shards to, one sub-directory per shard.
+    ids (list): The customer ids.
+    vectors (ndarray): The customer embeddings, row-aligned with `ids`.
+    records (list): The customer records, row-aligned with `ids`, used for the partitioning.
+    shard_count (int, optional): The number of shards. Defaults to the SHARD_COUNT environment variable or 4.
+    partition (str, optional): See `partition_key`. Defaults to the SHARD_PARTITION environment variable or 'postcode'.
+    backend (str, optional): The ANN backend of every shard. Defaults to 'brute_force'.
+    **params: Backend parameters, e.g. `nprobe` for 'ivf_flat'.
+
+    Returns:
+    list: The number of customers of every shard.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    shards = np.array([shard_of(r, shard_count, partition, i) for i, r in zip(ids, records)], dtype=np.int64)
+    ids = np.asarray(ids, dtype=object)
+
+    sizes = []
+    for shard in range(shard_count):
+        rows = np.flatnonzero(shards == shard)
+        if len(rows):
+            index = build_ann_index(backend, list(ids[rows]), vectors[rows].reshape(len(rows), vectors.shape[1]), **params)
+        else:
+            # An empty partition has nothing to train e.g. the IVF centroids on; its customers are added to an exact index
+            index = BruteForceIndex(vectors.shape[1])
+        index.save(os.path.join(path, str(shard)))
+        sizes.append(len(rows))
+
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'shards.json'), 'w') as f:
+        json.dump({'shard_count': shard_count, 'partition': partition, 'sizes': sizes}, f)
+    return sizes
+
+
+class ShardedIndex:
+    """
+    Coordinator of a sharded nearest neighbour index, with one worker process per shard.
+
+    A search is sent to every worker at once (scatter), each worker returns its own top-n and the coordinator
+    merges them by score (gather). New customers are routed to the shard of their partition key.
+    It has the `search` interface of the indexes in `ann_index.py`.
+
+    Requests carry an id and replies are matched to them by a reader thread per shard, so searches from several
+    threads are in flight at the same time: each shard answers the searches waiting for it together (see
+    `serve_shard`) and does not wait for the other shards to finish the previous search. When a worker stops, e.g.
+    because it crashed, the requests waiting for it and every later request to it fail with a `ShardUnavailableError`,
+    and a worker which does not answer within `timeout` seconds fails the request with a `TimeoutError`, so a check
+    never blocks on a shard for good.
+    """
+
+    def __init__(self, path, timeout=SHARD_TIMEOUT_SECONDS):
+        with open(os.path.join(path, 'shards.json')) as f:
+            info = json.load(f)
+        self.path = path
+        self.shard_count = info['shard_count']
+        self.partition = info['partition']
+        self.sizes = info['sizes']
+        self.timeout = timeout
+        self._request_ids = itertools.count()
+        # The shard and future of every request waiting for its reply, and the shards whose worker stopped
+        self._pending = {}
+        self._stopped_shards = set()
+        self._pending_lock = threading.Lock()
+
+        # Spawned workers do not inherit the threads and open connections of the coordinator
+        context = multiprocessing.get_context('spawn')
+        self.connections, self.workers = [], []
+        for shard in range(self.shard_count):
+            coordinator_end, worker_end = context.Pipe()
+            worker = context.Process(
+                target=serve_shard, args=(os.path.join(path, str(shard)), worker_end), name=f'shard-{shard}', daemon=True,
+            )
+            worker.start()
+            self.connections.append(coordinator_end)
+            self.workers.append(worker)
+        self._send_locks = [threading.Lock() for _ in self.connections]
+        self.readers = [
+            threading.Thread(target=self._read_replies, args=(shard, connection), name=f'shard-{shard}-reader', daemon=True)
+            for shard, connection in enumerate(self.connections)
+        ]
+        for reader in self.readers:
+            reader.start()
+
+    def _read_replies(self, shard, connection):
+        # Hand every reply of a shard to the request waiting for it
+        while True:
+            try:
+                request_id, status, result = connection.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                _, future = self._pending.pop(request_id, (shard, None))
+            # None when the request has already failed
+            if future is None:
+                continue
+            if status == 'error':
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        # The worker stopped: no reply will come for the requests still waiting for it
+        with self._pending_lock:
+            self._stopped_shards.add(shard)
+            request_ids = [request_id for request_id, (s, _) in self._pending.items() if s == shard]
+            futures = [self._pending.pop(request_id)[1] for request_id in request_ids]
+        for future in futures:
+            future.set_exception(ShardUnavailableError(f'The worker of shard {shard} stopped'))
+
+    def _request(self, shard, command, *args):
+        future = Future()
+        request_id = next(self._request_ids)
+        with self._pending_lock:
+            if shard in self._stopped_shards:
+                future.set_exception(ShardUnavailableError(f'The worker of shard {shard} stopped'))
+                return future
+            self._pending[request_id] = (shard, future)
+        try:
+            with self._send_locks[shard]:
+                self.connections[shard].send((request_id, command, *args))
+        except OSError as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            error = ShardUnavailableError(f'The worker of shard {shard} stopped')
+            error.__cause__ = e
+            future.set_exception(error)
+        return future
+
+    def _result(self, future):
+        # Drop a request whose reply did not come in time, so that a late reply is ignored
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            with self._pending_lock:
+                for request_id, (_, pending) in list(self._pending.items()):
+                    if pending is future:
+                        del self._pending[request_id]
+            raise TimeoutError(f'A shard worker did not answer within {self.timeout} seconds') from None
+
+    def search(self, queries, n=5):
+        """
+        Finds the n most similar customers of every query across all shards.
+
+        Parameters:
+        queries (ndarray): A 2-d array of query vectors.
+        n (int, optional): Number of neighbours to return per query. Defaults to 5.
+
+        Returns:
+        tuple: A list with the neighbour ids of every query and a list with their similarity scores.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        futures = [self._request(shard, 'search', queries, n) for shard in range(self.shard_count)]
+        shard_results = [self._result(future) for future in futures]
+
+        ids, scores = [], []
+        for q in range(len(queries)):
+            candidates = sorted(
+                ((score, i) for shard_ids, shard_scores in shard_results for i, score in zip(shard_ids[q], shard_scores[q])),
+                key=lambda candidate: candidate[0], reverse=True,
+            )[:n]
+            ids.append([i for _, i in candidates])
+            scores.append([score for score, _ in candidates])
+        return ids, scores
+
+    def add(self, ids, vectors, records):
+        """
+        Adds customers to the shards of their partition key.
+
+        Parameters:
+        ids (list): The customer ids.
+        vectors (ndarray): The customer embeddings, row-aligned with `ids`.
+        records (list): The customer records, row-aligned with `ids`.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        shards = [shard_of(r, self.shard_count, self.partition, i) for i, r in zip(ids, records)]
+        futures = {}
+        for shard in sorted(set(shards)):
+            rows = [row for row, s in enumerate(shards) if s == shard]
+            futures[shard] = self._request(shard, 'add', [ids[row] for row in rows], vectors[rows])
+        for shard, future in futures.items():
+            self.sizes[shard] = self._result(future)
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        for connection, send_lock, worker, reader in zip(self.connections, self._send_locks, self.workers, self.readers):
+            try:
+                with send_lock:
+                    connection.send(None)
+            except OSError:
+                # The worker has already stopped
+                pass
+            worker.join()
+            reader.join()
+            connection.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Compare a sharded index with a single index on an exported matrix of embeddings.')
+    parser.add_argument('vectors', help='.npy file of embeddings')
+    parser.add_argument('path', help='directory to write the shards to')
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--n', type=int, default=5)
+    args = parser.parse_args()
+
+    vectors = np.load(args.vectors, mmap_mode='r')
+    ids = [str(i) for i in range(len(vectors))]
+    # No customer fields in a bare matrix: the customers are spread over the shards by id
+    print('shard sizes', build_shards(args.path, ids, vectors, [{}] * len(ids), shard_count=args.shards))
+
+    queries = np.asarray(vectors[np.random.default_rng(0).choice(len(vectors), size=args.queries, replace=False)])
+    single = BruteForceIndex(vectors.shape[1])
+    single.add(ids, vectors)
+    sharded = ShardedIndex(args.path)
+    try:
+        # Wait for the workers to start and load their shard
+        sharded.search(queries[:1], n=args.n)
+        start = time.perf_counter()
+        sharded_ids, _ = sharded.search(queries, n=args.n)
+        sharded_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        single_ids, _ = single.search(queries, n=args.n)
+        single_seconds = time.perf_counter() - start
+    finally:
+        sharded.close()
+
+    agreement = np.mean([len(set(a) & set(b)) / args.n for a, b in zip(sharded_ids, single_ids)])
+    print(f'single: {single_seconds:.3f}s, sharded: {sharded_seconds:.3f}s, agreement: {agreement:.3f}')
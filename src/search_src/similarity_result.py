@@ -1,11 +1,32 @@
-# import os
-# import json
-import pandas as pd
-import recordlinkage
+import json
+import os
+import threading
 # from bson import ObjectId
 # from dotenv import load_dotenv
-from superduperdb import Document
-from src.search_src.create_superduperdb import search_functionality
+from src.search_src.ann_index import ANN_BACKENDS, build_ann_index, load_ann_index
+from src.search_src.blocking_index import BlockingIndex
+from src.search_src.create_superduperdb import (
+    MODEL_IDENTIFIER,
+    add_to_vector_searcher,
+    artifact_directory,
+    build_details,
+    count_customer_embeddings,
+    count_customers,
+    fetch_customers,
+    find_nearest_ids,
+    insert_customers,
+    iter_customers,
+    load_customer_embeddings,
+    search_functionality,
+)
+from src.search_src.customer_feed import CustomerFeed, publish
+from src.search_src.lexical_index import LexicalIndex, build_lexical_index, reciprocal_rank_fusion
+from src.search_src.instrumentation import increment, instrumented, stage
+from src.search_src.query_batcher import QueryBatcher
+from src.search_src.query_cache import normalize_search_term, query_embeddings, query_results
+from src.search_src.reranker import short_circuit_candidates, similar_candidates
+from src.search_src.sharded_index import SHARD_COUNT, SHARD_PARTITION, ShardedIndex, ShardUnavailableError, build_shards
+from src.search_src.resource_cache import cached_items, get_cached, invalidate, register_disposer
 
 # # Load environment variables from .env file
 # load_dotenv()
@@ -22,90 +43,670 @@ from src.search_src.create_superduperdb import search_functionality
 
 
 
-# @st.cache_resource
-def get_nearest_similarity(chunks, mongodb_uri, artifact_store, search_term, n=5):
+def build_comparison(method='jarowinkler', threshold=0.85):
+    """
+    Builds the record linkage comparison rules used to rerank the nearest neighbours.
+
+    The reranker in `reranker.py` computes the same features without pandas; this comparison is kept
+    as the reference its output is checked against.
+
+    Parameters:
+    method (str, optional): The string comparison method to use. Defaults to 'jarowinkler'.
+    threshold (float, optional): The threshold for string comparison. Defaults to 0.85.
+
+    Returns:
+    Compare: A recordlinkage Compare object with an exact phone comparison and string comparisons
+             on the full name, email and address.
+    """
+    import recordlinkage
+
+    compare = recordlinkage.Compare()
+    compare.exact('Phone Number', 'Phone Number', label='Phone Number')
+    compare.string('Full Name', 'Full Name', method=method, threshold=threshold, label='Full Name')
+    compare.string("Email", "Email", method=method, threshold=threshold, label="Email")
+    compare.string("Address", "Address", method=method, threshold=threshold, label="Address")
+    return compare
+
+
+# 'full' compares every field of every neighbour; 'short_circuit' stops at the first matching field and searches
+# SHORT_CIRCUIT_K neighbours first, widening the search up to n only when none of them matches
+RERANK_MODES = ('full', 'short_circuit')
+RERANK_MODE = os.getenv('RERANK_MODE', 'full')
+SHORT_CIRCUIT_K = int(os.getenv('SHORT_CIRCUIT_K', 2))
+
+# 'vector' searches the embeddings only; 'hybrid' also searches the character n-gram index of the details and fuses
+# the HYBRID_DEPTH best customers of both by reciprocal rank
+RETRIEVAL_MODES = ('vector', 'hybrid')
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'vector')
+HYBRID_DEPTH = int(os.getenv('HYBRID_DEPTH', 20))
+
+RESULT_COLUMNS = ['_id', 'Full Name', 'Email', 'Address', 'Phone Number', 'details', 'score']
+
+# Stop the shard worker processes and the batching thread of the resources dropped by `invalidate`, e.g. on a reload
+register_disposer('sharded_index', lambda sharded_index: sharded_index.close())
+register_disposer('query_batcher', lambda query_batcher: query_batcher.close())
+
+
+def get_search_index(chunks, mongodb_uri, artifact_store):
+    """
+    Returns the database, collection and model of the vector index, setting it up only once per process.
+
+    The first call builds the index (or attaches to an index which already exists in the database);
+    every later call with the same MongoDB URI and artifact store reuses the same database handle and model,
+    so a search only has to encode the search term and query the index.
+
+    Parameters:
+    chunks (list or str): A list of dictionaries, or the path of a customer snapshot, used to build the index if it does not exist yet.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+
+    Returns:
+    tuple: A tuple containing the database instance, the collection, and the model used for embedding.
+    """
+    def build():
+        db, collection, model = search_functionality(chunks, mongodb_uri, artifact_store)
+        # Follow the customers registered by other processes from here on, before any index of this process is
+        # loaded, so that none of them is missed (see `sync_customers`). The in-memory vector searcher of
+        # superduperdb is only loaded by the first search of the 'superduperdb' backend (see `find_nearest_ids`),
+        # so that the processes serving another backend do not hold every embedding in memory once more
+        get_cached('customer_feed', (mongodb_uri, artifact_store, MODEL_IDENTIFIER), lambda: CustomerFeed(db))
+        return db, collection, model
+
+    return get_cached('search_index', (mongodb_uri, artifact_store, MODEL_IDENTIFIER), build)
+
+
+def get_ann_index(chunks, mongodb_uri, artifact_store, backend, **params):
+    """
+    Returns the in-process nearest neighbour index of the given backend, loading or building it only once per process.
+
+    The index is persisted in the artifact store, so a restart loads it from disk instead of rebuilding it,
+    unless the collection holds a different number of embedded customers than the persisted index.
+    It is built from the embeddings already stored by the vector index listener, so nothing is re-encoded.
+
+    Parameters:
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the vector index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    backend (str): One of the backends of `ann_index.build_ann_index`, e.g. 'ivf_flat' or 'int8'.
+    **params: Backend parameters used when the index is built, see `build_ann_index`.
+
+    Returns:
+    The nearest neighbour index.
+    """
+    def build():
+        db, _, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+        path = artifact_directory(artifact_store, 'ann', backend)
+        if os.path.exists(os.path.join(path, 'index.json')):
+            ann_index = load_ann_index(path)
+            if len(ann_index.ids) == count_customer_embeddings(db):
+                return ann_index
+
+        records, vectors = load_customer_embeddings(db)
+        ann_index = build_ann_index(backend, [r['_id'] for r in records], vectors, **params)
+        ann_index.save(path)
+        return ann_index
+
+    return get_cached('ann_index', (mongodb_uri, artifact_store, MODEL_IDENTIFIER, backend), build)
+
+
+def get_sharded_index(chunks, mongodb_uri, artifact_store, shard_count=SHARD_COUNT, partition=SHARD_PARTITION):
+    """
+    Returns the sharded nearest neighbour index, starting its worker processes only once per process.
+
+    Every shard count and partitioning has its own shards, persisted under
+    '<artifact store>/shards/<partition>-<shard count>' and cached under its own key, so two configurations used
+    in one process do not share worker processes or files. The shards are reused on a restart unless the collection
+    holds a different number of embedded customers.
+
+    Parameters:
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the vector index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    shard_count (int, optional): The number of shards. Defaults to the SHARD_COUNT environment variable or 4.
+    partition (str, optional): 'postcode' or 'email_domain', see `sharded_index.partition_key`. Defaults to the
+                               SHARD_PARTITION environment variable or 'postcode'.
+
+    Returns:
+    ShardedIndex: The coordinator of the shard workers.
+    """
+    def build():
+        db, _, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+        path = artifact_directory(artifact_store, 'shards', f'{partition}-{shard_count}')
+        info_path = os.path.join(path, 'shards.json')
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                info = json.load(f)
+            if (info['shard_count'], info['partition'], sum(info['sizes'])) == (shard_count, partition, count_customer_embeddings(db)):
+                return ShardedIndex(path)
+
+        records, vectors = load_customer_embeddings(db)
+        build_shards(path, [r['_id'] for r in records], vectors, records, shard_count=shard_count, partition=partition)
+        return ShardedIndex(path)
+
+    return get_cached('sharded_index', (mongodb_uri, artifact_store, MODEL_IDENTIFIER, shard_count, partition), build)
+
+
+def get_blocking_index(chunks, mongodb_uri, artifact_store):
+    """
+    Returns the blocking index of the customers, building it only once per process.
+
+    Parameters:
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the vector index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+
+    Returns:
+    BlockingIndex: The index from normalized phone, email and compound name keys to customer ids.
+    """
+    def build():
+        db, _, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+        blocking_index = BlockingIndex()
+        for r in iter_customers(db):
+            blocking_index.add([r['_id']], [r])
+        return blocking_index
+
+    return get_cached('blocking_index', (mongodb_uri, artifact_store, MODEL_IDENTIFIER), build)
+
+
+def get_lexical_index(chunks, mongodb_uri, artifact_store):
+    """
+    Returns the character n-gram index of the customer details, loading or building it only once per process.
+
+    The index is persisted under '<artifact store>/lexical', where the ingest writes it next to the vector index,
+    and rebuilt when the collection holds a different number of customers than the persisted index.
+
+    Parameters:
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the vector index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+
+    Returns:
+    LexicalIndex: The BM25 index of the details of every customer.
+    """
+    def build():
+        db, _, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+        path = artifact_directory(artifact_store, 'lexical')
+        if os.path.exists(os.path.join(path, 'index.json')):
+            lexical_index = LexicalIndex.load(path)
+            if len(lexical_index.ids) == count_customers(db):
+                return lexical_index
+        return build_lexical_index(db, path)
+
+    return get_cached('lexical_index', (mongodb_uri, artifact_store, MODEL_IDENTIFIER), build)
+
+
+def add_customers(customers, chunks, mongodb_uri, artifact_store):
+    """
+    Adds newly registered customers to the database and embeds them into the existing vector index.
+
+    Parameters:
+    customers (list): A list of dictionaries with the 'Full Name', 'Email', 'Address' and 'Phone Number' of each customer.
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+
+    Returns:
+    list: The ids of the inserted customers.
+    """
+    db, collection, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+    inserted_ids = insert_customers(db, collection, customers)
+
+    # The listener added them to the vector searcher of this process; the other processes learn about them from the feed
+    publish(db, 'add', inserted_ids)
+    details = [c.get('details') or build_details(c) for c in customers]
+    apply_new_customers(db, inserted_ids, customers, details, mongodb_uri, artifact_store)
+    return inserted_ids
+
+
+def apply_new_customers(db, ids, records, details, mongodb_uri, artifact_store, vectors=None):
+    """
+    Adds inserted customers to the indexes cached in this process and drops the cached search results.
+
+    Parameters:
+    db (Datalayer): The database instance.
+    ids (list): The ids of the inserted customers.
+    records (list): Their customer records, aligned with `ids`.
+    details (list): Their 'details', aligned with `ids`.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    vectors (ndarray, optional): Their embeddings, to add them to the vector searcher of this process as well;
+                                 None when the listener of this process already did. Defaults to None.
+    """
+    # Cached search results may miss the new customers
+    query_results.clear()
+
+    # Keep the in-process indexes of this database in step with the collection
+    if vectors is not None:
+        add_to_vector_searcher(db, ids, vectors)
+    for _, blocking_index in cached_items('blocking_index', mongodb_uri=mongodb_uri, artifact_store=artifact_store):
+        blocking_index.add(ids, records)
+    for _, lexical_index in cached_items('lexical_index', mongodb_uri=mongodb_uri, artifact_store=artifact_store):
+        lexical_index.add(ids, details)
+
+    loaded_indexes = cached_items('ann_index', mongodb_uri=mongodb_uri, artifact_store=artifact_store)
+    sharded_indexes = cached_items('sharded_index', mongodb_uri=mongodb_uri, artifact_store=artifact_store)
+    if loaded_indexes or sharded_indexes:
+        embedded, embedded_vectors = load_customer_embeddings(db, ids=ids)
+        for _, ann_index in loaded_indexes:
+            ann_index.add([r['_id'] for r in embedded], embedded_vectors)
+        for _, sharded_index in sharded_indexes:
+            sharded_index.add([r['_id'] for r in embedded], embedded_vectors, embedded)
+
+
+def sync_customers(chunks, mongodb_uri, artifact_store):
+    """
+    Applies the customer changes published by other processes on the customer feed (see `customer_feed.py`).
+
+    Customers registered by another worker of the API, or another Streamlit process, are added to the vector
+    searcher and the indexes of this process, and the cached search results are dropped, so the next check sees
+    them. After a reload of the collection (e.g. by `ingest.py`) every resource of the database cached in this
+    process is dropped and rebuilt on its next use. A customer added while the indexes of this process were being
+    built can end up in them twice; the fetch of the nearest customers returns it once.
+
+    Parameters:
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    """
+    db, _, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+    feed = get_cached('customer_feed', (mongodb_uri, artifact_store, MODEL_IDENTIFIER), lambda: CustomerFeed(db))
+    for event in feed.poll():
+        if event['kind'] == 'reload':
+            query_results.clear()
+            invalidate(mongodb_uri=mongodb_uri, artifact_store=artifact_store)
+            return
+        records, vectors = load_customer_embeddings(db, ids=event['ids'])
+        apply_new_customers(
+            db, [r['_id'] for r in records], records, [r.get('details') or '' for r in records], mongodb_uri,
+            artifact_store, vectors=vectors,
+        )
+        increment('feed_customers_applied', len(records))
+
+
+def warm_up(chunks, mongodb_uri, artifact_store, blocking=True):
+    """
+    Loads everything the first dedup check needs in a background thread, so that the app can render right away.
+
+    The thread imports the heavy libraries, builds (or attaches to) the vector index, loads the model, starts
+    the query batcher, encodes a dummy search term and builds the blocking index. A check made before it is done
+    waits for the resources still being built instead of building them a second time.
+
+    Parameters:
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    blocking (bool, optional): Whether to build the blocking index as well. Defaults to True.
+
+    Returns:
+    Thread: The started warm-up thread.
+    """
+    def run():
+        import pandas  # noqa: F401
+
+        _, _, model = get_search_index(chunks, mongodb_uri, artifact_store)
+        get_query_batcher(model).encode('warm up')
+        if blocking:
+            get_blocking_index(chunks, mongodb_uri, artifact_store)
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def metrics_gauges():
+    """
+    Returns the cache and batching gauges exported next to the stage metrics of `instrumentation.py`.
+
+    Returns:
+    dict: The size and hit rate of the query caches and the batch size and queueing delay of the query batchers.
+    """
+    gauges = {}
+    for name, cache in [('query_embeddings', query_embeddings), ('query_results', query_results)]:
+        stats = cache.stats()
+        gauges[f'{name}_cache_size'] = stats['size']
+        gauges[f'{name}_cache_hit_rate'] = stats['hit_rate']
+    for _, batcher in cached_items('query_batcher'):
+        stats = batcher.stats()
+        gauges['query_batch_size_mean'] = stats['mean_batch_size']
+        gauges['query_queue_delay_p95_ms'] = stats['queue_delay_p95_ms']
+    return gauges
+
+
+@instrumented('nearest_similarity')
+def get_nearest_similarity(chunks, mongodb_uri, artifact_store, search_term, n=5, backend='superduperdb', vector=None, retrieval=RETRIEVAL_MODE):
     """
     Retrieves the most similar documents to a given search term from a MongoDB collection.
 
     This function connects to a MongoDB database and performs a similarity search on a specified collection.
     It returns the top 'n' documents that are most similar to the provided search term, based on the details field.
+    The search term is normalized first, and both its embedding and its nearest documents are cached
+    (see `query_cache.py`); the cached documents are dropped whenever customers are added.
 
     Parameters:
-    chunks (int): Number of chunks to process (used in search_functionality).
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed (used in search_functionality).
     mongodb_uri (str): MongoDB connection URI.
     artifact_store (str): Path to the artifact store.
     search_term (str): The term to search for in the document collection.
     n (int, optional): Number of top similar documents to return. Defaults to 5.
+    backend (str, optional): 'superduperdb' to search with the MongoDB vector index, or one of the in-process
+                             nearest neighbour backends (see `ann_index.py`), or 'sharded' to search the shard worker
+                             processes of `sharded_index.py`. Defaults to 'superduperdb'.
+    vector (list, optional): The embedding of the search term, when it has already been computed. Defaults to None.
+    retrieval (str, optional): 'vector' to rank by embedding similarity only, or 'hybrid' to also look the search
+                               term up in the character n-gram index of the details (see `lexical_index.py`) and fuse
+                               the HYBRID_DEPTH best customers of both rankings by reciprocal rank. A typo'd phone
+                               number or email the embedding misses still shares most of its n-grams, so a small n
+                               finds duplicates that the vector search alone only ranks further down. The 'score' of
+                               the hybrid results is the fused reciprocal rank score, not a cosine similarity.
+                               Defaults to the RETRIEVAL_MODE environment variable or 'vector'.
 
     Returns:
     list: A list of documents (in dict format) that are most similar to the search term.
     """
 
-    # Initialize the search functionality with the given parameters
-    db, collection, model = search_functionality(chunks, mongodb_uri, artifact_store)
+    if retrieval not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{retrieval}', expected one of {RETRIEVAL_MODES}")
+
+    # Serve resubmissions of the same details from the cache. Only the cache key is normalized: the search term is
+    # encoded as given, in the format of the stored 'details', so that caching does not change the query embedding
+    cache_term = normalize_search_term(search_term)
+    result_key = (mongodb_uri, artifact_store, backend, retrieval, n, cache_term)
+    cached_results = query_results.get(result_key)
+    from superduperdb import Document
+
+    if cached_results is not None:
+        increment('query_result_cache_hits')
+        return [Document(dict(r)) for r in cached_results]
+
+    # Get the (already built) search functionality for the given parameters
+    with stage('setup'):
+        db, collection, model = get_search_index(chunks, mongodb_uri, artifact_store)
+    if vector is None:
+        with stage('encode'):
+            vector = get_query_embedding(model, search_term)
+
+    # The hybrid mode fuses deeper rankings than the n customers it returns
+    depth = max(n, HYBRID_DEPTH) if retrieval == 'hybrid' else n
+    with stage('vector_search'):
+        if backend in ANN_BACKENDS:
+            # Look the search term up in the in-process index
+            ids, scores = get_ann_index(chunks, mongodb_uri, artifact_store, backend).search([vector], n=depth)
+            ids, scores = ids[0], scores[0]
+        elif backend == 'sharded':
+            # Scatter the search term to the shard workers and merge their top-n
+            try:
+                ids, scores = get_sharded_index(chunks, mongodb_uri, artifact_store).search([vector], n=depth)
+            except ShardUnavailableError:
+                # Start the workers again for the next check
+                invalidate('sharded_index', mongodb_uri=mongodb_uri, artifact_store=artifact_store)
+                raise
+            ids, scores = ids[0], scores[0]
+        else:
+            # Execute the similarity search on the vector index of the collection
+            ids, scores = find_nearest_ids(db, vector, n=depth, model_identifier=model.identifier)
+
+    if retrieval == 'hybrid':
+        with stage('lexical_search'):
+            lexical_ids, _ = get_lexical_index(chunks, mongodb_uri, artifact_store).search([cache_term], n=depth)
+            ids, scores = reciprocal_rank_fusion([[str(i) for i in ids], lexical_ids[0]], n=n)
+
+    with stage('fetch'):
+        results = fetch_customers(db, collection, ids, scores)
+    query_results.set(result_key, results)
+    return [Document(dict(r)) for r in results]
+
+
+def get_query_batcher(model, max_batch_size=64, max_wait_ms=5):
+    """
+    Returns the query batcher of a model, starting it only once per process.
+
+    Every search of the process goes through the same batcher, so concurrent Streamlit sessions, threads of the
+    async service and API requests share encode calls. The batch size and waiting time of the first call are kept.
+
+    Parameters:
+    model (Model): The model used for embedding.
+    max_batch_size (int, optional): The maximum number of search terms encoded together. Defaults to 64.
+    max_wait_ms (float, optional): How long the first search term of a batch waits for more. Defaults to 5.
 
-    # Execute the similarity search on the collection
-    result = db.execute(
-        collection
-        .like(Document({'details': search_term}), vector_index=f'pymongo-docs-{model.identifier}', n=n)
-        .find({}, {'Full Name': 1, 'Email': 1, 'Address': 1, 'Phone Number': 1, 'details': 1, 'score': 1, '_id': 1})
+    Returns:
+    QueryBatcher: The batcher encoding search terms with `model.predict`.
+    """
+    return get_cached(
+        'query_batcher',
+        (None, None, model.identifier),
+        lambda: QueryBatcher(model.predict, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms),
     )
 
-    return result
+
+def get_query_embedding(model, search_term):
+    """
+    Encodes a search term, reusing the embedding of an earlier search term with the same normalized form.
+
+    The search term is encoded as given, only its cache key is normalized (see `normalize_search_term`).
+    Search terms which are not cached are encoded by the query batcher of the model, together with the
+    search terms of concurrent searches.
+
+    Parameters:
+    model (Model): The model used for embedding.
+    search_term (str): The search term, in the format of the stored 'details' (see `build_details`).
+
+    Returns:
+    list: The embedding of the search term.
+    """
+    cache_key = (model.identifier, normalize_search_term(search_term))
+    vector = query_embeddings.get(cache_key)
+    if vector is None:
+        vector = get_query_batcher(model).encode(search_term)
+        query_embeddings.set(cache_key, vector)
+    return vector
+
+
+def get_query_embeddings(model, search_terms):
+    """
+    Encodes several search terms, encoding the ones which are not cached yet in a single batch.
+
+    As in `get_query_embedding`, the search terms are encoded as given and cached by their normalized form.
+
+    Parameters:
+    model (Model): The model used for embedding.
+    search_terms (list): The search terms, in the format of the stored 'details'.
+
+    Returns:
+    list: The embeddings of the search terms, in the same order.
+    """
+    keys = [normalize_search_term(term) for term in search_terms]
+    vectors = [query_embeddings.get((model.identifier, key)) for key in keys]
+    # The first search term of every missing key is encoded
+    missing = {}
+    for key, term, vector in zip(keys, search_terms, vectors):
+        if vector is None:
+            missing.setdefault(key, term)
+    if missing:
+        encoded = dict(zip(missing, model.predict(list(missing.values()))))
+        for key, vector in encoded.items():
+            query_embeddings.set((model.identifier, key), vector)
+        vectors = [encoded[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+    return vectors
+
+
+@instrumented('blocking')
+def get_blocked_matches(target_df, chunks, mongodb_uri, artifact_store, method='jarowinkler', threshold=0.85, normalized=False, rerank='full'):
+    """
+    Looks the target up in the blocking index and reranks the customers sharing a blocking key with it.
+
+    Parameters:
+    target_df (DataFrame): The target DataFrame to match against.
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    method (str): The string comparison method to use. Default is 'jarowinkler'.
+    threshold (float): The threshold for string comparison. Default is 0.85.
+    normalized (bool): Whether to compare the normalized fields stored at ingest. Default is False.
+    rerank (str): 'full' or 'short_circuit', see `rerank_results`. Default is 'full'.
+
+    Returns:
+    DataFrame: The matching customers with a score of 1.0, or None if no blocked customer matches.
+    """
+    blocking_index = get_blocking_index(chunks, mongodb_uri, artifact_store)
+    blocked_ids = list(dict.fromkeys(i for r in target_df.to_dict('records') for i in blocking_index.lookup(r)))
+    if not blocked_ids:
+        return None
+
+    db, collection, _ = get_search_index(chunks, mongodb_uri, artifact_store)
+    blocked_results = fetch_customers(db, collection, blocked_ids, [1.0] * len(blocked_ids))
+    filtered_df = rerank_results(target_df, blocked_results, method=method, threshold=threshold, normalized=normalized, rerank=rerank)
+    return filtered_df if len(filtered_df) > 0 else None
+
+
+def rerank_results(target_df, results, method='jarowinkler', threshold=0.85, normalized=False, rerank='full'):
+    """
+    Keeps the candidate customers which match the target on at least one field, sorted by score.
+
+    Parameters:
+    target_df (DataFrame): The target DataFrame to match against.
+    results (list): The candidate customers, as dictionaries with their '_id' and 'score'.
+    method (str): The string comparison method to use. Default is 'jarowinkler'.
+    threshold (float): The threshold for string comparison. Default is 0.85.
+    normalized (bool): Whether to compare the normalized fields stored at ingest instead of the raw fields
+                       (see `reranker.compare_normalized_pairs`). Default is False.
+    rerank (str): 'full' to compute every comparison, or 'short_circuit' to stop comparing a candidate at its
+                  first matching field (see `reranker.short_circuit_candidates`); both keep the same candidates.
+                  Default is 'full'.
+
+    Returns:
+    DataFrame: The matching candidates indexed by '_id', sorted by the 'score' field in descending order.
+    """
+    import pandas as pd
+
+    if not results:
+        return pd.DataFrame(columns=RESULT_COLUMNS).set_index('_id')
+    with stage('dataframe'):
+        comparison_df = pd.DataFrame(results).set_index('_id')
+
+    # Compare the target with every candidate and keep the candidates matching on at least one field
+    if rerank not in RERANK_MODES:
+        raise ValueError(f"Unknown rerank mode '{rerank}', expected one of {RERANK_MODES}")
+    candidates = short_circuit_candidates if rerank == 'short_circuit' else similar_candidates
+    with stage('compare'):
+        similar_positions = candidates(
+            target_df.to_dict('records'), comparison_df.to_dict('records'), method=method, threshold=threshold,
+            normalized=normalized,
+        )
+    filtered_df = comparison_df.iloc[similar_positions]
+
+    # Sort by score and return
+    with stage('sort'):
+        return filtered_df.sort_values(by='score', ascending=False)
+
+
+def widening_rerank(target_df, chunks, mongodb_uri, artifact_store, search_term, n=5, first_k=SHORT_CIRCUIT_K, method='jarowinkler', threshold=0.85, backend='superduperdb', normalized=False, retrieval=RETRIEVAL_MODE):
+    """
+    Reranks the nearest neighbours of the search term with the short-circuit comparison, searching only as many
+    neighbours as needed to reach a decision.
+
+    The first `first_k` neighbours are compared first. Only if none of them matches is the search widened, doubling
+    the number of neighbours up to `n` and comparing only the neighbours which were not compared yet. When a match
+    is found among the first neighbours, the neighbours further away are neither fetched nor compared, so fewer
+    matches may be returned than with the full rerank; whether the target is a duplicate is decided the same way.
+
+    Parameters:
+    target_df (DataFrame): The target DataFrame to match against.
+    chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
+    mongodb_uri (str): MongoDB connection URI.
+    artifact_store (str): Path to the artifact store.
+    search_term (str): The search term or phrase to use for matching records.
+    n (int): The maximum number of neighbours to compare. Default is 5.
+    first_k (int): The number of neighbours compared first. Default is the SHORT_CIRCUIT_K environment variable or 2.
+    method (str): The string comparison method to use. Default is 'jarowinkler'.
+    threshold (float): The threshold for string comparison. Default is 0.85.
+    backend (str): The nearest neighbour backend, see `get_nearest_similarity`. Default is 'superduperdb'.
+    normalized (bool): Whether the reranker compares the normalized fields stored at ingest. Default is False.
+    retrieval (str): 'vector' or 'hybrid', see `get_nearest_similarity`. Default is the RETRIEVAL_MODE environment variable or 'vector'.
+
+    Returns:
+    DataFrame: The matching neighbours of the last search, sorted by the 'score' field in descending order.
+    """
+    k, compared = min(max(first_k, 1), n), set()
+    while True:
+        # The embedding of the search term is cached, so a wider search only repeats the vector search
+        nearest_results = get_nearest_similarity(chunks, mongodb_uri, artifact_store, search_term, n=k, backend=backend, retrieval=retrieval)
+        with stage('unpack'):
+            comparison_data = [r for r in (result.unpack() for result in nearest_results) if r['_id'] not in compared]
+        filtered_df = rerank_results(
+            target_df, comparison_data, method=method, threshold=threshold, normalized=normalized, rerank='short_circuit'
+        )
+        if len(filtered_df) > 0 or k >= n or len(nearest_results) < k:
+            return filtered_df
+
+        compared.update(r['_id'] for r in comparison_data)
+        k = min(2 * k, n)
+        increment('rerank_widenings')
 
 
 # @st.cache_data
-def get_record_linkage(target_df, chunks, mongodb_uri, artifact_store, search_term, n=5, method='jarowinkler', threshold=0.85):
+@instrumented('record_linkage')
+def get_record_linkage(target_df, chunks, mongodb_uri, artifact_store, search_term, n=5, method='jarowinkler', threshold=0.85, backend='superduperdb', blocking=True, normalized=False, rerank=RERANK_MODE, retrieval=RETRIEVAL_MODE):
     """
     Finds and sorts database records that closely match the search term using record linkage and similarity scoring.
 
+    When `blocking` is on, customers sharing a normalized phone number, email or phonetic last name with the target
+    are looked up first; if any of them passes the record linkage rules they are returned (with a score of 1.0)
+    without encoding the search term. Otherwise the nearest neighbours of the search term are reranked.
+
     Parameters:
     - target_df (DataFrame): The target DataFrame to match against.
-    - chunks (int): Number of chunks to divide the data for processing.
+    - chunks (list or str): Customer records, or the path of a customer snapshot, used to build the index the first time it is needed.
     - MONGODB_URI (str): MongoDB connection URI.
     - artifact_store (str): Path or URI to the artifact store.
     - search_term (str): The search term or phrase to use for matching records.
     - n (int): Number of nearest similarity results to retrieve. Default is 5.
     - method (str): The string comparison method to use. Default is 'jarowinkler'.
     - threshold (float): The threshold for string comparison. Default is 0.85.
+    - backend (str): The nearest neighbour backend, see `get_nearest_similarity`. Default is 'superduperdb'.
+    - blocking (bool): Whether to look up exact and near-exact matches in the blocking index first. Default is True.
+    - normalized (bool): Whether the reranker compares the normalized fields stored at ingest. Default is False.
+    - rerank (str): 'full' to compare every field of all n neighbours, which keeps every match for auditing, or
+                    'short_circuit' to stop at the first matching field and widen the search only when the closest
+                    neighbours do not match (see `widening_rerank`). Default is the RERANK_MODE environment variable or 'full'.
+    - retrieval (str): 'vector' to search the embeddings only, or 'hybrid' to fuse them with the character n-gram
+                       index of the details, see `get_nearest_similarity`. Default is the RETRIEVAL_MODE environment variable or 'vector'.
 
     Returns:
     DataFrame: A sorted DataFrame of records from the comparison database that closely match the search criteria.
               Sorted by the 'score' field in descending order.
     """
-    # Fetch nearest similarity results
-    nearest_results = get_nearest_similarity(chunks, mongodb_uri, artifact_store, search_term, n=n)
+    increment('checks')
+    with stage('sync'):
+        sync_customers(chunks, mongodb_uri, artifact_store)
+    if blocking:
+        blocked_df = get_blocked_matches(
+            target_df, chunks, mongodb_uri, artifact_store, method=method, threshold=threshold, normalized=normalized,
+            rerank=rerank,
+        )
+        if blocked_df is not None:
+            increment('blocking_hits')
+            increment('duplicates_found')
+            return blocked_df
 
-    # Unpack results and create a comparison DataFrame
-    comparison_data = [result.unpack() for result in nearest_results]
-    comparison_df = pd.DataFrame(comparison_data).set_index('_id')
+    if rerank == 'short_circuit':
+        filtered_df = widening_rerank(
+            target_df, chunks, mongodb_uri, artifact_store, search_term, n=n, method=method, threshold=threshold,
+            backend=backend, normalized=normalized, retrieval=retrieval,
+        )
+        if len(filtered_df) > 0:
+            increment('duplicates_found')
+        return filtered_df
 
-    # Create an indexer for record linkage
-    indexer = recordlinkage.Index()
-    indexer.full()
-    pairs = indexer.index(target_df, comparison_df)
-
-    # Setup comparison criteria
-    compare = recordlinkage.Compare()
-    compare.exact('Phone Number', 'Phone Number', label='Phone Number')
-    compare.string('Full Name', 'Full Name', method=method, threshold=threshold, label='Full Name')
-    compare.string("Email", "Email", method=method, threshold=threshold, label="Email")
-    compare.string("Address", "Address", method=method, threshold=threshold, label="Address")
-
-    # Compute similarity features
-    similarity_features = compare.compute(pairs, target_df, comparison_df)
-    similarity_columns = ['Phone Number', 'Full Name', 'Email', 'Address']
-    similarity_features['similarity_sum'] = similarity_features[similarity_columns].sum(axis=1)
-    similarity_features =  similarity_features.reset_index()
-
-    # Filter results based on similarity sum
-    # features = features.reset_index()
-    similar_ids = similarity_features[similarity_features['similarity_sum'] >= 1.0]['_id_2'].tolist()
-    filtered_df = comparison_df.loc[similar_ids]
-
-    # Sort by score and return
-    return filtered_df.sort_values(by='score', ascending=False)
+    # Fetch nearest similarity results
+    nearest_results = get_nearest_similarity(chunks, mongodb_uri, artifact_store, search_term, n=n, backend=backend, retrieval=retrieval)
 
+    # Unpack results and rerank them
+    with stage('unpack'):
+        comparison_data = [result.unpack() for result in nearest_results]
+    filtered_df = rerank_results(target_df, comparison_data, method=method, threshold=threshold, normalized=normalized)
+    if len(filtered_df) > 0:
+        increment('duplicates_found')
+    return filtered_df
 
 
 
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def normalize(vectors):
+    """
+    Scales each row of a matrix to unit length so that dot products become cosine similarities.
+
+    Parameters:
+    vectors (ndarray): A 2-d array of vectors.
+
+    Returns:
+    ndarray: A float32 array of the same shape with unit-length rows (all-zero rows are left as zeros).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_n_cosine(queries, vectors, n=5, block_size=65536):
+    """
+    Finds the n most similar vectors for every query using blocked matrix products.
+
+    The stored vectors are scanned in blocks of `block_size` rows so that the similarity matrix
+    never holds more than `len(queries) x block_size` values, and a running top-n is kept per query.
+
+    Parameters:
+    queries (ndarray): A 2-d array of unit-length query vectors.
+    vectors (ndarray): A 2-d array of unit-length stored vectors.
+    n (int, optional): Number of neighbours to return per query. Defaults to 5.
+    block_size (int, optional): Number of stored vectors compared at once. Defaults to 65536.
+
+    Returns:
+    tuple: Two arrays of shape (len(queries), n): the row positions of the neighbours in `vectors`
+           and their cosine similarity, sorted by similarity in descending order.
+    """
+    n = min(n, len(vectors))
+    blocks = (
+        (start, queries @ np.asarray(vectors[start:start + block_size], dtype=np.float32).T)
+        for start in range(0, len(vectors), block_size)
+    )
+    return top_n_from_blocks(blocks, len(queries), n)
+
+
+def top_n_from_blocks(blocks, query_count, n=5):
+    """
+    Keeps a running top-n over blocks of similarity scores, as computed by `top_n_cosine` or by a compressed index.
+
+    Parameters:
+    blocks (iterable): Tuples of the row position of the first stored vector of the block and the
+                       (query_count, block length) matrix of its scores.
+    query_count (int): The number of queries.
+    n (int, optional): Number of neighbours to return per query. It must not exceed the number of stored vectors. Defaults to 5.
+
+    Returns:
+    tuple: Two arrays of shape (query_count, n): the row positions of the neighbours and their scores,
+           sorted by score in descending order.
+    """
+    if n == 0:
+        return np.zeros((query_count, 0), dtype=np.int64), np.zeros((query_count, 0), dtype=np.float32)
+
+    best_scores = np.full((query_count, n), -np.inf, dtype=np.float32)
+    best_positions = np.zeros((query_count, n), dtype=np.int64)
+
+    for start, scores in blocks:
+        # Merge the block with the running top-n and keep the n best of both
+        k = min(n, scores.shape[1])
+        block_positions = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        block_scores = np.take_along_axis(scores, block_positions, axis=1)
+        all_scores = np.concatenate([best_scores, block_scores], axis=1)
+        all_positions = np.concatenate([best_positions, block_positions + start], axis=1)
+        keep = np.argpartition(-all_scores, n - 1, axis=1)[:, :n]
+        best_scores = np.take_along_axis(all_scores, keep, axis=1)
+        best_positions = np.take_along_axis(all_positions, keep, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_positions, order, axis=1), np.take_along_axis(best_scores, order, axis=1)